@@ -1,9 +1,15 @@
 const net = require("net");
 
+// framing: "newline"（1行に1つのJSON）または "length"（4バイトのビッグエンディアンの長さ + JSON）
+// サーバーの --framing と合わせる。応答はidで対応付けるため、複数のリクエストを同時に送れる
 class RPCClient {
-  constructor(host = "localhost", port = 10000) {
+  constructor(host = "localhost", port = 10000, framing = "newline") {
+    if (framing !== "newline" && framing !== "length") {
+      throw new Error(`Unknown framing: ${framing}`);
+    }
     this.host = host;
     this.port = port;
+    this.framing = framing;
     this.client = new net.Socket();
     this.requestId = 0;
     this.pendingRequests = new Map();
@@ -24,28 +30,49 @@ class RPCClient {
   }
 
   _setupMessageHandler() {
-    let buffer = "";
+    let buffer = Buffer.alloc(0);
     this.client.on("data", (data) => {
-      buffer += data.toString();
-
-      try {
-        const response = JSON.parse(buffer);
-        const resolver = this.pendingRequests.get(response.id);
-        if (resolver) {
-          if (response.error) {
-            resolver.reject(new Error(response.error.message));
-          } else {
-            resolver.resolve(response.result);
-          }
-          this.pendingRequests.delete(response.id);
+      buffer = buffer.length ? Buffer.concat([buffer, data]) : data;
+      let start = 0;
+      let search = buffer.length - data.length; // 前回までの残りには区切りがないので、追加分だけを探す
+      while (true) {
+        let frame;
+        if (this.framing === "newline") {
+          const end = buffer.indexOf(0x0a, search);
+          if (end < 0) break;
+          frame = buffer.subarray(start, end);
+          start = search = end + 1;
+        } else {
+          if (buffer.length - start < 4) break;
+          const end = start + 4 + buffer.readUInt32BE(start);
+          if (buffer.length < end) break;
+          frame = buffer.subarray(start + 4, end);
+          start = end;
         }
-        buffer = "";
-      } catch (e) {
-        // JSONのパースに失敗した場合は、データが完全に届いていない可能性があるため待機
+        this._handleResponse(frame);
       }
+      buffer = buffer.subarray(start);
     });
   }
 
+  _handleResponse(frame) {
+    let response;
+    try {
+      response = JSON.parse(frame.toString());
+    } catch (e) {
+      console.error("Invalid response:", e.message);
+      return;
+    }
+    const resolver = this.pendingRequests.get(response.id);
+    if (!resolver) return;
+    if (response.error) {
+      resolver.reject(new Error(response.error.message));
+    } else {
+      resolver.resolve(response.result);
+    }
+    this.pendingRequests.delete(response.id);
+  }
+
   async call(method, params) {
     const requestId = ++this.requestId;
     const request = {
@@ -56,7 +83,14 @@ class RPCClient {
 
     return new Promise((resolve, reject) => {
       this.pendingRequests.set(requestId, { resolve, reject });
-      this.client.write(JSON.stringify(request) + "\n");
+      const payload = Buffer.from(JSON.stringify(request));
+      if (this.framing === "newline") {
+        this.client.write(Buffer.concat([payload, Buffer.from("\n")]));
+      } else {
+        const header = Buffer.alloc(4);
+        header.writeUInt32BE(payload.length);
+        this.client.write(Buffer.concat([header, payload]));
+      }
     });
   }
 
@@ -95,6 +129,14 @@ async function example() {
     // 配列操作の例
     const sortResult = await client.call("sort", [[3, 1, 4, 1, 5, 9]]);
     console.log("Sort result:", sortResult);
+
+    // 応答を待たずに複数のリクエストを送る（応答はidで対応付けられる）
+    const results = await Promise.all([
+      client.call("sort", [Array.from({ length: 100000 }, () => Math.random())]),
+      client.call("subtract", [10, 3]),
+      client.call("reverse", ["pipelined"]),
+    ]);
+    console.log("Pipelined results:", results[0].length, results[1], results[2]);
   } catch (error) {
     console.error("Error:", error.message);
   } finally {
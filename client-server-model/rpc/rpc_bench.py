@@ -0,0 +1,139 @@
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import socket
+import time
+
+from server import FRAMERS, RPCServer
+
+# 同時に接続したクライアントがそれぞれリクエストを送り、サーバーのモードごとに
+# スループットと応答時間（リクエストごと・接続してから最初の応答まで）を比較する
+# --pipelineで1接続あたり応答を待たずに送るリクエスト数、--sort-sizeで大きなsortを混ぜる
+# 実行例: python rpc_bench.py --clients 200 --requests 20 --modes single asyncio
+#         python rpc_bench.py --clients 20 --requests 200 --pipeline 16 --workers 0 4 --sort-size 100000
+
+REQUESTS = [
+    ("subtract", [42, 23]),
+    ("reverse", ["hello"]),
+    ("sort", [[3, 1, 4, 1, 5, 9]]),
+    ("validAnagram", ["listen", "silent"]),
+]
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def run_server(mode: str, port: int, backlog: int, framing: str, workers: int):
+    devnull = open(os.devnull, "w")
+    os.dup2(devnull.fileno(), 1)
+    RPCServer("127.0.0.1", port, mode, backlog, framing, workers).start()
+
+
+async def client(port: int, index: int, args, latencies: list, first_responses: list, small_latencies: list):
+    framer = FRAMERS[args.framing]()
+    started = time.perf_counter()
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    sent = {}
+    received = 0
+    try:
+        next_id = 0
+        while received < args.requests:
+            # 応答待ちが--pipeline件になるまで送る
+            while next_id < args.requests and len(sent) < args.pipeline:
+                if args.sort_size and next_id % 10 == 0:
+                    method, params = "sort", [list(range(args.sort_size, 0, -1))]
+                else:
+                    method, params = REQUESTS[(index + next_id) % len(REQUESTS)]
+                payload = json.dumps({"method": method, "params": params, "id": next_id}).encode()
+                writer.write(framer.encode(payload))
+                sent[next_id] = (time.perf_counter(), method)
+                next_id += 1
+            data = await reader.read(65536)
+            if not data:
+                raise ConnectionError("connection closed")
+            for frame in framer.feed(data):
+                response = json.loads(frame)
+                assert "error" not in response, response
+                request_sent, method = sent.pop(response["id"])
+                now = time.perf_counter()
+                latencies.append(now - request_sent)
+                if method != "sort":
+                    small_latencies.append(now - request_sent)
+                if received == 0:
+                    first_responses.append(now - started)
+                received += 1
+    finally:
+        writer.close()
+
+
+async def run_clients(port: int, args) -> dict:
+    latencies = []
+    first_responses = []
+    small_latencies = []
+    started = time.perf_counter()
+    tasks = [asyncio.wait_for(client(port, i, args, latencies, first_responses, small_latencies), args.timeout)
+             for i in range(args.clients)]
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    first_responses.sort()
+    small_latencies.sort()
+
+    def percentile(values, p):
+        return values[min(len(values) - 1, int(len(values) * p))] * 1000 if values else float("nan")
+
+    return {
+        "failed": sum(isinstance(result, BaseException) for result in results),
+        "throughput": len(latencies) / elapsed,
+        "p50": percentile(latencies, 0.5),
+        "p99": percentile(latencies, 0.99),
+        "small_p99": percentile(small_latencies, 0.99),
+        "first_p50": percentile(first_responses, 0.5),
+        "first_max": percentile(first_responses, 1.0),
+        "elapsed": elapsed,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="RPC Server benchmark")
+    parser.add_argument("--clients", type=int, default=200, help="同時に接続するクライアント数")
+    parser.add_argument("--requests", type=int, default=20, help="クライアントごとのリクエスト数")
+    parser.add_argument("--modes", nargs="+", choices=RPCServer.MODES, default=list(RPCServer.MODES))
+    parser.add_argument("--backlog", type=int, default=None, help="既定はsingleで1、asyncioで1024")
+    parser.add_argument("--timeout", type=float, default=60.0, help="クライアントごとの制限時間（秒）")
+    parser.add_argument("--framing", choices=["newline", "length"], default="newline")
+    parser.add_argument("--pipeline", type=int, default=1, help="1接続あたり応答を待たずに送るリクエスト数")
+    parser.add_argument("--workers", type=int, nargs="+", default=[0], help="asyncioモードのスレッド数（複数指定で比較）")
+    parser.add_argument("--sort-size", type=int, default=0, help="10件に1件、この長さの配列のsortを送る")
+    args = parser.parse_args()
+
+    runs = [(mode, workers) for mode in args.modes for workers in (args.workers if mode == "asyncio" else [0])]
+    for mode, workers in runs:
+        port = free_port()
+        backlog = args.backlog or (1024 if mode == "asyncio" else 1)
+        server = multiprocessing.Process(target=run_server, args=(mode, port, backlog, args.framing, workers),
+                                         daemon=True)
+        server.start()
+        for _ in range(100):
+            try:
+                socket.create_connection(("127.0.0.1", port)).close()
+                break
+            except OSError:
+                time.sleep(0.05)
+        result = asyncio.run(run_clients(port, args))
+        server.terminate()
+        label = f"{mode} workers {workers}" if mode == "asyncio" else mode
+        print(f"{label:18} clients {args.clients} x {args.requests} requests pipeline {args.pipeline}  "
+              f"failed {result['failed']}  {result['throughput']:.0f} req/s  "
+              f"latency p50 {result['p50']:.2f}ms p99 {result['p99']:.2f}ms (small p99 {result['small_p99']:.2f}ms)  "
+              f"first response p50 {result['first_p50']:.0f}ms max {result['first_max']:.0f}ms  "
+              f"total {result['elapsed']:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,13 @@
+import argparse
+import asyncio
 import socket
 import json
 import math
-from typing import Any, Dict, List, Tuple
+import struct
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+
+MAX_FRAME_SIZE = 16 * 1024 * 1024  # 1メッセージの上限（超えたら接続を切る）
 
 class RPCMethod:
     def __init__(self, name: str, handler: callable, param_types: List[type]):
@@ -78,45 +84,219 @@ class RPCHandler:
         return a - b
 
 class SocketServer:
-    def __init__(self, host: str = 'localhost', port: int = 10000):
+    def __init__(self, host: str = 'localhost', port: int = 10000, backlog: int = 1):
         self.host = host
         self.port = port
+        self.backlog = backlog
         self.socket = None
 
     def create_socket(self):
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.socket.bind((self.host, self.port))
-        self.socket.listen(1)
+        self.socket.listen(self.backlog)
 
     def accept_connection(self) -> Tuple[socket.socket, Tuple[str, int]]:
         return self.socket.accept()
 
+class FramingError(Exception):
+    pass
+
+class RawFramer:
+    # 区切りなし: 1回の受信を1リクエストとみなす（従来の動作、大きなリクエストや連続したリクエストは壊れる）
+    def feed(self, data: bytes) -> List[bytes]:
+        return [data]
+
+    def encode(self, payload: bytes) -> bytes:
+        return payload
+
+class NewlineFramer:
+    # 改行区切り: 1行に1つのJSON（client.jsの既定）
+    def __init__(self, max_size: int = MAX_FRAME_SIZE):
+        self.buffer = bytearray()
+        self.max_size = max_size
+
+    def feed(self, data: bytes) -> List[bytes]:
+        buffer = self.buffer
+        search = len(buffer)  # 前回までの残りには改行がないので、追加分だけを探す
+        buffer += data
+        frames = []
+        start = 0
+        while True:
+            end = buffer.find(b"\n", search)
+            if end < 0:
+                break
+            line = bytes(buffer[start:end]).strip()
+            if line:
+                frames.append(line)
+            start = search = end + 1
+        del buffer[:start]
+        if len(buffer) > self.max_size:
+            raise FramingError("Frame too large")
+        return frames
+
+    def encode(self, payload: bytes) -> bytes:
+        return payload + b"\n"
+
+class LengthPrefixFramer:
+    # 長さ付き: 4バイトのビッグエンディアンの長さ + JSON
+    HEADER = struct.Struct("!I")
+
+    def __init__(self, max_size: int = MAX_FRAME_SIZE):
+        self.buffer = bytearray()
+        self.max_size = max_size
+
+    def feed(self, data: bytes) -> List[bytes]:
+        buffer = self.buffer
+        buffer += data
+        frames = []
+        start = 0
+        header_size = self.HEADER.size
+        while len(buffer) - start >= header_size:
+            size, = self.HEADER.unpack_from(buffer, start)
+            if size > self.max_size:
+                raise FramingError("Frame too large")
+            end = start + header_size + size
+            if len(buffer) < end:
+                break
+            frames.append(bytes(buffer[start + header_size:end]))
+            start = end
+        del buffer[:start]
+        return frames
+
+    def encode(self, payload: bytes) -> bytes:
+        return self.HEADER.pack(len(payload)) + payload
+
+FRAMERS = {
+    "raw": RawFramer,
+    "newline": NewlineFramer,
+    "length": LengthPrefixFramer,
+}
+
 class RPCServer:
-    def __init__(self, host: str = 'localhost', port: int = 10000):
-        self.socket_server = SocketServer(host, port)
+    # single: 1接続ずつ順に処理（接続中の他のクライアントは待たされる）
+    # asyncio: 1つのイベントループで多数の接続を同時に処理
+    MODES = ("single", "asyncio")
+
+    def __init__(self, host: str = 'localhost', port: int = 10000, mode: str = "single", backlog: int = 1,
+                 framing: str = "newline", workers: int = 0, max_inflight: int = 128):
+        if mode not in self.MODES:
+            raise ValueError(f"Unknown mode: {mode}")
+        if framing not in FRAMERS:
+            raise ValueError(f"Unknown framing: {framing}")
+        self.socket_server = SocketServer(host, port, backlog)
         self.rpc_handler = RPCHandler()
+        self.mode = mode
+        self.framing = framing
+        # asyncioモードでworkers > 0ならハンドラーをスレッドプールで実行し、終わった順に応答する
+        # （1接続あたり同時にmax_inflight件まで、0なら受信順にイベントループ上で実行）
+        self.workers = workers
+        self.max_inflight = max_inflight
+        self.executor: Optional[ThreadPoolExecutor] = None
 
     def start(self):
+        if self.mode == "asyncio":
+            asyncio.run(self.serve_async())
+        else:
+            self.serve_single()
+
+    def process(self, data: bytes) -> bytes:
+        try:
+            request = json.loads(data)
+        except ValueError as e:
+            response = self.rpc_handler._create_error_response(None, f"Parse error: {e}")
+        else:
+            if isinstance(request, dict):
+                response = self.rpc_handler.handle_request(request)
+            else:
+                response = self.rpc_handler._create_error_response(None, "Invalid request")
+        return json.dumps(response).encode()
+
+    def serve_single(self):
         self.socket_server.create_socket()
         print(f"RPC Server listening on {self.socket_server.host}:{self.socket_server.port}")
         
         while True:
             connection, client_address = self.socket_server.accept_connection()
+            framer = FRAMERS[self.framing]()
             try:
                 while True:
-                    data = connection.recv(4096)
+                    data = connection.recv(65536)
                     if not data:
                         break
 
-                    request = json.loads(data.decode())
-                    response = self.rpc_handler.handle_request(request)
-                    connection.sendall(json.dumps(response).encode())
+                    for frame in framer.feed(data):
+                        connection.sendall(framer.encode(self.process(frame)))
             except Exception as e:
                 print(f"Error handling client {client_address}: {e}")
             finally:
                 connection.close()
 
-if __name__ == "__main__":
-    server = RPCServer()
+    async def serve_async(self):
+        if self.workers > 0:
+            self.executor = ThreadPoolExecutor(self.workers)
+        server = await asyncio.start_server(self.handle_connection, self.socket_server.host,
+                                            self.socket_server.port, backlog=self.socket_server.backlog)
+        print(f"RPC Server (asyncio) listening on {self.socket_server.host}:{self.socket_server.port}")
+        async with server:
+            await server.serve_forever()
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        client_address = writer.get_extra_info("peername")
+        framer = FRAMERS[self.framing]()
+        inflight = asyncio.Semaphore(self.max_inflight)
+        tasks = set()
+        try:
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    break
+
+                for frame in framer.feed(data):
+                    if self.executor is None:
+                        writer.write(framer.encode(self.process(frame)))
+                        continue
+                    # 実行中の件数が上限なら、どれかが終わるまで次のリクエストを読まない
+                    await inflight.acquire()
+                    task = asyncio.create_task(self.dispatch(frame, framer, writer, inflight))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+                await writer.drain()
+            # 受け取ったリクエストにはすべて応答してから閉じる
+            if tasks:
+                await asyncio.gather(*tasks)
+                await writer.drain()
+        except Exception as e:
+            print(f"Error handling client {client_address}: {e}")
+        finally:
+            for task in tasks:
+                task.cancel()
+            writer.close()
+
+    async def dispatch(self, frame: bytes, framer, writer: asyncio.StreamWriter, inflight: asyncio.Semaphore):
+        try:
+            response = await asyncio.get_running_loop().run_in_executor(self.executor, self.process, frame)
+            if not writer.is_closing():
+                writer.write(framer.encode(response))
+        finally:
+            inflight.release()
+
+def main():
+    parser = argparse.ArgumentParser(description="RPC Server")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=10000)
+    parser.add_argument("--mode", choices=RPCServer.MODES, default="single",
+                        help="asyncio: 多数の接続を同時に処理")
+    parser.add_argument("--backlog", type=int, default=None,
+                        help="listenのキュー長（既定はsingleで1、asyncioで1024）")
+    parser.add_argument("--framing", choices=FRAMERS.keys(), default="newline",
+                        help="newline: 改行区切り、length: 4バイトの長さ付き、raw: 区切りなし（従来の動作）")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="asyncioモードでハンドラーを実行するスレッド数（応答は終わった順、0で受信順）")
+    parser.add_argument("--max-inflight", type=int, default=128, help="1接続あたり同時に実行するリクエスト数")
+    args = parser.parse_args()
+    backlog = args.backlog or (1024 if args.mode == "asyncio" else 1)
+    server = RPCServer(args.host, args.port, args.mode, backlog, args.framing, args.workers, args.max_inflight)
     server.start()
-    
\ No newline at end of file
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+"""
+UDPServer.handle_messageの1メッセージあたりのメモリ確保量と処理時間を計測するベンチマーク
+
+変更前と同じ処理（ヘッダーのデコード、f-stringでの再エンコード、配信先リストの作成）と、
+memoryviewで解析してキャッシュ済みのユーザー名プレフィックスを使う現在の処理を比較します。
+送信は行わず、配信先の計算までを計測します。
+確保量は1メッセージの処理中のピークのバイト数（tracemalloc）と、確保したメモリブロック数で表示します。
+ブロック数は配信の時点で確保されているもの（解析・配信先リストなどの一時的な確保、
+処理前と配信時のtracemallocのスナップショットの差）と、処理後も残るもの
+（ループ前後のsys.getallocatedblocks()の差をメッセージ数で割った値）です。
+
+実行例:
+    python alloc_bench.py --members 1000 --messages 20000
+"""
+
+import argparse
+import gc
+import os
+import sys
+import time
+import tracemalloc
+import uuid
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'chat-server'))
+
+from models import ClientInfo
+from tcp_server import TCPServer
+from udp_server import UDPServer
+
+
+class NullRelayServer(UDPServer):
+    """送信せずに配信先だけを受け取るUDPServer"""
+
+    def relay(self, data, addresses, skip=None):
+        self.last = (data, addresses, skip)
+        if tracemalloc.is_tracing():
+            self.relay_snapshot = tracemalloc.take_snapshot()
+
+
+def legacy_handle_message(server, data, address):
+    """変更前のhandle_messageと同じ処理"""
+    room_id_size = data[0]
+    token_size = data[1]
+    room_id = data[2:2+room_id_size].decode('utf-8')
+    token = data[2+room_id_size:2+room_id_size+token_size].decode('utf-8')
+    message = data[2+room_id_size+token_size:].decode('utf-8')
+    if room_id not in server.tcp_server.rooms:
+        return
+    room = server.tcp_server.rooms[room_id]
+    if token not in room.clients:
+        return
+    client_info = room.clients[token]
+    client_info.update_message_time()
+    client_info.address = address
+    sender = client_info.username
+    room.add_message(sender, message)
+    formatted_message = f"{sender}: {message}".encode('utf-8')
+    server.relay(formatted_message, [c.address for t, c in room.clients.items() if t != token])
+
+
+def measure(server, handler, data, address, messages):
+    for _ in range(100):
+        handler(data, address)
+
+    start = time.perf_counter()
+    for _ in range(messages):
+        handler(data, address)
+    elapsed = (time.perf_counter() - start) / messages
+
+    # 1メッセージの処理中に一時的に確保されたメモリのピークを計測
+    tracemalloc.start()
+    peaks = []
+    for _ in range(500):
+        base = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        handler(data, address)
+        peaks.append(tracemalloc.get_traced_memory()[1] - base)
+
+    # 配信の時点で確保されているブロック数（スナップショット自体の確保は除く）
+    ignore = [tracemalloc.Filter(False, tracemalloc.__file__)]
+    in_flight = []
+    for _ in range(100):
+        server.last = None  # 前回の配信先リストを解放してから数える
+        before = tracemalloc.take_snapshot().filter_traces(ignore)
+        handler(data, address)
+        after = server.relay_snapshot.filter_traces(ignore)
+        server.relay_snapshot = None
+        in_flight.append(sum(stat.count_diff for stat in after.compare_to(before, 'filename')))
+    tracemalloc.stop()
+
+    # 処理後も残るブロック数（履歴に残るメッセージや作り直したキャッシュなど）
+    gc.collect()
+    gc.disable()
+    try:
+        before = sys.getallocatedblocks()
+        for _ in range(messages):
+            handler(data, address)
+        retained = (sys.getallocatedblocks() - before) / messages
+    finally:
+        gc.enable()
+    return elapsed, sorted(peaks)[len(peaks) // 2], sorted(in_flight)[len(in_flight) // 2], retained
+
+
+def main():
+    parser = argparse.ArgumentParser(description="UDPメッセージ処理のメモリ確保ベンチマーク")
+    parser.add_argument('--members', type=int, default=1000)
+    parser.add_argument('--messages', type=int, default=20000)
+    args = parser.parse_args()
+
+    # 履歴は件数上限に達した状態で計測する（保持分の増加を除くため）
+    tcp_server = TCPServer(history_messages=100)
+    server = NullRelayServer(tcp_server)
+    room = tcp_server.new_room('bench')
+    tcp_server.register_room(room)
+    sender_token = str(uuid.uuid4())
+    address = ('127.0.0.1', 40000)
+    tcp_server.register_client(room, sender_token, ClientInfo(address, datetime.now(), 'sender'),
+                               is_host=True)
+    for i in range(args.members - 1):
+        tcp_server.register_client(room, str(uuid.uuid4()),
+                                   ClientInfo(('127.0.0.1', 20000 + i), datetime.now(), f'member{i}'))
+
+    packet = (bytes([len(room.id_bytes), len(sender_token)]) + room.id_bytes
+              + sender_token.encode('utf-8') + 'こんにちは、ベンチマークです'.encode('utf-8'))
+
+    # 現在の処理は受信バッファのmemoryviewをそのまま受け取る
+    buffer = bytearray(4096)
+    buffer[:len(packet)] = packet
+    view = memoryview(buffer)[:len(packet)]
+
+    cases = (
+        ('legacy', lambda data, addr: legacy_handle_message(server, data, addr), packet),
+        ('current', server.handle_message, view),
+    )
+    print(f"room members: {args.members}")
+    print(f"{'':>8} {'time (us)':>10} {'peak alloc per message (B)':>27} "
+          f"{'blocks at relay':>16} {'blocks retained':>16}")
+    for name, handler, data in cases:
+        elapsed, peak, in_flight, retained = measure(server, handler, data, address, args.messages)
+        print(f"{name:>8} {elapsed * 1e6:>10.2f} {peak:>27} {in_flight:>16} {retained:>16.2f}")
+
+
+if __name__ == "__main__":
+    main()
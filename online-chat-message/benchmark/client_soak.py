@@ -0,0 +1,150 @@
+"""
+多数のクライアントを1プロセスで動かしたときのコストを計測するベンチマーク
+
+N人のクライアント（--room-size人ずつのルーム）を、受信スレッドと1秒タイムアウトの
+UDPClient（threadエンジン）と、1つのイベントループ上のChatSession（asyncioエンジン）で動かし、
+無通信時のCPU使用率・スレッド数・メモリ使用量、短時間の送受信での到達数、終了にかかる時間を比較します。
+各エンジンは別プロセスで計測し、サーバーは子プロセスで起動します。
+
+実行例:
+    python client_soak.py --clients 1000 --room-size 10 --idle 10
+"""
+
+import argparse
+import asyncio
+import multiprocessing
+import os
+import sys
+import threading
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..', 'chat-client'))
+
+from async_client import AsyncTCPClient, open_session
+from tcrp_load import free_tcp_port
+from udp_client import UDPClient
+from udp_load import free_udp_port, server_process
+
+
+def process_stats():
+    """(スレッド数, RSS MB)"""
+    with open('/proc/self/status') as f:
+        fields = dict(line.split(':', 1) for line in f)
+    return int(fields['Threads']), int(fields['VmRSS'].split()[0]) / 1024
+
+
+async def provision(tcp_port, clients, room_size):
+    """ルームを作成して参加（[(ルームID, トークン)]）"""
+    tcp_client = AsyncTCPClient('127.0.0.1', tcp_port)
+    members = []
+    for index in range(0, clients, room_size):
+        created = await tcp_client.create_room(f'soak-{index}', f'soak{index}')
+        members.append((created['roomId'], created['token']))
+        joins = [tcp_client.join_room(created['roomId'], f'soak{index + j}')
+                 for j in range(1, min(room_size, clients - index))]
+        members.extend((created['roomId'], joined['token']) for joined in await asyncio.gather(*joins))
+    return members
+
+
+def measure_idle(seconds):
+    cpu = time.process_time()
+    time.sleep(seconds)
+    return (time.process_time() - cpu) / seconds * 100
+
+
+def run_thread(ports, args, results):
+    members = asyncio.run(provision(ports[0], args.clients, args.room_size))
+    received = [0]
+    running = [True]
+    clients = []
+
+    def receive(client):
+        while running[0]:
+            if client.receive_message():
+                received[0] += 1
+
+    threads = []
+    for room_id, token in members:
+        client = UDPClient('127.0.0.1', ports[1])
+        client.send_message(room_id, token, 'hello')  # UDPアドレスを登録
+        clients.append((client, room_id, token))
+        thread = threading.Thread(target=receive, args=(client,), daemon=True)
+        thread.start()
+        threads.append(thread)
+    time.sleep(1)
+    received[0] = 0
+    idle_cpu = measure_idle(args.idle)
+    thread_count, rss = process_stats()
+    for client, room_id, token in clients:
+        client.send_message(room_id, token, 'ping')
+        time.sleep(args.spread / len(clients))  # サーバーの受信バッファがあふれないよう間隔をあける
+    time.sleep(1)
+    started = time.perf_counter()
+    running[0] = False
+    for thread in threads:
+        thread.join()
+    shutdown = time.perf_counter() - started
+    for client, _, _ in clients:
+        client.close()
+    results.put(('thread', idle_cpu, thread_count, rss, received[0], shutdown))
+
+
+def run_asyncio(ports, args, results):
+    async def main():
+        members = await provision(ports[0], args.clients, args.room_size)
+        received = [0]
+
+        def on_message(message):
+            received[0] += 1
+
+        sessions = []
+        for room_id, token in members:
+            session = await open_session('127.0.0.1', ports[1], room_id, token, on_message)
+            session.send('hello')  # UDPアドレスを登録
+            sessions.append(session)
+        await asyncio.sleep(1)
+        received[0] = 0
+        idle_cpu = await asyncio.get_running_loop().run_in_executor(None, measure_idle, args.idle)
+        thread_count, rss = process_stats()
+        for session in sessions:
+            session.send('ping')
+            await asyncio.sleep(args.spread / len(sessions))
+        await asyncio.sleep(1)
+        started = time.perf_counter()
+        for session in sessions:
+            session.close()
+        await asyncio.sleep(0)
+        return idle_cpu, thread_count, rss, received[0], time.perf_counter() - started
+
+    results.put(('asyncio',) + asyncio.run(main()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="クライアントの多重起動ベンチマーク")
+    parser.add_argument('--clients', type=int, default=1000)
+    parser.add_argument('--room-size', type=int, default=10)
+    parser.add_argument('--spread', type=float, default=1.0, help='全員が1件ずつ送信するのにかける秒数')
+    parser.add_argument('--idle', type=float, default=10.0, help='無通信時のCPU使用率を計測する秒数')
+    args = parser.parse_args()
+
+    expected = sum(min(args.room_size, args.clients - i) * (min(args.room_size, args.clients - i) - 1)
+                   for i in range(0, args.clients, args.room_size))
+    for target in (run_thread, run_asyncio):
+        ports = (free_tcp_port(), free_udp_port(), free_tcp_port())
+        ready = multiprocessing.Event()
+        server = multiprocessing.Process(target=server_process, args=ports + ('thread', 0, ready), daemon=True)
+        server.start()
+        ready.wait()
+        results = multiprocessing.Queue()
+        process = multiprocessing.Process(target=target, args=(ports, args, results))
+        process.start()
+        engine, idle_cpu, threads, rss, received, shutdown = results.get()
+        process.join()
+        server.terminate()
+        print(f"{engine:8} idle cpu {idle_cpu:5.1f}%  threads {threads:5}  rss {rss:6.1f}MB  "
+              f"received {received}/{expected}  shutdown {shutdown * 1000:.0f}ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+"""
+まとめ送信（ルームごとのバッチ配信）の効果を計測するベンチマーク
+
+N人のルームで、数人が同時に発言するバースト（--burst件を--spread秒の間に送信）を繰り返し、
+まとめ送信の有無で送信データグラム数・送信システムコール数・サーバーのCPU時間を比較します。
+メンバーのアドレスはこのプロセス内の受信ソケットで、バーストごとに受信してメッセージ数を確認します。
+
+実行例:
+    python coalesce_bench.py --members 1000 --bursts 50 --burst 20 --delay-ms 5
+    python coalesce_bench.py --no-batch-send  # sendmmsgを使わない場合
+"""
+
+import argparse
+import math
+import os
+import socket
+import sys
+import time
+import uuid
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'chat-server'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'common'))
+
+import server_log
+from models import ClientInfo
+from tcp_server import TCPServer
+from udp_batch import split_datagram
+from udp_server import UDPServer
+
+
+class CountingUDPServer(UDPServer):
+    """送信したデータグラム数とシステムコール数を数えるUDPServer"""
+
+    def relay(self, data, addresses, skip=None):
+        count = len(addresses) - (skip is not None)
+        self.datagrams += count
+        if self.multi_sender and len(addresses) > 2:
+            self.syscalls += math.ceil(len(addresses) / self.multi_sender.MAX_BATCH)
+        else:
+            self.syscalls += count
+        super().relay(data, addresses, skip)
+
+
+def open_sinks(count):
+    sinks = []
+    for _ in range(count):
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1024 * 1024)
+        s.bind(('127.0.0.1', 0))
+        s.setblocking(False)
+        sinks.append(s)
+    return sinks
+
+
+def drain(sinks):
+    """受信ソケットに届いたメッセージ数（まとめ送信は中身の件数）"""
+    messages = 0
+    for s in sinks:
+        while True:
+            try:
+                data = s.recv(4096)
+            except BlockingIOError:
+                break
+            messages += len(split_datagram(data))
+    return messages
+
+
+def run(delay_ms, sinks, args):
+    tcp_server = TCPServer(max_coalesce_delay=1.0)
+    server = CountingUDPServer(tcp_server, host='127.0.0.1', port=0, batch_send=not args.no_batch_send)
+    server.datagrams = server.syscalls = 0
+    server.socket = server.create_socket()
+    server.socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4 * 1024 * 1024)
+    server.coalescer.start()
+
+    room = tcp_server.new_room('bench', coalesce_delay=delay_ms / 1000)
+    tcp_server.register_room(room)
+    tokens = []
+    for i, sink in enumerate(sinks):
+        token = str(uuid.uuid4())
+        tcp_server.register_client(room, token, ClientInfo(sink.getsockname(), datetime.now(), f'user{i}'),
+                                   is_host=(i == 0))
+        tokens.append(token)
+    header = lambda token: bytes([len(room.id_bytes), len(token)]) + room.id_bytes + token.encode('utf-8')
+    packets = [header(token) + 'メッセージです'.encode('utf-8') for token in tokens[:args.burst]]
+
+    expected = delivered = 0
+    server_cpu = 0.0
+    interval = args.spread / args.burst
+    for _ in range(args.bursts):
+        cpu = time.process_time()
+        for i, packet in enumerate(packets):
+            server.dispatch(packet, sinks[i].getsockname())
+            time.sleep(interval)
+        time.sleep(delay_ms / 1000 + 0.01)  # まとめ送信のバッチが送られるのを待つ
+        server_cpu += time.process_time() - cpu
+        expected += len(packets) * (len(sinks) - 1)
+        delivered += drain(sinks)
+
+    server.coalescer.stop()
+    server.socket.close()
+    metrics = tcp_server.metrics
+    return {
+        'datagrams': server.datagrams,
+        'syscalls': server.syscalls,
+        'server_cpu': server_cpu,
+        'delivered': delivered,
+        'expected': expected,
+        'batches': metrics.udp_batches.value,
+        'coalesced': metrics.udp_coalesced.value,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="まとめ送信のベンチマーク")
+    parser.add_argument('--members', type=int, default=1000)
+    parser.add_argument('--bursts', type=int, default=50)
+    parser.add_argument('--burst', type=int, default=20, help='1回のバーストで送るメッセージ数')
+    parser.add_argument('--spread', type=float, default=0.004, help='1回のバーストを送る秒数')
+    parser.add_argument('--no-batch-send', action='store_true', help='sendmmsgを使わずに1件ずつ送信')
+    parser.add_argument('--delay-ms', type=float, default=5.0, help='まとめ送信の待ち時間（ミリ秒）')
+    args = parser.parse_args()
+    server_log.configure('ERROR')
+
+    sinks = open_sinks(args.members)
+    messages = args.bursts * args.burst
+    for label, delay_ms in (('per message', 0.0), (f'coalesce {args.delay_ms:g}ms', args.delay_ms)):
+        result = run(delay_ms, sinks, args)
+        print(label)
+        print(f"  datagrams: {result['datagrams']} ({result['datagrams'] / messages:.1f}/message)  "
+              f"send syscalls: {result['syscalls']}")
+        print(f"  server cpu: {result['server_cpu']:.2f}s ({result['server_cpu'] / messages * 1e3:.2f} ms/message)")
+        print(f"  delivered: {result['delivered']}/{result['expected']}  "
+              f"batches: {result['batches']} ({result['coalesced']} messages)")
+    for sink in sinks:
+        sink.close()
+
+
+if __name__ == "__main__":
+    main()
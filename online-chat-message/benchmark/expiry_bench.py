@@ -0,0 +1,76 @@
+"""
+非アクティブクライアント削除のコストを比較するベンチマーク
+
+従来の全ルーム・全クライアント走査と、タイミングホイール（ExpiryIndex）で
+1回の確認に掛かる時間を比較します。
+
+実行例:
+    python expiry_bench.py --clients 100000 --rooms 1000
+"""
+
+import argparse
+import os
+import sys
+import time
+import uuid
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'chat-server'))
+
+from models import ClientInfo
+from tcp_server import TCPServer
+
+
+def legacy_scan(rooms):
+    """変更前のremove_inactive_clientsの走査部分"""
+    current_time = datetime.now()
+    timeout = timedelta(minutes=3)
+    inactive = []
+    for room_id, room in list(rooms.items()):
+        for token, client in room.clients.items():
+            if current_time - client.last_message_time > timeout:
+                inactive.append((room_id, token))
+    return inactive
+
+
+def main():
+    parser = argparse.ArgumentParser(description="非アクティブクライアント削除ベンチマーク")
+    parser.add_argument('--clients', type=int, default=100000)
+    parser.add_argument('--rooms', type=int, default=1000)
+    parser.add_argument('--timeout', type=float, default=180.0)
+    args = parser.parse_args()
+
+    tcp_server = TCPServer(client_timeout=args.timeout)
+    rooms = []
+    for i in range(args.rooms):
+        room = tcp_server.new_room(f'room{i}')
+        tcp_server.register_room(room)
+        rooms.append(room)
+
+    # 登録時刻をタイムアウト期間全体に均等に散らす
+    now = time.monotonic()
+    for i in range(args.clients):
+        client_info = ClientInfo(('127.0.0.1', 20000 + i % 40000), datetime.now(), f'u{i}')
+        client_info.last_active = now - args.timeout * i / args.clients
+        tcp_server.register_client(rooms[i % args.rooms], str(uuid.uuid4()), client_info)
+
+    start = time.perf_counter()
+    legacy_scan(tcp_server.rooms)
+    legacy_time = time.perf_counter() - start
+
+    # 1秒ごとの確認を60回分シミュレートする
+    ticks = 60
+    expired = 0
+    start = time.perf_counter()
+    for tick in range(1, ticks + 1):
+        expired += len(tcp_server.expiry.expired(tcp_server.rooms, now + tick))
+    wheel_time = (time.perf_counter() - start) / ticks
+
+    print(f"{args.clients:,} clients in {args.rooms:,} rooms")
+    print(f"full scan:    {legacy_time * 1000:.2f} ms per check")
+    print(f"timing wheel: {wheel_time * 1000:.3f} ms per 1s tick "
+          f"({expired / ticks:.0f} expired per tick)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+"""
+混雑したルームが小さなルームの配信遅延に与える影響を計測するベンチマーク
+
+1000人のルームに大量のメッセージを流しながら、2人のルームで往復する
+メッセージの遅延を計測します。--room-workersを変えて比較してください。
+
+実行例:
+    python isolation_bench.py --room-workers 0
+    python isolation_bench.py --room-workers 4
+"""
+
+import argparse
+import multiprocessing
+import os
+import socket
+import sys
+import threading
+import time
+import uuid
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'chat-server'))
+
+from models import ClientInfo
+from tcp_server import TCPServer
+from server import UDP_ENGINES
+from relay_bench import free_udp_port, sink_process, sender_process
+
+
+def packet_header(room, token):
+    room_id_bytes = room.id.encode('utf-8')
+    token_bytes = token.encode('utf-8')
+    return bytes([len(room_id_bytes), len(token_bytes)]) + room_id_bytes + token_bytes
+
+
+def probe(server_port, header, receiver, duration, interval):
+    """小さなルームでメッセージを送り、届くまでの遅延を計測"""
+    sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    receiver.settimeout(1)
+    latencies = []
+    lost = 0
+    end = time.perf_counter() + duration
+    while time.perf_counter() < end:
+        sender.sendto(header + repr(time.perf_counter()).encode('utf-8'), ('127.0.0.1', server_port))
+        try:
+            data = receiver.recv(4096)
+            sent_at = float(data.split(b': ', 1)[1])
+            latencies.append(time.perf_counter() - sent_at)
+        except socket.timeout:
+            lost += 1
+        time.sleep(interval)
+    sender.close()
+    return latencies, lost
+
+
+def percentile(values, p):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p))] if ordered else 0.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ルーム間の遅延分離ベンチマーク")
+    parser.add_argument('--engine', choices=UDP_ENGINES.keys(), default='thread')
+    parser.add_argument('--room-workers', type=int, default=4)
+    parser.add_argument('--members', type=int, default=1000, help='混雑ルームのメンバー数')
+    parser.add_argument('--rate', type=float, default=200, help='混雑ルームの毎秒メッセージ数')
+    parser.add_argument('--duration', type=float, default=5.0)
+    args = parser.parse_args()
+
+    ports_queue = multiprocessing.Queue()
+    result_queue = multiprocessing.Queue()
+    sink = multiprocessing.Process(target=sink_process, args=(8, ports_queue, result_queue, 2.0))
+    sink.start()
+    sink_ports = ports_queue.get()
+
+    tcp_server = TCPServer()
+    hot_room = tcp_server.new_room('hot')
+    tcp_server.register_room(hot_room)
+    hot_token = str(uuid.uuid4())
+    tcp_server.register_client(hot_room, hot_token,
+                               ClientInfo(('127.0.0.1', 0), datetime.now(), 'hot'), is_host=True)
+    for i in range(args.members - 1):
+        address = ('127.0.0.1', sink_ports[i % len(sink_ports)])
+        tcp_server.register_client(hot_room, str(uuid.uuid4()),
+                                   ClientInfo(address, datetime.now(), f'member{i}'))
+
+    small_room = tcp_server.new_room('small')
+    tcp_server.register_room(small_room)
+    probe_token = str(uuid.uuid4())
+    receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    receiver.bind(('127.0.0.1', 0))
+    tcp_server.register_client(small_room, probe_token,
+                               ClientInfo(('127.0.0.1', 0), datetime.now(), 'probe'), is_host=True)
+    tcp_server.register_client(small_room, str(uuid.uuid4()),
+                               ClientInfo(receiver.getsockname(), datetime.now(), 'listener'))
+
+    port = free_udp_port()
+    udp_server = UDP_ENGINES[args.engine](tcp_server, host='127.0.0.1', port=port,
+                                          room_workers=args.room_workers)
+    threading.Thread(target=udp_server.start, daemon=True).start()
+    time.sleep(0.5)
+
+    start_event = multiprocessing.Event()
+    messages = int(args.rate * (args.duration + 1))
+    hot_sender = multiprocessing.Process(
+        target=sender_process,
+        args=(port, hot_room.id, hot_token, messages, args.rate, start_event))
+    hot_sender.start()
+    start_event.set()
+    time.sleep(0.5)
+
+    latencies, lost = probe(port, packet_header(small_room, probe_token), receiver,
+                            args.duration, 0.02)
+    hot_sender.join()
+    result_queue.get()
+    sink.join()
+
+    print(f"engine={args.engine} room_workers={args.room_workers} "
+          f"hot room: {args.members} members @ {args.rate:.0f} msg/s")
+    print(f"small room latency: p50 {percentile(latencies, 0.5) * 1000:.2f}ms "
+          f"p99 {percentile(latencies, 0.99) * 1000:.2f}ms "
+          f"max {max(latencies, default=0) * 1000:.2f}ms lost {lost}")
+    if udp_server.scheduler:
+        for room_id, stats in udp_server.scheduler.stats().items():
+            name = tcp_server.rooms[room_id].name
+            print(f"  [{name}] count={stats['count']} dropped={stats['dropped']} "
+                  f"p50={stats['p50'] * 1000:.2f}ms p99={stats['p99'] * 1000:.2f}ms")
+    udp_server.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+"""
+メッセージログの書き込みと読み出し（全件再生・最新N件・時刻指定）を計測するベンチマーク
+
+実行例:
+    python log_bench.py --messages 1000000
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'chat-server'))
+
+from history import MessageRecord
+from message_log import MessageLog
+
+
+def main():
+    parser = argparse.ArgumentParser(description="メッセージログベンチマーク")
+    parser.add_argument('--messages', type=int, default=1000000)
+    parser.add_argument('--segment-bytes', type=int, default=16 * 1024 * 1024)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as log_dir:
+        log = MessageLog(log_dir, segment_bytes=args.segment_bytes)
+        base = 1_700_000_000_000
+        start = time.perf_counter()
+        for i in range(args.messages):
+            log.append('bench', MessageRecord(f'user{i % 50}', b'hello, this is a chat message', base + i))
+        enqueued = time.perf_counter() - start
+        log.flush()
+        written = time.perf_counter() - start
+        size = sum(os.path.getsize(os.path.join(log_dir, 'bench', name))
+                   for name in os.listdir(os.path.join(log_dir, 'bench')))
+        print(f"append: {args.messages:,} messages enqueued in {enqueued:.2f}s, "
+              f"on disk after {written:.2f}s ({size / 1e6:.1f} MB)")
+
+        reader = log.reader('bench')
+        start = time.perf_counter()
+        count = sum(1 for _ in reader.replay())
+        print(f"replay: {count:,} messages in {time.perf_counter() - start:.3f}s")
+
+        start = time.perf_counter()
+        latest = reader.latest(100)
+        print(f"latest(100): {len(latest)} messages in {(time.perf_counter() - start) * 1000:.2f}ms")
+
+        start = time.perf_counter()
+        recent = reader.since(base + args.messages - 1000)
+        print(f"since(T): {len(recent)} messages in {(time.perf_counter() - start) * 1000:.2f}ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+"""
+計測（metrics）がUDPメッセージ処理に与えるコストを計測するベンチマーク
+
+カウンター・ヒストグラムの1回あたりの記録時間（ロック付きカウンターとの比較を含む）と、
+送信を行わないUDPServerのメッセージ処理時間を計測の有無で比較します。
+最後に複数スレッドから記録した件数が失われていないことを確認します。
+
+実行例:
+    python metrics_bench.py --members 10 --messages 100000
+"""
+
+import argparse
+import os
+import sys
+import threading
+import time
+import uuid
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'chat-server'))
+
+from metrics import LATENCY_BOUNDS_NS, Counter, Histogram
+from models import ClientInfo
+from tcp_server import TCPServer
+from udp_server import UDPServer
+
+
+class NullRelayServer(UDPServer):
+    """送信せずに配信先だけを受け取るUDPServer"""
+
+    def relay(self, data, addresses, skip=None):
+        self.last = (data, addresses, skip)
+
+
+class NullMetric:
+    """何も記録しないカウンター・ヒストグラム（計測なしの比較用）"""
+
+    def inc(self, amount=1):
+        pass
+
+    def record(self, value):
+        pass
+
+
+class NullMetrics:
+    def __init__(self, metrics):
+        for name, value in vars(metrics).items():
+            if isinstance(value, dict):
+                value = dict.fromkeys(value, NullMetric())
+            setattr(self, name, NullMetric() if isinstance(value, (Counter, Histogram)) else value)
+
+
+class LockedCounter:
+    """ロックで保護するカウンター（比較用）"""
+
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+
+def per_call(label, func, repeat):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    elapsed = (time.perf_counter() - started) / repeat
+    print(f"{label:<32} {elapsed * 1e9:8.0f} ns")
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="計測のオーバーヘッドのベンチマーク")
+    parser.add_argument('--members', type=int, default=10)
+    parser.add_argument('--messages', type=int, default=100000)
+    parser.add_argument('--threads', type=int, default=4)
+    args = parser.parse_args()
+
+    counter = Counter('bench', 'bench')
+    locked = LockedCounter()
+    histogram = Histogram('bench_seconds', 'bench', LATENCY_BOUNDS_NS, scale=1e-9)
+    per_call('Counter.inc', counter.inc, args.messages)
+    per_call('locked counter', locked.inc, args.messages)
+    per_call('Histogram.record', lambda: histogram.record(12345), args.messages)
+    per_call('perf_counter_ns', time.perf_counter_ns, args.messages)
+
+    tcp_server = TCPServer(history_messages=100)
+    server = NullRelayServer(tcp_server)
+    room = tcp_server.new_room('bench')
+    tcp_server.register_room(room)
+    token = str(uuid.uuid4())
+    address = ('127.0.0.1', 40000)
+    tcp_server.register_client(room, token, ClientInfo(address, datetime.now(), 'sender'), is_host=True)
+    for i in range(args.members - 1):
+        tcp_server.register_client(room, str(uuid.uuid4()),
+                                   ClientInfo(('127.0.0.1', 20000 + i), datetime.now(), f'member{i}'))
+    packet = (bytes([len(room.id_bytes), len(token)]) + room.id_bytes + token.encode('utf-8')
+              + 'こんにちは'.encode('utf-8'))
+
+    metrics = server.metrics
+    for _ in range(1000):
+        server.dispatch(packet, address)
+    server.metrics = NullMetrics(metrics)
+    off = per_call('dispatch (no metrics)', lambda: server.dispatch(packet, address),
+                   args.messages)
+    server.metrics = metrics
+    on = per_call('dispatch (metrics)', lambda: server.dispatch(packet, address),
+                  args.messages)
+    print(f"  overhead: {(on - off) * 1e9:.0f} ns/message ({(on / off - 1) * 100:.1f}%)")
+
+    # 複数スレッドから同時に記録しても件数が失われないことの確認
+    received = metrics.udp_received.value
+    threads = [threading.Thread(target=lambda: [server.dispatch(packet, address)
+                                                for _ in range(args.messages // args.threads)])
+               for _ in range(args.threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    expected = received + args.messages // args.threads * args.threads
+    assert metrics.udp_received.value == expected, (metrics.udp_received.value, expected)
+    latency = metrics.udp_relay_latency
+    print(f"relay latency p50={latency.percentile(0.5) / 1e3:.1f}us "
+          f"p99={latency.percentile(0.99) / 1e3:.1f}us "
+          f"count={latency.snapshot()[2]}")
+    started = time.perf_counter()
+    text = metrics.render()
+    print(f"render: {len(text.splitlines())} lines in {(time.perf_counter() - started) * 1e3:.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+"""
+sendmmsg/recvmmsgによるバッチ送受信と通常ループを比較するマイクロベンチマーク
+
+実行例:
+    python mmsg_bench.py --members 10 100 1000 --rounds 200
+"""
+
+import argparse
+import os
+import socket
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'chat-server'))
+
+from mmsg import MMSG_AVAILABLE, MultiReceiver, MultiSender, MSG_DONTWAIT
+
+
+def make_socket(rcvbuf=None):
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    if rcvbuf:
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+    s.bind(('127.0.0.1', 0))
+    return s
+
+
+def bench_send(members, rounds, sinks):
+    """1回のファンアウトに掛かる時間を比較"""
+    sender = make_socket()
+    addresses = [sinks[i % len(sinks)].getsockname() for i in range(members)]
+    data = b"sender: " + b"x" * 64
+
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for address in addresses:
+            sender.sendto(data, address)
+    loop_time = (time.perf_counter() - start) / rounds
+
+    multi = MultiSender()
+    start = time.perf_counter()
+    for _ in range(rounds):
+        multi.sendto_many(sender, data, addresses)
+    batch_time = (time.perf_counter() - start) / rounds
+    sender.close()
+    return loop_time, batch_time
+
+
+def drain(sock):
+    sock.setblocking(False)
+    try:
+        while True:
+            sock.recv(4096)
+    except BlockingIOError:
+        pass
+    sock.setblocking(True)
+
+
+def bench_recv(packets):
+    """受信ソケットに溜まったパケットを読み切る時間を比較"""
+    receiver = make_socket(rcvbuf=16 * 1024 * 1024)
+    sender = make_socket()
+    address = receiver.getsockname()
+    data = b"\x08\x24" + b"x" * 100
+
+    def fill():
+        for _ in range(packets):
+            sender.sendto(data, address)
+
+    fill()
+    receiver.setblocking(False)
+    start = time.perf_counter()
+    received = 0
+    try:
+        while True:
+            receiver.recvfrom(4096)
+            received += 1
+    except BlockingIOError:
+        pass
+    loop_time = (time.perf_counter() - start) / max(received, 1)
+
+    fill()
+    multi = MultiReceiver()
+    start = time.perf_counter()
+    batch_received = 0
+    while True:
+        batch = multi.recv(receiver, MSG_DONTWAIT)
+        if not batch:
+            break
+        batch_received += len(batch)
+    batch_time = (time.perf_counter() - start) / max(batch_received, 1)
+    receiver.close()
+    sender.close()
+    return loop_time, batch_time, received, batch_received
+
+
+def main():
+    parser = argparse.ArgumentParser(description="sendmmsg/recvmmsgベンチマーク")
+    parser.add_argument('--members', type=int, nargs='+', default=[10, 100, 1000])
+    parser.add_argument('--rounds', type=int, default=200)
+    parser.add_argument('--packets', type=int, default=20000)
+    args = parser.parse_args()
+
+    if not MMSG_AVAILABLE:
+        print("sendmmsg/recvmmsgはこの環境では利用できません")
+        return
+
+    sinks = [make_socket() for _ in range(8)]
+    print(f"{'members':>8} {'loop (us)':>12} {'sendmmsg (us)':>14} {'speedup':>8}")
+    for members in args.members:
+        loop_time, batch_time = bench_send(members, args.rounds, sinks)
+        for sink in sinks:
+            drain(sink)
+        print(f"{members:>8} {loop_time * 1e6:>12.1f} {batch_time * 1e6:>14.1f} {loop_time / batch_time:>7.2f}x")
+
+    loop_time, batch_time, received, batch_received = bench_recv(args.packets)
+    print(f"\nrecv per packet: recvfrom {loop_time * 1e6:.2f}us ({received} pkts), "
+          f"recvmmsg {batch_time * 1e6:.2f}us ({batch_received} pkts), "
+          f"speedup {loop_time / batch_time:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+"""
+MultiSessionClientで多数のルームに参加するベンチマーク
+
+ホスト役のクライアントがN個のルームを作成し、ブリッジ役のクライアントが全ルームに
+1つのUDPソケットで参加します。ホスト役が各ルームに--messages件ずつ（全体で毎秒--rate件）送り、
+ブリッジ役はルームごとのasync forで受信します。参加にかかった時間・メモリ使用量・
+到達数・配信遅延・送受信中のCPU使用率を表示します。サーバーは子プロセスで起動します。
+
+実行例:
+    python multi_session_bench.py --rooms 10000 --messages 3 --rate 2000
+"""
+
+import argparse
+import asyncio
+import multiprocessing
+import os
+import sys
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..', 'chat-client'))
+
+from client_soak import process_stats
+from multi_session import MultiSessionClient
+from tcrp_load import free_tcp_port
+from udp_load import free_udp_port, server_process
+
+
+async def consume(session, latencies, received):
+    async for message in session:
+        body = message[message.find(': ') + 2:]
+        latencies.append(time.monotonic() - float(body))
+        received[0] += 1
+
+
+async def run(ports, args):
+    host = MultiSessionClient('127.0.0.1', ports[0], ports[1])
+    bridge = MultiSessionClient('127.0.0.1', ports[0], ports[1])
+    await host.start()
+    await bridge.start()
+
+    started = time.perf_counter()
+    rooms = await asyncio.gather(*(host.create_room(f'room-{i}', 'host') for i in range(args.rooms)))
+    created = time.perf_counter() - started
+    started = time.perf_counter()
+    sessions = await bridge.join_rooms([room.room_id for room in rooms], 'bridge')
+    joined = time.perf_counter() - started
+    failed = sum(isinstance(session, Exception) for session in sessions)
+    await asyncio.sleep(1)  # 参加時の生存通知がサーバーに届くのを待つ
+
+    latencies = []
+    received = [0]
+    consumers = [asyncio.create_task(consume(session, latencies, received))
+                 for session in sessions if not isinstance(session, Exception)]
+    _, rss = process_stats()
+    cpu = time.process_time()
+    started = time.perf_counter()
+    interval = 1.0 / args.rate
+    next_send = time.perf_counter()
+    for _ in range(args.messages):
+        for room in rooms:
+            room.send(repr(time.monotonic()))
+            next_send += interval
+            delay = next_send - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+    await asyncio.sleep(args.drain)
+    elapsed = time.perf_counter() - started
+    cpu = time.process_time() - cpu
+    dropped = sum(session.dropped for session in bridge.sessions.values())
+    unknown = bridge.unknown
+    host.close()
+    bridge.close()
+    await asyncio.gather(*consumers)
+
+    latencies.sort()
+    expected = args.messages * len(consumers)
+    print(f"rooms {args.rooms}  create {created:.2f}s  join {joined:.2f}s ({failed} failed)  "
+          f"rss {rss:.1f}MB (host + bridge)")
+    print(f"received {received[0]}/{expected} ({received[0] / max(expected, 1):.2%})  "
+          f"dropped {dropped}  unknown {unknown}")
+    if latencies:
+        print(f"latency p50 {latencies[len(latencies) // 2] * 1000:.2f}ms  "
+              f"p99 {latencies[int(len(latencies) * 0.99)] * 1000:.2f}ms  "
+              f"client cpu {cpu / elapsed * 100:.1f}% ({cpu / max(received[0], 1) * 1e6:.0f}us/message)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="マルチセッションクライアントのベンチマーク")
+    parser.add_argument('--rooms', type=int, default=10000)
+    parser.add_argument('--messages', type=int, default=3, help='ルームごとの送信件数')
+    parser.add_argument('--rate', type=float, default=2000, help='全体で毎秒の送信件数')
+    parser.add_argument('--drain', type=float, default=1.0, help='送信終了後に受信を待つ秒数')
+    args = parser.parse_args()
+
+    ports = (free_tcp_port(), free_udp_port(), free_tcp_port())
+    ready = multiprocessing.Event()
+    server = multiprocessing.Process(target=server_process, args=ports + ('thread', 0, ready), daemon=True)
+    server.start()
+    ready.wait()
+    try:
+        asyncio.run(run(ports, args))
+    finally:
+        server.terminate()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+"""
+流量制限（トークンバケット）の効果を計測するベンチマーク
+
+ルームAの1クライアントが4096バイトのデータグラムを連続して送り続ける間に、
+ルームBのクライアントが通常の頻度で送信する状況を、流量制限の有無で比較します。
+送信は行わず（配信先の計算まで）、サーバー側の処理時間・ルームAの履歴使用量・
+破棄した件数を表示します。
+
+実行例:
+    python rate_limit_bench.py --flood 50000 --members 100
+"""
+
+import argparse
+import os
+import sys
+import time
+import uuid
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'chat-server'))
+
+import server_log
+from models import ClientInfo
+from rate_limit import RateLimits
+from tcp_server import TCPServer
+from udp_server import UDPServer
+
+
+class CountingRelayServer(UDPServer):
+    """送信せずにルームごとの配信件数を数えるUDPServer"""
+
+    def relay(self, data, addresses, skip=None):
+        self.relayed[data[:6]] = self.relayed.get(data[:6], 0) + 1
+
+
+def setup_room(tcp_server, name, members):
+    room = tcp_server.new_room(name)
+    tcp_server.register_room(room)
+    tokens = []
+    for i in range(members):
+        token = str(uuid.uuid4())
+        tcp_server.register_client(room, token, ClientInfo(('127.0.0.1', 20000 + i), datetime.now(),
+                                                           f'{name}-{i}'), is_host=(i == 0))
+        tokens.append(token)
+    return room, tokens
+
+
+def packet(room, token, body):
+    return bytes([len(room.id_bytes), len(token)]) + room.id_bytes + token.encode('utf-8') + body
+
+
+def run(rate_limits, args):
+    tcp_server = TCPServer(history_messages=1000)
+    server = CountingRelayServer(tcp_server, rate_limits=rate_limits)
+    server.relayed = {}
+    room_a, tokens_a = setup_room(tcp_server, 'flood', args.members)
+    room_b, tokens_b = setup_room(tcp_server, 'quiet', args.members)
+    flood = packet(room_a, tokens_a[1], b'x' * (4096 - 2 - len(room_a.id_bytes) - 36))
+    normal = [packet(room_b, token, 'こんにちは'.encode('utf-8')) for token in tokens_b]
+    attacker = ('10.0.0.1', 40000)
+
+    quiet_time = 0.0
+    started = time.perf_counter()
+    for i in range(args.flood):
+        server.dispatch(flood, attacker)
+        if i % args.ratio == 0:
+            # ルームBは送信者を順に替え、1クライアントあたりは低頻度
+            index = (i // args.ratio) % len(normal)
+            t = time.perf_counter()
+            server.dispatch(normal[index], ('10.0.1.%d' % (index % 250), 50000 + index))
+            quiet_time += time.perf_counter() - t
+    elapsed = time.perf_counter() - started
+    dropped = {reason: counter.value for reason, counter in tcp_server.metrics.udp_dropped.items()
+               if counter.value}
+    quiet_sent = args.flood // args.ratio + (args.flood % args.ratio > 0)
+    return {
+        'elapsed': elapsed,
+        'per_packet_us': elapsed / (args.flood + quiet_sent) * 1e6,
+        'flood_relayed': server.relayed.get(b'flood-', 0),
+        'quiet_relayed': server.relayed.get(b'quiet-', 0),
+        'quiet_sent': quiet_sent,
+        'quiet_us': quiet_time / quiet_sent * 1e6,
+        'history_bytes': room_a.history_stats()['bytes'],
+        'dropped': dropped,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="流量制限のベンチマーク")
+    parser.add_argument('--flood', type=int, default=50000, help='ルームAから送る4096バイトのパケット数')
+    parser.add_argument('--ratio', type=int, default=100, help='ルームAのN件ごとにルームBから1件送信')
+    parser.add_argument('--members', type=int, default=100)
+    args = parser.parse_args()
+    server_log.configure('ERROR')  # 破棄のたびの警告は出力しない
+
+    cases = (
+        ('no limits', None),
+        ('token 20/s, address 100/s, room 500/s',
+         RateLimits(token=(20, 40), address=(100, 200), room=(500, 1000))),
+    )
+    for label, limits in cases:
+        result = run(limits, args)
+        print(f"{label}")
+        print(f"  total {result['elapsed']:.2f}s ({result['per_packet_us']:.2f} us/packet)")
+        print(f"  flood relayed: {result['flood_relayed']}/{args.flood}  "
+              f"quiet relayed: {result['quiet_relayed']}/{result['quiet_sent']} "
+              f"({result['quiet_us']:.2f} us/message)")
+        print(f"  flood room history: {result['history_bytes']} bytes  dropped: {result['dropped']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+"""
+配信先アドレスリストの作成コストを比較するベンチマーク
+
+従来のメッセージごとのリスト内包表記と、Roomがキャッシュする
+配信先タプル（Room.recipient_list）を、ルームの人数ごとに比較します。
+
+実行例:
+    python recipients_bench.py --members 10 100 1000 10000
+"""
+
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+import uuid
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'chat-server'))
+
+from models import ClientInfo, Room
+
+
+def legacy_addresses(room, except_token):
+    """変更前のRoom.get_client_addressesと同じ処理"""
+    return [client.address for token, client in room.clients.items() if token != except_token]
+
+
+def cached_addresses(room, except_token):
+    addresses, positions = room.recipient_list()
+    return addresses, positions.get(except_token)
+
+
+def measure(func, room, token, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        func(room, token)
+    elapsed = (time.perf_counter() - start) / rounds
+
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = func(room, token)
+    allocated = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    del result
+    return elapsed, allocated
+
+
+def main():
+    parser = argparse.ArgumentParser(description="配信先リスト作成ベンチマーク")
+    parser.add_argument('--members', type=int, nargs='+', default=[10, 100, 1000, 10000])
+    parser.add_argument('--rounds', type=int, default=2000)
+    args = parser.parse_args()
+
+    print(f"{'members':>8} {'legacy (us)':>12} {'cached (us)':>12} {'speedup':>8} "
+          f"{'legacy alloc':>13} {'cached alloc':>13}")
+    for members in args.members:
+        room = Room('bench')
+        tokens = [str(uuid.uuid4()) for _ in range(members)]
+        for i, token in enumerate(tokens):
+            room.add_client(token, ClientInfo(('127.0.0.1', 20000 + i), datetime.now(), f'u{i}'))
+        sender = tokens[members // 2]
+        room.recipient_list()  # キャッシュを作成
+
+        rounds = max(10, args.rounds * 100 // members)
+        legacy_time, legacy_alloc = measure(legacy_addresses, room, sender, rounds)
+        cached_time, cached_alloc = measure(cached_addresses, room, sender, rounds)
+        print(f"{members:>8} {legacy_time * 1e6:>12.2f} {cached_time * 1e6:>12.3f} "
+              f"{legacy_time / cached_time:>7.0f}x {legacy_alloc:>12}B {cached_alloc:>12}B")
+
+
+if __name__ == "__main__":
+    main()
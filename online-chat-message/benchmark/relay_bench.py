@@ -0,0 +1,160 @@
+"""
+UDPリレーのファンアウト性能を計測するベンチマーク
+
+1つのルームにN人のメンバーを登録し、送信プロセスからメッセージを流して
+受信プロセスに届いたパケット数から毎秒の配信パケット数を算出します。
+
+実行例:
+    python relay_bench.py --engine thread --members 1000 --messages 200
+    python relay_bench.py --engine asyncio --members 1000 --messages 200
+"""
+
+import argparse
+import multiprocessing
+import os
+import selectors
+import socket
+import sys
+import threading
+import time
+import uuid
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'chat-server'))
+
+from models import ClientInfo
+from tcp_server import TCPServer
+from server import UDP_ENGINES
+
+
+def free_udp_port():
+    """空いているUDPポートを取得"""
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def sink_process(sink_count, ports_queue, result_queue, idle_timeout):
+    """ファンアウトされたパケットを受信して数える"""
+    selector = selectors.DefaultSelector()
+    sockets = []
+    for _ in range(sink_count):
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 8 * 1024 * 1024)
+        s.bind(('127.0.0.1', 0))
+        s.setblocking(False)
+        selector.register(s, selectors.EVENT_READ)
+        sockets.append(s)
+    ports_queue.put([s.getsockname()[1] for s in sockets])
+
+    received = 0
+    first = last = None
+    while True:
+        events = selector.select(idle_timeout if first else 30)
+        if not events:
+            break
+        for key, _ in events:
+            sock = key.fileobj
+            while True:
+                try:
+                    sock.recv(4096)
+                except BlockingIOError:
+                    break
+                received += 1
+                last = time.perf_counter()
+                if first is None:
+                    first = last
+    result_queue.put((received, first, last))
+
+
+def sender_process(server_port, room_id, token, messages, rate, start_event):
+    """チャットメッセージを送信するクライアント"""
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    room_id_bytes = room_id.encode('utf-8')
+    token_bytes = token.encode('utf-8')
+    header = bytes([len(room_id_bytes), len(token_bytes)]) + room_id_bytes + token_bytes
+    start_event.wait()
+    interval = 1.0 / rate if rate else 0
+    next_send = time.perf_counter()
+    for i in range(messages):
+        s.sendto(header + f"message {i}".encode('utf-8'), ('127.0.0.1', server_port))
+        if interval:
+            next_send += interval
+            delay = next_send - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+    s.close()
+
+
+def run(engine, members, messages, rate, sinks, idle_timeout=2.0):
+    """ベンチマークを1回実行して結果を返す"""
+    ports_queue = multiprocessing.Queue()
+    result_queue = multiprocessing.Queue()
+    sink = multiprocessing.Process(target=sink_process,
+                                   args=(sinks, ports_queue, result_queue, idle_timeout))
+    sink.start()
+    sink_ports = ports_queue.get()
+
+    # TCRPを経由せずにルームとメンバーを直接登録する
+    tcp_server = TCPServer()
+    room = tcp_server.new_room('bench')
+    tcp_server.register_room(room)
+    sender_token = str(uuid.uuid4())
+    tcp_server.register_client(room, sender_token,
+                               ClientInfo(('127.0.0.1', 0), datetime.now(), 'sender'), is_host=True)
+    for i in range(members - 1):
+        address = ('127.0.0.1', sink_ports[i % len(sink_ports)])
+        tcp_server.register_client(room, str(uuid.uuid4()),
+                                   ClientInfo(address, datetime.now(), f'member{i}'))
+
+    port = free_udp_port()
+    udp_server = UDP_ENGINES[engine](tcp_server, host='127.0.0.1', port=port)
+    server_thread = threading.Thread(target=udp_server.start, daemon=True)
+    server_thread.start()
+    time.sleep(0.5)
+
+    start_event = multiprocessing.Event()
+    sender = multiprocessing.Process(target=sender_process,
+                                     args=(port, room.id, sender_token, messages, rate, start_event))
+    sender.start()
+    started = time.perf_counter()
+    start_event.set()
+    sender.join()
+
+    received, first, last = result_queue.get()
+    sink.join()
+    udp_server.stop()
+
+    expected = messages * (members - 1)
+    elapsed = (last - first) if received > 1 else 0
+    return {
+        'engine': engine,
+        'members': members,
+        'messages': messages,
+        'expected': expected,
+        'received': received,
+        'loss': 1 - received / expected if expected else 0,
+        'elapsed': elapsed,
+        'packets_per_sec': received / elapsed if elapsed else 0,
+        'send_duration': (last or started) - started,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="UDPリレーベンチマーク")
+    parser.add_argument('--engine', choices=UDP_ENGINES.keys(), default='thread')
+    parser.add_argument('--members', type=int, default=1000, help='ルームのメンバー数')
+    parser.add_argument('--messages', type=int, default=200, help='送信メッセージ数')
+    parser.add_argument('--rate', type=float, default=10, help='毎秒の送信メッセージ数 (0で無制限)')
+    parser.add_argument('--sinks', type=int, default=8, help='受信ソケット数')
+    args = parser.parse_args()
+
+    result = run(args.engine, args.members, args.messages, args.rate, args.sinks)
+    print(f"engine={result['engine']} members={result['members']} messages={result['messages']}")
+    print(f"received {result['received']}/{result['expected']} packets "
+          f"(loss {result['loss']:.2%}) in {result['elapsed']:.2f}s")
+    print(f"fan-out throughput: {result['packets_per_sec']:,.0f} packets/s")
+
+
+if __name__ == "__main__":
+    main()
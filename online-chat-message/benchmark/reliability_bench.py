@@ -0,0 +1,168 @@
+"""
+信頼性モード（連番と再送要求）の効果とコストを計測するベンチマーク
+
+サーバーの送信時に宛先ごとに一定の確率でパケットを捨て（再送も同じ確率で失われる）、
+UDPClientで受信するN人のルームに1人（--sendersで複数人が順番に）がメッセージを送り続けます。
+損失率ごとに信頼性モードの有無で、届いたメッセージの割合・配信遅延（初回到着）・
+再送要求と再送の件数・サーバーのメッセージ処理時間を比較します。
+欠番を待たずに後続を渡す（先頭ブロッキングがない）ため、p50の遅延は損失があっても変わりません。
+送信者も受信し、自分のメッセージが届いた件数（self、0であるべき）と、損失なしで欠番が出ないことを確認します。
+
+実行例:
+    python reliability_bench.py --members 20 --messages 2000 --rate 500 --loss 0 0.01 0.05
+    python reliability_bench.py --members 2 --senders 2 --messages 200 --loss 0
+"""
+
+import argparse
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'chat-server'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'chat-client'))
+
+import server_log
+from metrics import Histogram
+from models import ClientInfo
+from relay_bench import free_udp_port
+from tcp_server import TCPServer
+from udp_client import UDPClient
+from udp_server import UDPServer
+
+
+class LossyUDPServer(UDPServer):
+    """宛先ごとにloss の確率で送信を捨てるUDPServer"""
+
+    def relay(self, data, addresses, skip=None):
+        chance = self.chance
+        kept = [address for index, address in enumerate(addresses)
+                if index != skip and chance() >= self.loss]
+        if kept:
+            super().relay(data, kept)
+
+
+def receiver(client, stop, latency, received, senders, own=None):
+    """受信したメッセージの初回到着遅延を記録（Histogramはスレッドごとに記録される）
+
+    ownはこのクライアントが送信者の場合の番号で、自分のメッセージはreceivedではなくself_echoesに数えます。
+    """
+    client.self_echoes = 0
+    while not stop.is_set():
+        message = client.receive_message()
+        if message is None:
+            continue
+        body = message[message.find(': ') + 2:]
+        if body[:1] != 'M':
+            continue
+        sent, _, index = body[1:].partition(':')
+        if own is not None and int(index) % senders == own:
+            client.self_echoes += 1
+            continue
+        latency.record(time.monotonic_ns() - int(sent))
+        received.add(int(index))
+
+
+def run(loss, reliable, args):
+    tcp_server = TCPServer(history_messages=100)
+    port = free_udp_port()
+    server = LossyUDPServer(tcp_server, host='127.0.0.1', port=port)
+    server.loss = loss
+    server.chance = random.Random(1).random
+    threading.Thread(target=server.start, daemon=True).start()
+    time.sleep(0.2)
+
+    room = tcp_server.new_room('bench', reliable=reliable)
+    tcp_server.register_room(room)
+    members = []
+    for i in range(args.members + args.senders):
+        token = str(uuid.uuid4())
+        tcp_server.register_client(room, token, ClientInfo(('127.0.0.1', 1), datetime.now(), f'user{i}'),
+                                   is_host=(i == 0))
+        client = UDPClient('127.0.0.1', port)
+        client.send_message(room.id, token, 'hello')  # UDPアドレスを登録
+        members.append((client, token))
+    time.sleep(0.2)
+
+    stop = threading.Event()
+    latency = Histogram('latency', 'latency', [])
+    results = []
+    threads = []
+    for i, (client, _) in enumerate(members):
+        received = set()
+        results.append(received)
+        own = i if i < args.senders else None
+        thread = threading.Thread(target=receiver, args=(client, stop, latency, received, args.senders, own),
+                                  daemon=True)
+        thread.start()
+        threads.append(thread)
+
+    interval = 1.0 / args.rate
+    next_send = time.perf_counter()
+    for i in range(args.messages):
+        sender, token = members[i % args.senders]
+        sender.send_message(room.id, token, f'M{time.monotonic_ns()}:{i}')
+        next_send += interval
+        delay = next_send - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+    time.sleep(args.drain)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    server.stop()
+
+    # 送信者は自分以外のメッセージ、それ以外は全メッセージを受信するはず
+    expected = args.messages * (args.members + args.senders) - args.messages
+    received = 0
+    stats = {'gaps': 0, 'nacks': 0, 'recovered': 0, 'lost': 0, 'duplicates': 0, 'self': 0}
+    for result, (client, _) in zip(results, members):
+        received += len(result)
+        for key in stats:
+            if key != 'self':
+                stats[key] += client.tracker.stats[key]
+        stats['self'] += client.self_echoes
+        client.close()
+    _, total, count, _ = tcp_server.metrics.udp_relay_latency.snapshot()
+    metrics = tcp_server.metrics
+    return {
+        'delivered': received / expected,
+        'p50_ms': latency.percentile(0.5) / 1e6,
+        'p99_ms': latency.percentile(0.99) / 1e6,
+        'server_us': total / max(count, 1) / 1e3,
+        'server_nacks': metrics.udp_nacks.value,
+        'retransmitted': metrics.udp_retransmitted.value,
+        'client': stats,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="信頼性モードのベンチマーク")
+    parser.add_argument('--members', type=int, default=20, help='受信だけするクライアント数')
+    parser.add_argument('--senders', type=int, default=1, help='順番にメッセージを送るクライアント数（送信者も受信する）')
+    parser.add_argument('--messages', type=int, default=2000)
+    parser.add_argument('--rate', type=float, default=500, help='毎秒の送信件数')
+    parser.add_argument('--loss', type=float, nargs='+', default=[0.0, 0.01, 0.05], help='損失率')
+    parser.add_argument('--drain', type=float, default=1.5, help='送信終了後に受信を待つ秒数')
+    args = parser.parse_args()
+    server_log.configure('ERROR')
+
+    for loss in args.loss:
+        for reliable in (False, True):
+            result = run(loss, reliable, args)
+            label = f"loss {loss:.0%} {'reliable' if reliable else 'plain':8}"
+            print(f"{label} delivered {result['delivered']:.4%}  "
+                  f"latency p50 {result['p50_ms']:.2f}ms p99 {result['p99_ms']:.2f}ms  "
+                  f"server {result['server_us']:.1f} us/message  "
+                  f"nacks {result['server_nacks']} retransmitted {result['retransmitted']}  "
+                  f"client {result['client']}")
+            if reliable and loss == 0:
+                # 損失がなければ欠番も自分のメッセージの受信も起きない
+                assert result['client']['gaps'] == 0 and result['client']['self'] == 0, result['client']
+
+
+if __name__ == "__main__":
+    main()
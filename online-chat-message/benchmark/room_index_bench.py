@@ -0,0 +1,102 @@
+"""
+ルーム一覧・検索（TCRPのOP_LIST）の応答時間を計測するベンチマーク
+
+N個のルームを登録し、RoomIndexによる1ページ分の取得と、
+self.roomsを全件走査して並べ替える方法を比較します。
+メッセージごとに呼ばれる活動の記録（touch）の時間も表示します。
+
+実行例:
+    python room_index_bench.py --rooms 100000
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+import uuid
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'chat-server'))
+
+from models import ClientInfo
+from tcp_server import TCPServer
+
+WORDS = ['game', 'music', 'python', 'news', 'anime', 'travel', 'cooking', 'sports', 'study', 'random']
+
+
+def scan_query(rooms, sort, prefix, limit):
+    """全ルームを走査する一覧（比較用）"""
+    if sort == 'name':
+        matched = [room for room in rooms.values() if room.name.casefold().startswith(prefix)]
+        matched.sort(key=lambda room: (room.name.casefold(), room.id))
+    else:
+        matched = sorted(rooms.values(), key=lambda room: (-len(room.clients), room.id))
+    return matched[:limit]
+
+
+def measure(label, func, repeat):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    elapsed = (time.perf_counter() - started) / repeat
+    print(f"{label:<40} {elapsed * 1e6:10.1f} us")
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ルーム一覧・検索のベンチマーク")
+    parser.add_argument('--rooms', type=int, default=100000)
+    parser.add_argument('--limit', type=int, default=20)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    server = TCPServer()
+    started = time.perf_counter()
+    for i in range(args.rooms):
+        room = server.new_room(f'{random.choice(WORDS)}-{i}')
+        server.register_room(room)
+        for j in range(random.randint(1, 5)):
+            client_info = ClientInfo(address=('127.0.0.1', 20000 + j),
+                                     last_message_time=datetime.now(), username=f'user{j}')
+            server.register_client(room, str(uuid.uuid4()), client_info, is_host=(j == 0))
+    print(f"registered {args.rooms} rooms in {time.perf_counter() - started:.2f}s")
+
+    index = server.room_index
+    cases = [('name', ''), ('name', 'pyth'), ('members', '')]
+    for sort, prefix in cases:
+        label = f"sort={sort} prefix='{prefix}'"
+        indexed = measure(f"index  {label}", lambda: index.query(sort, prefix, args.limit), args.repeat)
+        scanned = measure(f"scan   {label}", lambda: scan_query(server.rooms, sort, prefix, args.limit),
+                          max(1, args.repeat // 10))
+        print(f"  speedup: {scanned / indexed:,.0f}x")
+
+    # 最後のページまでカーソルでたどれることの確認（全ページをたどる時間も表示）
+    for sort in ('members', 'activity'):
+        started = time.perf_counter()
+        cursor, seen = None, set()
+        while True:
+            page = index.query(sort, '', 100, cursor)
+            seen.update(room['roomId'] for room in page['rooms'])
+            cursor = page['nextCursor']
+            if cursor is None:
+                break
+        assert len(seen) == len(index), len(seen)
+        print(f"index  sort={sort} all {len(index)} rooms in pages of 100: "
+              f"{(time.perf_counter() - started) * 1000:.1f}ms")
+    measure("index  sort=activity (first page)", lambda: index.query('activity', '', args.limit), args.repeat)
+
+    # メッセージごとに呼ばれる活動の記録（ルーム数によらず一定のはず）
+    rooms = list(server.rooms.values())
+    touches = [(random.choice(rooms), i * index.activity_resolution) for i in range(1, 100001)]
+    started = time.perf_counter()
+    for room, now in touches:
+        index.touch(room, time.monotonic() + now)
+    print(f"index  touch ({len(touches)} rooms updated) "
+          f"{(time.perf_counter() - started) / len(touches) * 1e6:10.2f} us")
+    measure("index  sort=activity (first page after touches)",
+            lambda: index.query('activity', '', args.limit), args.repeat)
+
+
+if __name__ == "__main__":
+    main()
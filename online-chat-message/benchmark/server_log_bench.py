@@ -0,0 +1,81 @@
+"""
+診断ログがハンドラースレッドに与えるコストを計測するベンチマーク
+
+変更前のTCPServerが1リクエストごとに行っていたprint（ヘッダーの16進ダンプを含む）と、
+キュー経由の構造化ログ（server_log）で、リクエスト処理スレッド側の時間を比較します。
+出力先はどちらもファイルで、構造化ログは書き出しスレッドがキューを空にするまでの時間も表示します。
+
+実行例:
+    python server_log_bench.py --requests 50000
+"""
+
+import argparse
+import contextlib
+import logging
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'chat-server'))
+
+import server_log
+
+HEADER = bytes([8, 2, 0]) + b'36' + bytes(27)
+ADDRESS = ('127.0.0.1', 50000)
+
+
+def legacy_request(i):
+    """変更前の参加リクエスト1件分の出力"""
+    header = HEADER
+    print(f"受信ヘッダー: room_size={header[0]}, op={header[1]}, state={header[2]}, payload_size=36")
+    print(f"データ受信サイズ: {header[0] + 36} バイト")
+    print(f"受信データ: room_name=abcd1234, payload_length=36")
+    print(f"Debug - 受信ヘッダー: {', '.join([f'{b:02x}' for b in header[:8]])}")
+    print(f"ルーム参加レスポンス送信: room_id=abcd1234, payload_size=80")
+    print(f"Debug - レスポンスヘッダー: {', '.join([f'{b:02x}' for b in header[:8]])}")
+    print(f"Client joined room: abcd1234 - user{i}")
+
+
+log = server_log.get_logger('bench')
+
+
+def logged_request(i):
+    """現在の参加リクエスト1件分のログ"""
+    header = HEADER
+    if log.enabled(logging.DEBUG):
+        log.debug('request', address=ADDRESS, op=header[1], state=header[2], room='abcd1234',
+                  payload_size=36, request_id=None, header=header[:8].hex(' '))
+    log.info('client_joined', room_id='abcd1234', username=f'user{i}')
+
+
+def measure(label, func, requests):
+    started = time.perf_counter()
+    for i in range(requests):
+        func(i)
+    elapsed = time.perf_counter() - started
+    print(f"{label:<28} {elapsed / requests * 1e6:8.2f} us/request", end='', file=sys.__stdout__)
+    return started
+
+
+def main():
+    parser = argparse.ArgumentParser(description="診断ログのベンチマーク")
+    parser.add_argument('--requests', type=int, default=50000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        with open(os.path.join(tmp, 'legacy.out'), 'w') as out, contextlib.redirect_stdout(out):
+            measure('print (before)', legacy_request, args.requests)
+        print(file=sys.__stdout__)
+
+        for level in ('WARNING', 'INFO', 'DEBUG'):
+            with open(os.path.join(tmp, f'{level}.out'), 'w') as out:
+                server_log.configure(level, stream=out, queue_size=args.requests * 2)
+                started = measure(f'server_log level={level}', logged_request, args.requests)
+                server_log.shutdown()
+                drained = time.perf_counter() - started
+                print(f"  (including drain: {drained / args.requests * 1e6:.2f} us/request)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+"""
+TCRPヘッダー・ボディのエンコード・デコード性能を計測するベンチマーク
+
+変更前と同じ1バイトずつのループによる処理と、structを使う共通コーデック（common/tcrp.py）を比較します。
+両者が同じバイト列を生成・解釈することも確認します。
+
+実行例:
+    python tcrp_codec_bench.py --iterations 200000
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'common'))
+
+from tcrp import OP_CREATE, STATE_RESPONSE, encode_message, unpack_header
+
+
+def legacy_encode(operation, state, room, payload):
+    """変更前のレスポンス組み立て"""
+    header = bytearray(32)
+    header[0] = len(room)
+    header[1] = operation
+    header[2] = state
+    payload_size_str = str(len(payload))
+    for i in range(min(len(payload_size_str), 29)):
+        header[3 + i] = ord(payload_size_str[i])
+    for i in range(len(payload_size_str), 29):
+        header[3 + i] = 0
+    return header + room.encode('utf-8') + payload.encode('utf-8')
+
+
+def legacy_decode(header):
+    """変更前のヘッダー解析"""
+    payload_size_str = ''
+    for b in header[3:32]:
+        if b == 0:
+            break
+        if 48 <= b <= 57:
+            payload_size_str += chr(b)
+    payload_size = int(payload_size_str) if payload_size_str else 0
+    return header[0], header[1], header[2], payload_size
+
+
+def measure(label, func, args, iterations):
+    started = time.perf_counter()
+    for _ in range(iterations):
+        func(*args)
+    elapsed = time.perf_counter() - started
+    print(f"{label:<28} {elapsed / iterations * 1e9:8.0f} ns/op")
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="TCRPコーデックのベンチマーク")
+    parser.add_argument('--iterations', type=int, default=200000)
+    args = parser.parse_args()
+
+    room = 'general'
+    payload = json.dumps({"token": str(uuid.uuid4()), "roomId": str(uuid.uuid4())})
+    message = bytes(legacy_encode(OP_CREATE, STATE_RESPONSE, room, payload))
+
+    # ワイヤー互換性の確認
+    assert encode_message(OP_CREATE, STATE_RESPONSE, room, payload) == message
+    assert unpack_header(message) == legacy_decode(message)
+
+    encode_args = (OP_CREATE, STATE_RESPONSE, room, payload)
+    legacy = measure('encode (legacy loops)', legacy_encode, encode_args, args.iterations)
+    new = measure('encode (struct)', encode_message, encode_args, args.iterations)
+    print(f"  speedup: {legacy / new:.1f}x")
+
+    legacy = measure('decode (legacy loops)', legacy_decode, (message,), args.iterations)
+    new = measure('decode (struct)', unpack_header, (message,), args.iterations)
+    print(f"  speedup: {legacy / new:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
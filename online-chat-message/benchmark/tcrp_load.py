@@ -0,0 +1,144 @@
+"""
+TCRP（ルーム作成・参加）サーバーの負荷生成ツール
+
+asyncioでN本のTCP接続を同時に張り、ルーム作成・参加リクエストを一斉に送って
+成功数・失敗数と応答時間を計測します。--connectを指定しない場合は
+別プロセスでTCPServerを起動して計測します。
+
+実行例:
+    python tcrp_load.py --concurrency 5000
+    python tcrp_load.py --concurrency 5000 --connect 127.0.0.1:9001
+"""
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import socket
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'chat-server'))
+
+from tcp_server import TCPServer
+from tcrp import (HEADER_SIZE, OP_CREATE, OP_JOIN, STATE_REQUEST, STATE_RESPONSE, encode_message,
+                  unpack_header)
+
+
+def free_tcp_port():
+    """空いているTCPポートを取得"""
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def server_process(port, options, ready):
+    """計測対象のTCPServer（ログ出力は捨てる）"""
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1)
+    os.dup2(devnull, 2)
+    server = TCPServer(host='127.0.0.1', port=port, **options)
+    ready.set()
+    server.start()
+
+
+async def request(host, port, operation, room, payload, timeout):
+    """1件のリクエストを送り、(state, 応答JSONまたはエラー文字列) を返す"""
+    reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+    try:
+        writer.write(encode_message(operation, STATE_REQUEST, room, payload))
+        header = await asyncio.wait_for(reader.readexactly(HEADER_SIZE), timeout)
+        room_size, _, state, size = unpack_header(header)
+        body = await asyncio.wait_for(reader.readexactly(room_size + size), timeout)
+        content = body[room_size:].decode('utf-8')
+        return state, json.loads(content) if state == STATE_RESPONSE else content
+    finally:
+        writer.close()
+
+
+async def run_load(host, port, concurrency, rooms, join_ratio, timeout):
+    # 参加先のルームを先に作成
+    room_ids = []
+    for i in range(rooms):
+        state, result = await request(host, port, OP_CREATE, f'room-{i}', f'host-{i}', timeout)
+        if state != STATE_RESPONSE:
+            raise RuntimeError(f'ルーム作成に失敗: {result}')
+        room_ids.append(result['roomId'])
+
+    latencies = []
+    errors = {}
+    start_event = asyncio.Event()
+
+    async def client(index):
+        if random.random() < join_ratio:
+            operation, room = OP_JOIN, random.choice(room_ids)
+        else:
+            operation, room = OP_CREATE, f'flash-{index}'
+        await start_event.wait()
+        started = time.perf_counter()
+        try:
+            state, result = await request(host, port, operation, room, f'user-{index}', timeout)
+            if state != STATE_RESPONSE:
+                raise RuntimeError(f'error state {state}')
+            latencies.append(time.perf_counter() - started)
+        except Exception as e:
+            name = type(e).__name__
+            errors[name] = errors.get(name, 0) + 1
+
+    tasks = [asyncio.ensure_future(client(i)) for i in range(concurrency)]
+    await asyncio.sleep(0)
+    started = time.perf_counter()
+    start_event.set()
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - started
+    return latencies, errors, elapsed
+
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(len(values) * p))] if values else 0.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="TCRP負荷生成ツール")
+    parser.add_argument('--concurrency', type=int, default=5000, help='同時に送るリクエスト数')
+    parser.add_argument('--rooms', type=int, default=50, help='参加先として事前に作成するルーム数')
+    parser.add_argument('--join-ratio', type=float, default=0.8, help='参加リクエストの割合（残りは作成）')
+    parser.add_argument('--timeout', type=float, default=30.0, help='1リクエストのタイムアウト（秒）')
+    parser.add_argument('--connect', default=None, help='既存サーバーのhost:port（未指定なら起動する）')
+    parser.add_argument('--backlog', type=int, default=1024)
+    parser.add_argument('--threads', type=int, default=64)
+    parser.add_argument('--max-pending', type=int, default=1024)
+    args = parser.parse_args()
+
+    server = None
+    if args.connect:
+        host, port = args.connect.rsplit(':', 1)
+        port = int(port)
+    else:
+        host, port = '127.0.0.1', free_tcp_port()
+        ready = multiprocessing.Event()
+        options = dict(backlog=args.backlog, handler_threads=args.threads, max_pending=args.max_pending)
+        server = multiprocessing.Process(target=server_process, args=(port, options, ready), daemon=True)
+        server.start()
+        ready.wait()
+        time.sleep(0.5)
+
+    try:
+        latencies, errors, elapsed = asyncio.run(
+            run_load(host, port, args.concurrency, args.rooms, args.join_ratio, args.timeout))
+    finally:
+        if server:
+            server.terminate()
+
+    latencies.sort()
+    print(f"requests: {args.concurrency}  ok: {len(latencies)}  failed: {sum(errors.values())} {errors}")
+    print(f"elapsed: {elapsed:.2f}s  ({len(latencies) / elapsed:,.0f} req/s)")
+    print(f"latency p50: {percentile(latencies, 0.5) * 1000:.1f}ms  "
+          f"p99: {percentile(latencies, 0.99) * 1000:.1f}ms  "
+          f"max: {(latencies[-1] if latencies else 0) * 1000:.1f}ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+"""
+TCRPのパイプライン接続（リクエストID拡張）による参加時間の短縮を計測するベンチマーク
+
+多数のルームに参加するボットを想定し、1リクエストごとに接続するTCPClientと、
+1本の接続で参加リクエストを続けて送るPipelinedTCPClientで全ルームへの参加時間を比較します。
+--rtt-msを指定すると、片道rtt/2ミリ秒の遅延を入れる中継プロキシを経由して計測します。
+
+実行例:
+    python tcrp_pipeline_bench.py --rooms 500
+    python tcrp_pipeline_bench.py --rooms 500 --rtt-ms 2
+    python tcrp_pipeline_bench.py --rooms 500 --connect 127.0.0.1:9001
+"""
+
+import argparse
+import asyncio
+import multiprocessing
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'chat-client'))
+
+from tcp_client import PipelinedTCPClient, TCPClient
+from tcrp_load import free_tcp_port, server_process
+
+
+class DelayProxy:
+    """片道delay秒の遅延を加えてTCP接続を中継する（データの順序は保つ）"""
+
+    def __init__(self, target_host, target_port, delay):
+        self.target = (target_host, target_port)
+        self.delay = delay
+        self.port = free_tcp_port()
+        self.ready = threading.Event()
+
+    def start(self):
+        thread = threading.Thread(target=asyncio.run, args=(self.serve(),))
+        thread.daemon = True
+        thread.start()
+        self.ready.wait()
+
+    async def serve(self):
+        server = await asyncio.start_server(self.handle, '127.0.0.1', self.port)
+        self.ready.set()
+        async with server:
+            await server.serve_forever()
+
+    async def handle(self, client_reader, client_writer):
+        server_reader, server_writer = await asyncio.open_connection(*self.target)
+        await asyncio.gather(self.pipe(client_reader, server_writer),
+                             self.pipe(server_reader, client_writer))
+
+    async def pipe(self, reader, writer):
+        loop = asyncio.get_running_loop()
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                loop.call_later(self.delay, writer.close)
+                return
+            loop.call_later(self.delay, writer.write, data)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="TCRPパイプライン接続のベンチマーク")
+    parser.add_argument('--rooms', type=int, default=500, help='ボットが参加するルーム数')
+    parser.add_argument('--rtt-ms', type=float, default=0, help='中継プロキシで加える往復遅延（ミリ秒）')
+    parser.add_argument('--connect', default=None, help='既存サーバーのhost:port（未指定なら起動する）')
+    args = parser.parse_args()
+
+    server = None
+    if args.connect:
+        host, port = args.connect.rsplit(':', 1)
+        port = int(port)
+    else:
+        host, port = '127.0.0.1', free_tcp_port()
+        ready = multiprocessing.Event()
+        server = multiprocessing.Process(target=server_process, args=(port, {}, ready), daemon=True)
+        server.start()
+        ready.wait()
+        time.sleep(0.5)
+
+    if args.rtt_ms:
+        proxy = DelayProxy(host, port, args.rtt_ms / 2000)
+        proxy.start()
+        host, port = '127.0.0.1', proxy.port
+
+    try:
+        one_shot = TCPClient(host, port)
+        room_ids = [one_shot.create_room(f'room-{i}', f'host-{i}')['roomId'] for i in range(args.rooms)]
+
+        started = time.perf_counter()
+        for room_id in room_ids:
+            one_shot.join_room(room_id, 'bot')
+        sequential = time.perf_counter() - started
+
+        client = PipelinedTCPClient(host, port)
+        started = time.perf_counter()
+        results = client.join_rooms(room_ids, 'bot')
+        pipelined = time.perf_counter() - started
+        supported = client.supported
+        client.close()
+    finally:
+        if server:
+            server.terminate()
+
+    failed = sum(1 for result in results if isinstance(result, Exception))
+    print(f"rooms: {args.rooms}  rtt: {args.rtt_ms}ms  pipelining supported by server: {supported}  failed: {failed}")
+    print(f"one connection per join: {sequential:.3f}s  ({sequential / args.rooms * 1e6:.0f} us/join)")
+    print(f"pipelined connection:    {pipelined:.3f}s  ({pipelined / args.rooms * 1e6:.0f} us/join)")
+    print(f"speedup: {sequential / pipelined:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
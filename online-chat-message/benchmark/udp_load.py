@@ -0,0 +1,391 @@
+"""
+多数のUDPチャットクライアントを模擬する負荷試験ツール
+
+TCPClientの作成・参加リクエストでM個のルームにN人ずつ参加させ、各クライアントが
+毎秒rate件のメッセージをasyncioのUDPソケットから送信します。受信したメッセージの
+送信時刻から配信遅延を求め、欠落率・サーバーのCPU使用率とあわせてJSONのレポートに出力します。
+要件（docs/requirement.md）の「毎秒10,000パケットの送信」は、クライアントに届いたパケット数が
+毎秒10,000以上かつ欠落率が --max-loss 以下かどうかで判定します（レポートのtarget.met）。
+
+既定ではサーバーを子プロセスとして起動します。--server で起動済みのサーバーを指定した場合、
+CPU使用率は --server-pid を指定したときだけ計測します。
+
+実行例:
+    python udp_load.py --rooms 500 --clients 10 --rate 2 --output report.json
+    python udp_load.py --rooms 1 --clients 1000 --rate 0.01 --engine asyncio
+    python udp_load.py --rooms 1 --clients 1000 --rate 0.1 --coalesce-ms 5
+    python udp_load.py --server 127.0.0.1:9001:10000 --server-pid 12345
+"""
+
+import argparse
+import asyncio
+import heapq
+import json
+import multiprocessing
+import os
+import platform
+import random
+import socket
+import sys
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..', 'chat-server'))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..', 'chat-client'))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..', 'common'))
+
+from metrics import QUANTILES, Histogram
+from tcp_client import TCPClient
+from tcrp_load import free_tcp_port
+from udp_batch import split_datagram
+from udp_reliable import KIND_ACK, KIND_LOST, parse_sequenced
+
+TARGET_PACKETS_PER_SECOND = 10000
+HELLO = b'H'  # サーバーにUDPアドレスを知らせるための最初のメッセージ
+MEASURE = b'M'  # 計測用メッセージ: M<送信時刻ns>:<送信者番号>:<連番>|<埋め草>
+
+
+def free_udp_port():
+    """空いているUDPポートを取得"""
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def server_process(tcp_port, udp_port, metrics_port, engine, room_workers, ready):
+    """計測対象のサーバー（TCP・UDP・計測値エンドポイント、ログは捨てる）"""
+    import threading
+    import server_log
+    from metrics import serve_metrics
+    from server import UDP_ENGINES
+    from tcp_server import TCPServer
+
+    devnull = open(os.devnull, 'w')
+    os.dup2(devnull.fileno(), 1)
+    os.dup2(devnull.fileno(), 2)
+    server_log.configure('WARNING', stream=devnull)
+    tcp_server = TCPServer(host='127.0.0.1', port=tcp_port)
+    udp_server = UDP_ENGINES[engine](tcp_server, host='127.0.0.1', port=udp_port,
+                                     room_workers=room_workers)
+    serve_metrics(tcp_server.metrics, '127.0.0.1', metrics_port)
+    threading.Thread(target=tcp_server.start, daemon=True).start()
+    threading.Thread(target=udp_server.start, daemon=True).start()
+    time.sleep(0.5)
+    ready.set()
+    threading.Event().wait()
+
+
+def cpu_seconds(pid):
+    """プロセスの累積CPU時間（user + system、/procが読めなければNone）"""
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+    except OSError:
+        return None
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+
+def provision(host, tcp_port, rooms, clients, threads, coalesce_ms=None, reliable=False):
+    """TCPClientでルームを作成し参加させる（[(ルームID, [(トークン, ユーザー名)])]）"""
+    client = TCPClient(host, tcp_port)
+
+    def setup(index):
+        host_name = f'load{index}-0'
+        created = client.create_room(f'load-{index}', host_name, coalesce_ms, reliable)
+        members = [(created['token'], host_name)]
+        for j in range(1, clients):
+            username = f'load{index}-{j}'
+            members.append((client.join_room(created['roomId'], username)['token'], username))
+        return created['roomId'], members
+
+    with ThreadPoolExecutor(threads) as executor:
+        return list(executor.map(setup, range(rooms)))
+
+
+class LoadClient(asyncio.DatagramProtocol):
+    """1人分のUDPクライアント（受信したメッセージの遅延を記録）"""
+
+    def __init__(self, stats):
+        self.stats = stats
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        now = time.monotonic_ns()
+        for message in split_datagram(data):
+            self.message_received(message, now)
+
+    def message_received(self, data, now):
+        # 信頼性モードのルームでは連番を外す（再送要求はしない）
+        kind, _, _, data = parse_sequenced(data)
+        if kind == KIND_LOST or kind == KIND_ACK:
+            return
+        # 受信データは「ユーザー名: 本文」
+        separator = data.find(b': ')
+        body = data[separator + 2:]
+        stats = self.stats
+        if body[:1] != MEASURE:
+            # HELLOが配信された送信者はサーバーにアドレスが登録済み
+            # （受信できたことは登録の証明にならない: 未登録のクライアント宛ての古いアドレスが
+            # 別のクライアントのポートと一致する場合がある）
+            stats['registered'].add(data[:separator])
+            stats['last_hello'] = now
+            return
+        stats['received'] += 1
+        stats['latency'].record(now - int(body[1:body.index(b':')]))
+
+    def error_received(self, exc):
+        self.stats['errors'] += 1
+
+
+def packet(room_id, token, body):
+    room_id_bytes = room_id.encode('utf-8')
+    token_bytes = token.encode('utf-8')
+    return bytes([len(room_id_bytes), len(token_bytes)]) + room_id_bytes + token_bytes + body
+
+
+async def register(senders, stats, warmup, timeout):
+    """HELLOを送ってサーバーにUDPアドレスを登録させる
+
+    HELLOもルーム全員に配信されるため、大きなルームではサーバーの受信バッファからあふれて
+    登録されないクライアントが出ます。登録を確認できないクライアントはHELLOを送り直し、
+    全員の登録を確認してからHELLOの配信がwarmup秒途切れるまで待ちます。
+    """
+    deadline = time.monotonic() + timeout
+    pending = [sender for sender in senders if sender[2] > 0]
+    while pending and time.monotonic() < deadline:
+        for count, (transport, prefix, _, _) in enumerate(pending, 1):
+            transport.sendto(prefix + HELLO)
+            # まとめて送るとサーバーの受信バッファからあふれるため間隔を空ける
+            if count % 100 == 0:
+                await asyncio.sleep(0.05)
+        await asyncio.sleep(0.2)
+        while time.monotonic_ns() - stats['last_hello'] < warmup * 1e9:
+            await asyncio.sleep(0.1)
+        pending = [sender for sender in pending if sender[3] not in stats['registered']]
+    return len(pending)
+
+
+async def generate(rooms, server, rate, duration, size, warmup, drain, ready, go):
+    """割り当てられたルームのクライアントからメッセージを送信し、受信を数える"""
+    loop = asyncio.get_running_loop()
+    stats = {'sent': 0, 'expected': 0, 'received': 0, 'errors': 0, 'registered': set(),
+             'last_hello': time.monotonic_ns(), 'latency': Histogram('latency', 'latency', [])}
+    senders = []
+    for room_id, members in rooms:
+        for token, username in members:
+            username = username.encode('utf-8')
+            transport, _ = await loop.create_datagram_endpoint(
+                lambda: LoadClient(stats), local_addr=('127.0.0.1', 0), remote_addr=server)
+            senders.append((transport, packet(room_id, token, b''), len(members) - 1, username))
+    stats['unregistered'] = await register(senders, stats, warmup, timeout=60)
+    ready.put(len(senders))
+    await loop.run_in_executor(None, go.wait)
+
+    # クライアントごとの送信時刻をヒープで管理（開始位相はばらつかせる）
+    interval = 1.0 / rate
+    cpu_started = time.process_time()
+    started = loop.time()
+    schedule = [(started + random.random() * interval, index, 0) for index in range(len(senders))]
+    heapq.heapify(schedule)
+    end = started + duration
+    padding = b'|' + b'x' * size
+    while schedule:
+        due, index, seq = schedule[0]
+        now = loop.time()
+        if due > now:
+            if due >= end:
+                break
+            await asyncio.sleep(due - now)
+            continue
+        transport, prefix, recipients, _ = senders[index]
+        body = b'%s%d:%d:%d' % (MEASURE, time.monotonic_ns(), index, seq)
+        transport.sendto(prefix + body + padding[:max(0, size - len(body))])
+        stats['sent'] += 1
+        stats['expected'] += recipients
+        heapq.heapreplace(schedule, (due + interval, index, seq + 1))
+    await asyncio.sleep(drain)
+    stats['cpu_seconds'] = time.process_time() - cpu_started
+    stats['seconds'] = loop.time() - started
+    for sender in senders:
+        sender[0].close()
+    stats['latency'] = stats['latency'].snapshot()
+    del stats['last_hello'], stats['registered']
+    return stats
+
+
+def generator_process(rooms, server, options, ready, go, results):
+    results.put(asyncio.run(generate(rooms, server, ready=ready, go=go, **options)))
+
+
+def scrape_metrics(port):
+    """サーバーの計測値から受信・転送・破棄（理由別）パケット数を取り出す"""
+    text = urllib.request.urlopen(f'http://127.0.0.1:{port}/metrics', timeout=5).read().decode()
+    values = {}
+    for line in text.splitlines():
+        if line.startswith(('chat_udp_packets_received_total', 'chat_udp_packets_relayed_total',
+                            'chat_udp_packets_dropped_total{')):
+            name, value = line.rsplit(' ', 1)
+            values[name.split('"')[1] if '{' in name else name] = int(float(value))
+    return values
+
+
+def socket_drops(port):
+    """カーネルがUDPソケットの受信バッファあふれで破棄した数（/proc/net/udpのdrops）"""
+    try:
+        with open('/proc/net/udp') as f:
+            lines = f.readlines()[1:]
+    except OSError:
+        return None
+    for line in lines:
+        fields = line.split()
+        if int(fields[1].split(':')[1], 16) == port:
+            return int(fields[-1])
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="UDPチャットクライアントの負荷試験")
+    parser.add_argument('--rooms', type=int, default=100, help='ルーム数 (M)')
+    parser.add_argument('--clients', type=int, default=10, help='ルームごとのクライアント数 (N)')
+    parser.add_argument('--rate', type=float, default=1.2, help='クライアントごとの毎秒送信件数')
+    parser.add_argument('--duration', type=float, default=10.0, help='送信を続ける秒数')
+    parser.add_argument('--size', type=int, default=64, help='メッセージ本文のバイト数')
+    parser.add_argument('--warmup', type=float, default=1.0,
+                        help='全員の登録後、HELLOの配信がこの秒数途切れたら計測を始める')
+    parser.add_argument('--drain', type=float, default=2.0, help='送信終了後に受信を待つ秒数')
+    parser.add_argument('--processes', type=int, default=1, help='負荷生成プロセス数')
+    parser.add_argument('--max-loss', type=float, default=0.01,
+                        help='目標達成とみなす欠落率の上限')
+    parser.add_argument('--coalesce-ms', type=float, default=None,
+                        help='ルームをまとめ送信（指定したミリ秒以内のメッセージを1データグラムに）で作成')
+    parser.add_argument('--reliable', action='store_true',
+                        help='ルームを信頼性モード（配信メッセージに連番を付ける）で作成')
+    parser.add_argument('--provision-threads', type=int, default=32)
+    parser.add_argument('--engine', choices=('thread', 'asyncio'), default='thread')
+    parser.add_argument('--room-workers', type=int, default=0)
+    parser.add_argument('--server', default=None, metavar='HOST:TCP_PORT:UDP_PORT',
+                        help='起動済みのサーバーを使う（未指定なら子プロセスで起動）')
+    parser.add_argument('--server-pid', type=int, default=None,
+                        help='--server使用時にCPU使用率を計測するプロセスID')
+    parser.add_argument('--output', default=None, help='レポートの出力先（未指定なら標準出力）')
+    args = parser.parse_args()
+
+    server_proc = metrics_port = None
+    if args.server:
+        host, tcp_port, udp_port = args.server.rsplit(':', 2)
+        tcp_port, udp_port = int(tcp_port), int(udp_port)
+        server_pid = args.server_pid
+    else:
+        host, tcp_port, udp_port, metrics_port = '127.0.0.1', free_tcp_port(), free_udp_port(), free_tcp_port()
+        ready = multiprocessing.Event()
+        server_proc = multiprocessing.Process(
+            target=server_process, daemon=True,
+            args=(tcp_port, udp_port, metrics_port, args.engine, args.room_workers, ready))
+        server_proc.start()
+        ready.wait(30)
+        server_pid = server_proc.pid
+
+    try:
+        started = time.perf_counter()
+        rooms = provision(host, tcp_port, args.rooms, args.clients, args.provision_threads,
+                          args.coalesce_ms, args.reliable)
+        provision_seconds = time.perf_counter() - started
+        print(f"provisioned {args.rooms} rooms x {args.clients} clients in {provision_seconds:.2f}s",
+              file=sys.stderr)
+
+        options = dict(rate=args.rate, duration=args.duration, size=args.size,
+                       warmup=args.warmup, drain=args.drain)
+        ready_queue, results = multiprocessing.Queue(), multiprocessing.Queue()
+        go = multiprocessing.Event()
+        generators = [
+            multiprocessing.Process(target=generator_process, daemon=True,
+                                    args=(rooms[i::args.processes], (host, udp_port), options,
+                                          ready_queue, go, results))
+            for i in range(args.processes)
+        ]
+        for generator in generators:
+            generator.start()
+        for _ in generators:
+            ready_queue.get()
+
+        server_before = scrape_metrics(metrics_port) if metrics_port else {}
+        socket_drops_before = socket_drops(udp_port)
+        cpu_before = cpu_seconds(server_pid) if server_pid else None
+        go.set()
+        time.sleep(args.duration)
+        cpu_after = cpu_seconds(server_pid) if server_pid else None
+        stats = [results.get() for _ in generators]
+        server_after = scrape_metrics(metrics_port) if metrics_port else {}
+        socket_drops_after = socket_drops(udp_port)
+        for generator in generators:
+            generator.join()
+    finally:
+        if server_proc:
+            server_proc.terminate()
+
+    sent = sum(s['sent'] for s in stats)
+    expected = sum(s['expected'] for s in stats)
+    received = sum(s['received'] for s in stats)
+    counts = [sum(column) for column in zip(*(s['latency'][0] for s in stats))]
+    snapshot = (counts, sum(s['latency'][1] for s in stats), sum(counts),
+                max(s['latency'][3] for s in stats))
+    latency = Histogram('latency', 'latency', [])
+    relayed_pps = received / args.duration
+    report = {
+        'config': {
+            'rooms': args.rooms, 'clients_per_room': args.clients, 'rate_per_client': args.rate,
+            'duration': args.duration, 'message_size': args.size, 'processes': args.processes,
+            'coalesce_ms': args.coalesce_ms, 'reliable': args.reliable,
+            'engine': None if args.server else args.engine,
+            'room_workers': None if args.server else args.room_workers,
+            'python': platform.python_version(), 'cpus': os.cpu_count(),
+        },
+        'provision_seconds': round(provision_seconds, 3),
+        'sent': sent,
+        'expected_deliveries': expected,
+        'received': received,
+        'loss_ratio': round(1 - received / expected, 6) if expected else 0.0,
+        'send_pps': round(sent / args.duration, 1),
+        'relayed_pps': round(relayed_pps, 1),
+        'latency_ms': dict(
+            {f'p{q * 100:g}': round(latency.percentile(q, snapshot) / 1e6, 3) for q in QUANTILES},
+            mean=round(snapshot[1] / snapshot[2] / 1e6, 3) if snapshot[2] else 0.0,
+            max=round(snapshot[3] / 1e6, 3)),
+        'client_errors': sum(s['errors'] for s in stats),
+        # サーバーにUDPアドレスを登録できなかったクライアント数（0でなければ欠落に含まれる）
+        'unregistered_clients': sum(s['unregistered'] for s in stats),
+        # 負荷生成側のCPU使用率（100%に近ければ遅延・欠落は生成側の限界による可能性が高い）
+        'generator_cpu_percent': [round(s['cpu_seconds'] / s['seconds'] * 100, 1) for s in stats],
+        'server': {
+            'cpu_percent': round((cpu_after - cpu_before) / args.duration * 100, 1)
+            if cpu_before is not None and cpu_after is not None else None,
+            # サーバーの計測値の増分（受信・転送数と理由別の破棄数）
+            'counters': {name: count - server_before.get(name, 0)
+                         for name, count in server_after.items()},
+            'socket_drops': socket_drops_after - socket_drops_before
+            if socket_drops_before is not None and socket_drops_after is not None else None,
+        },
+        'target': {'relayed_pps': TARGET_PACKETS_PER_SECOND, 'max_loss': args.max_loss,
+                   'met': relayed_pps >= TARGET_PACKETS_PER_SECOND
+                   and (not expected or 1 - received / expected <= args.max_loss)},
+    }
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+    print(f"sent {sent} ({report['send_pps']}/s), received {received}/{expected} "
+          f"({report['relayed_pps']}/s, loss {report['loss_ratio']:.2%}), "
+          f"p99 {report['latency_ms']['p99']}ms, server cpu {report['server']['cpu_percent']}%, "
+          f"generator cpu {report['generator_cpu_percent']}%",
+          file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
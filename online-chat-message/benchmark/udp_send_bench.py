@@ -0,0 +1,84 @@
+"""
+UDPClient.send_message の送信コストを計測するベンチマーク
+
+読み出さないUDPソケットを宛先に、N件のメッセージを送るときの呼び出し側の時間と
+プロセスのCPU時間を比較します:
+- legacy: 変更前の実装（毎回ヘッダーをエンコードし、宛先をホスト名のままsendtoに渡す）
+- direct: エンコード済みのヘッダーと解決済みの宛先で直接送信
+- queued: 送信キューに入れて送信スレッドがまとめて送信（--flush-msごとにキューを空にする）
+
+実行例:
+    python udp_send_bench.py --messages 200000 --host localhost
+"""
+
+import argparse
+import os
+import socket
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'chat-client'))
+
+from udp_client import UDPClient
+
+ROOM_ID = '3f2b8c1e-6a4d-4e0b-9c1a-5d7e8f901234'
+TOKEN = '9a8b7c6d-5e4f-4a3b-8c2d-1e0f9a8b7c6d'
+
+
+def legacy_send(client, room_id, token, message):
+    """変更前のUDPClient.send_message"""
+    room_id_bytes = room_id.encode('utf-8')
+    token_bytes = token.encode('utf-8')
+    header = bytearray(2)
+    header[0] = len(room_id_bytes)
+    header[1] = len(token_bytes)
+    packet = header + room_id_bytes + token_bytes + message.encode('utf-8')
+    client.socket.sendto(packet, (client.host, client.port))
+
+
+def run(mode, args, port):
+    if mode == 'queued':
+        client = UDPClient(args.host, port, queue_size=args.queue_size, flush_interval=args.flush_ms / 1000)
+    else:
+        client = UDPClient(args.host, port)
+    send = client.send_message if mode != 'legacy' else lambda *a: legacy_send(client, *a)
+    message = 'x' * args.size
+    cpu = time.process_time()
+    started = time.perf_counter()
+    for i in range(args.messages):
+        send(ROOM_ID, TOKEN, message)
+        if args.rate and i % 100 == 99:
+            # 送信スレッドが追いつけるよう--rateの速さに合わせる
+            delay = started + (i + 1) / args.rate - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+    caller = time.perf_counter() - started
+    client.close()
+    cpu = time.process_time() - cpu
+    return caller, cpu, client.send_stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="UDPClientの送信ベンチマーク")
+    parser.add_argument('--messages', type=int, default=200000)
+    parser.add_argument('--size', type=int, default=32, help='本文のバイト数')
+    parser.add_argument('--host', default='localhost', help='宛先のホスト名（名前解決の有無で差が出る）')
+    parser.add_argument('--queue-size', type=int, default=4096)
+    parser.add_argument('--flush-ms', type=float, default=1.0)
+    parser.add_argument('--rate', type=float, default=0, help='毎秒の送信件数（0で制限なし）')
+    args = parser.parse_args()
+
+    sink = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sink.bind(('127.0.0.1', 0))
+    port = sink.getsockname()[1]
+    for mode in ('legacy', 'direct', 'queued'):
+        caller, cpu, stats = run(mode, args, port)
+        print(f"{mode:7} caller {caller / args.messages * 1e6:6.2f} us/message  "
+              f"cpu {cpu / args.messages * 1e6:6.2f} us/message  "
+              f"sent {stats['sent'] if mode == 'queued' else args.messages}  dropped {stats['dropped']}  "
+              f"backpressure {stats['backpressure']}  flushes {stats['flushes']}")
+    sink.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+"""
+asyncio版のクライアントコア
+TCRPリクエストとUDPの送受信を1つのイベントループで扱います。
+受信はソケットが読めるようになったときだけ呼ばれ、待機中にタイムアウトで起きることはありません
+（再送要求はタイマーで必要な時刻にだけ送ります）。画面を持たないクライアントを多数動かす場合にも使えます。
+"""
+
+import asyncio
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'common'))
+
+from tcp_client import create_payload, history_query, join_payload, list_query, parse_response
+from tcrp import (HEADER_SIZE, OP_CREATE, OP_HISTORY, OP_JOIN, OP_LIST, STATE_REQUEST, encode_message,
+                  unpack_header)
+from udp_client import nack_packets, packet_header, unpack_datagram
+from udp_reliable import SequenceTracker
+
+
+class AsyncTCPClient:
+    """TCPClientのasyncio版（1リクエストごとに接続）"""
+
+    def __init__(self, host, port, timeout=10):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+
+    async def create_room(self, room_name, username, coalesce_ms=None, reliable=False, tagged=False):
+        """新しいルームを作成（TCPClient.create_roomと同じ）"""
+        payload = create_payload(username, coalesce_ms, reliable, tagged)
+        return await self.request(OP_CREATE, room_name, payload)
+
+    async def join_room(self, room_id, username, tagged=False):
+        """既存のルームに参加（TCPClient.join_roomと同じ）"""
+        return await self.request(OP_JOIN, room_id, join_payload(username, tagged))
+
+    async def list_rooms(self, prefix='', sort='name', limit=20, cursor=None):
+        """ルームの一覧を取得（TCPClient.list_roomsと同じ）"""
+        return await self.request(OP_LIST, prefix, list_query(sort, limit, cursor))
+
+    async def history(self, room_id, token, count=None, since=None):
+        """参加中のルームの最近のメッセージを取得（TCPClient.historyと同じ）"""
+        return await self.request(OP_HISTORY, room_id, history_query(token, count, since))
+
+    async def request(self, operation, room_id, payload):
+        """リクエストを送信して応答のペイロードを返す"""
+        try:
+            return await asyncio.wait_for(self._request(operation, room_id, payload), self.timeout)
+        except asyncio.TimeoutError:
+            raise TimeoutError("サーバーへの接続がタイムアウトしました")
+
+    async def _request(self, operation, room_id, payload):
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        try:
+            writer.write(encode_message(operation, STATE_REQUEST, room_id, payload))
+            room_size, _, state, payload_size = unpack_header(await reader.readexactly(HEADER_SIZE))
+            data = await reader.readexactly(room_size + payload_size)
+            return parse_response(state, data, room_size)
+        except asyncio.IncompleteReadError:
+            raise ConnectionError("サーバーからのレスポンスがありません")
+        finally:
+            writer.close()
+
+
+class ChatSession(asyncio.DatagramProtocol):
+    """1つのルームのUDP送受信
+
+    受信したメッセージ（"ユーザー名: 本文"）はon_messageに1件ずつ渡します。
+    サーバーは最初に受け取ったパケットで送信元アドレスを登録するため、メッセージを送るまでは届きません。
+    """
+
+    def __init__(self, room_id, token, on_message):
+        self.room_id = room_id
+        self.header = packet_header(room_id, token)
+        self.on_message = on_message
+        self.tracker = SequenceTracker()  # 信頼性モードの欠番検出（statsに再送の統計）
+        self.transport = None
+        self.nack_timer = None
+        self.errors = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        for message in unpack_datagram(data, self.tracker):
+            self.on_message(message)
+        self.schedule_nacks()
+
+    def error_received(self, exc):
+        self.errors += 1
+
+    def connection_lost(self, exc):
+        if self.nack_timer:
+            self.nack_timer.cancel()
+            self.nack_timer = None
+
+    def send(self, message):
+        """メッセージを送信"""
+        self.transport.sendto(self.header + message.encode('utf-8'))
+
+    def schedule_nacks(self):
+        """次に再送要求する時刻にタイマーを合わせる（loop.time()はtime.monotonic()と同じ時計）"""
+        due = self.tracker.next_due
+        if due is None or (self.nack_timer and self.nack_timer.when() <= due):
+            return
+        if self.nack_timer:
+            self.nack_timer.cancel()
+        self.nack_timer = asyncio.get_running_loop().call_at(due, self.send_nacks)
+
+    def send_nacks(self):
+        self.nack_timer = None
+        if self.transport is None or self.transport.is_closing():
+            return
+        for packet in nack_packets(self.header, self.tracker):
+            self.transport.sendto(packet)
+        self.schedule_nacks()
+
+    def close(self):
+        if self.transport:
+            self.transport.close()
+
+
+async def open_session(host, port, room_id, token, on_message):
+    """サーバーのUDPポートに接続したChatSessionを作成"""
+    loop = asyncio.get_running_loop()
+    _, session = await loop.create_datagram_endpoint(lambda: ChatSession(room_id, token, on_message),
+                                                     remote_addr=(host, port))
+    return session
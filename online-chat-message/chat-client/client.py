@@ -4,9 +4,11 @@ TCPとUDPの通信を統合し、ユーザーインターフェースを提供
 """
 
 import argparse
+import asyncio
 import threading
 import sys
 import os
+from async_client import AsyncTCPClient, open_session
 from tcp_client import TCPClient
 from udp_client import UDPClient
 
@@ -32,13 +34,15 @@ class ChatClient:
         
         while True:
             self.print_menu()
-            choice = input("選択してください (1-3): ")
+            choice = input("選択してください (1-4): ")
             
             if choice == '1':
                 self.create_room()
             elif choice == '2':
                 self.join_room()
             elif choice == '3':
+                self.search_rooms()
+            elif choice == '4':
                 print("チャットクライアントを終了します。")
                 sys.exit(0)
             else:
@@ -56,7 +60,8 @@ class ChatClient:
         print("\nメインメニュー:")
         print("1. 新しいチャットルームを作成")
         print("2. 既存のチャットルームに参加")
-        print("3. 終了")
+        print("3. チャットルームを検索")
+        print("4. 終了")
         
     def create_room(self):
         """新しいルームを作成"""
@@ -90,6 +95,24 @@ class ChatClient:
         except Exception as e:
             print(f"エラー: {e}")
             
+    def search_rooms(self):
+        """ルームを名前の前方一致・参加人数順・活動順で一覧表示"""
+        print("並び順: 1. 名前  2. 参加人数  3. 最近の活動")
+        sort = {'1': 'name', '2': 'members', '3': 'activity'}.get(input("選択してください (1-3): "), 'name')
+        prefix = input("ルーム名の先頭（空欄ですべて）: ") if sort == 'name' else ''
+        cursor = None
+        try:
+            while True:
+                result = self.tcp_client.list_rooms(prefix, sort=sort, cursor=cursor)
+                for room in result['rooms']:
+                    print(f"  {room['roomId']}  {room['roomName']}  ({room['members']}人)")
+                print(f"全{result['total']}件")
+                cursor = result['nextCursor']
+                if cursor is None or input("次のページを表示しますか？ (y/N): ").lower() != 'y':
+                    break
+        except Exception as e:
+            print(f"エラー: {e}")
+
     def start_chat(self):
         """チャットセッションを開始"""
         self.running = True
@@ -134,17 +157,175 @@ class ChatClient:
             except Exception as e:
                 if self.running:  # 終了時のエラーは無視
                     print(f"受信エラー: {e}")
-                    
+
+
+class AsyncChatClient(ChatClient):
+    """asyncio版のチャットクライアント
+
+    標準入力・UDPソケット・TCRPリクエストを1つのイベントループで待つため、
+    受信用のスレッドや1秒ごとのタイムアウトがなく、/exitで即座に終了します（標準入力の監視はPOSIXのみ）。
+    """
+
+    def __init__(self, server_host, tcp_port, udp_port):
+        super().__init__(server_host, tcp_port, udp_port)
+        self.tcp_client = AsyncTCPClient(server_host, tcp_port)
+        self.session = None
+        self.lines = None  # 標準入力から読んだ行（asyncio.Queue、EOFはNone）
+        self.partial = b''  # 標準入力から読んだ、改行がまだ来ていない部分
+
+    def start(self):
+        """クライアントを起動"""
+        asyncio.run(self.run())
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        self.lines = asyncio.Queue()
+        loop.add_reader(sys.stdin.fileno(), self.read_stdin)
+        try:
+            self.print_welcome()
+            self.username = await self.input("ユーザー名を入力してください: ")
+            while True:
+                self.print_menu()
+                choice = await self.input("選択してください (1-4): ")
+                if choice == '1':
+                    await self.create_room()
+                elif choice == '2':
+                    await self.join_room()
+                elif choice == '3':
+                    await self.search_rooms()
+                elif choice == '4':
+                    print("チャットクライアントを終了します。")
+                    return
+                else:
+                    print("無効な選択です。もう一度選択してください。")
+        except EOFError:
+            print("\nクライアントを終了します。")
+        finally:
+            loop.remove_reader(sys.stdin.fileno())
+
+    def read_stdin(self):
+        """標準入力が読めるようになったら、読めた分の行をすべてキューに入れる
+
+        sys.stdin.readline()はファイルオブジェクトのバッファに残りの行を溜めてしまい、
+        ファイルディスクリプタが再び読めるようになるまで取り出されないため、os.readで直接読みます。
+        """
+        fd = sys.stdin.fileno()
+        data = os.read(fd, 65536)
+        if not data:
+            asyncio.get_running_loop().remove_reader(fd)
+            if self.partial:
+                self.lines.put_nowait(self.partial.decode('utf-8', errors='replace'))
+                self.partial = b''
+            self.lines.put_nowait(None)
+            return
+        *lines, self.partial = (self.partial + data).split(b'\n')
+        for line in lines:
+            self.lines.put_nowait(line.rstrip(b'\r').decode('utf-8', errors='replace'))
+
+    async def input(self, prompt=''):
+        """input()のasyncio版（EOFならEOFError）"""
+        print(prompt, end='', flush=True)
+        line = await self.lines.get()
+        if line is None:
+            raise EOFError
+        return line
+
+    async def create_room(self):
+        """新しいルームを作成"""
+        room_name = await self.input("作成するルーム名を入力してください: ")
+        try:
+            result = await self.tcp_client.create_room(room_name, self.username)
+            if result:
+                self.token = result['token']
+                self.room_id = result['roomId']
+                self.room_name = room_name
+                print(f"ルーム '{room_name}' を作成しました！")
+                await self.start_chat()
+            else:
+                print("ルームの作成に失敗しました。")
+        except (EOFError, asyncio.CancelledError):
+            raise
+        except Exception as e:
+            print(f"エラー: {e}")
+
+    async def join_room(self):
+        """既存のルームに参加"""
+        room_id = await self.input("参加するルームIDを入力してください: ")
+        try:
+            result = await self.tcp_client.join_room(room_id, self.username)
+            if result:
+                self.token = result['token']
+                self.room_id = result['roomId']
+                self.room_name = result['roomName']
+                print(f"ルーム '{self.room_name}' に参加しました！")
+                await self.start_chat()
+            else:
+                print("ルームへの参加に失敗しました。")
+        except (EOFError, asyncio.CancelledError):
+            raise
+        except Exception as e:
+            print(f"エラー: {e}")
+
+    async def search_rooms(self):
+        """ルームを名前の前方一致・参加人数順・活動順で一覧表示"""
+        print("並び順: 1. 名前  2. 参加人数  3. 最近の活動")
+        choice = await self.input("選択してください (1-3): ")
+        sort = {'1': 'name', '2': 'members', '3': 'activity'}.get(choice, 'name')
+        prefix = await self.input("ルーム名の先頭（空欄ですべて）: ") if sort == 'name' else ''
+        cursor = None
+        try:
+            while True:
+                result = await self.tcp_client.list_rooms(prefix, sort=sort, cursor=cursor)
+                for room in result['rooms']:
+                    print(f"  {room['roomId']}  {room['roomName']}  ({room['members']}人)")
+                print(f"全{result['total']}件")
+                cursor = result['nextCursor']
+                if cursor is None or (await self.input("次のページを表示しますか？ (y/N): ")).lower() != 'y':
+                    break
+        except (EOFError, asyncio.CancelledError):
+            raise
+        except Exception as e:
+            print(f"エラー: {e}")
+
+    async def start_chat(self):
+        """チャットセッションを開始（受信はイベントループ上でprintする）"""
+        self.running = True
+        self.session = await open_session(self.server_host, self.udp_port, self.room_id, self.token, print)
+
+        os.system('cls' if os.name == 'nt' else 'clear')
+        print(f"==== ルーム: {self.room_name} (ID: {self.room_id}) ====")
+        print("チャットを開始します。終了するには '/exit' と入力してください。")
+
+        try:
+            while self.running:
+                message = await self.input()
+                if message.lower() == '/exit':
+                    break
+                if message:
+                    self.session.send(message)
+        finally:
+            self.running = False
+            self.session.close()
+        print("チャットを終了します...")
+
+
+CLIENT_ENGINES = {
+    'thread': ChatClient,
+    'asyncio': AsyncChatClient,
+}
+
 def main():
     """メイン関数"""
     parser = argparse.ArgumentParser(description="チャットクライアント")
     parser.add_argument('--host', default='localhost', help='サーバーホスト')
     parser.add_argument('--tcp-port', type=int, default=9001, help='TCPポート')
     parser.add_argument('--udp-port', type=int, default=10000, help='UDPポート')
+    parser.add_argument('--engine', choices=CLIENT_ENGINES.keys(), default='thread',
+                        help='threadは受信スレッド、asyncioは標準入力・UDP・TCRPを1つのイベントループで処理')
     
     args = parser.parse_args()
     
-    client = ChatClient(args.host, args.tcp_port, args.udp_port)
+    client = CLIENT_ENGINES[args.engine](args.host, args.tcp_port, args.udp_port)
     try:
         client.start()
     except KeyboardInterrupt:
@@ -0,0 +1,205 @@
+"""
+画面を持たないマルチセッションクライアント（ボットやブリッジ向け）
+1つのUDPソケットで多数のルームに参加し、配信に付くルームタグで受信メッセージをルームごとに振り分けます。
+各ルームのメッセージは async for で受け取れます:
+
+    client = MultiSessionClient('localhost', 9001, 10000)
+    await client.start()
+    session = await client.join_room(room_id, 'bridge')
+    session.send('こんにちは')
+    async for message in session:  # "ユーザー名: 本文"
+        print(session.room_name, message)
+
+参加したルームごとに生存通知（範囲のない再送要求）を定期的に送ります。有効なトークン付きの生存通知は
+サーバーの送信元アドレスごとの流量制限（--rate-limit-address）に数えられないため、多数のルームに参加しても
+制限を大きくする必要はありません。
+"""
+
+import asyncio
+import math
+import os
+import socket
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'common'))
+
+from async_client import AsyncTCPClient
+from udp_batch import split_room_tag
+from udp_client import nack_packets, packet_header, unpack_datagram
+from udp_reliable import SequenceTracker, encode_nack
+
+KEEPALIVE = encode_nack(0, [])  # 範囲のない再送要求（アドレスの登録と生存通知）
+
+
+class RoomSession:
+    """1つのルームへの参加（async forで受信メッセージを届いた順に返す）"""
+
+    def __init__(self, client, room_id, room_name, token, queue_size):
+        self.client = client
+        self.room_id = room_id
+        self.room_name = room_name
+        self.token = token
+        self.header = packet_header(room_id, token)
+        self.tracker = SequenceTracker()  # 信頼性モードの欠番検出（statsに再送の統計）
+        self.messages = asyncio.Queue(queue_size)
+        self.dropped = 0  # 読み出されずにキューが一杯になって捨てたメッセージ数
+        self.last_sent = 0.0
+        self.nack_timer = None
+        self.closed = False
+
+    def send(self, message):
+        """メッセージを送信"""
+        self.client.send_packet(self, self.header + message.encode('utf-8'))
+
+    def deliver(self, message):
+        try:
+            self.messages.put_nowait(message)
+        except asyncio.QueueFull:
+            self.dropped += 1
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self.closed and self.messages.empty():
+            raise StopAsyncIteration
+        message = await self.messages.get()
+        if message is None:
+            raise StopAsyncIteration
+        return message
+
+    def close(self):
+        """受信を終える（サーバーからは生存通知が途絶えたあとタイムアウトで削除される）"""
+        if self.closed:
+            return
+        self.closed = True
+        self.client.forget(self)
+        if self.nack_timer:
+            self.nack_timer.cancel()
+            self.nack_timer = None
+        if self.messages.full():
+            self.messages.get_nowait()
+            self.dropped += 1
+        self.messages.put_nowait(None)  # 待っているasync forを終わらせる
+
+
+class MultiSessionClient(asyncio.DatagramProtocol):
+    """1つのUDPソケットで複数のルームに参加するクライアント
+
+    ルームの作成・参加はAsyncTCPClientで行い（同時にconcurrency件まで）、参加時にルームタグ付きの配信を求めます。
+    各セッションには受信メッセージをqueue_size件までためます。生存通知はkeepalive秒ごとに、
+    全セッション分を1秒ごとに少しずつ送ります。
+    """
+
+    def __init__(self, host, tcp_port, udp_port, queue_size=1000, keepalive=60.0, concurrency=100):
+        self.host = host
+        self.udp_port = udp_port
+        self.tcp_client = AsyncTCPClient(host, tcp_port)
+        self.queue_size = queue_size
+        self.keepalive = keepalive
+        self.requests = asyncio.Semaphore(concurrency)
+        self.sessions = {}  # ルームID（bytes） -> RoomSession
+        self.transport = None
+        self.keepalive_task = None
+        self.keepalive_cursor = 0
+        self.unknown = 0  # 参加していないルームのデータグラム数
+        self.errors = 0
+
+    async def start(self):
+        """UDPソケットを作成して生存通知を開始"""
+        loop = asyncio.get_running_loop()
+        await loop.create_datagram_endpoint(lambda: self, remote_addr=(self.host, self.udp_port))
+        sock = self.transport.get_extra_info('socket')
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+        self.keepalive_task = loop.create_task(self.keepalive_loop())
+
+    async def create_room(self, room_name, username, coalesce_ms=None, reliable=False):
+        """ルームを作成してセッションを返す"""
+        async with self.requests:
+            result = await self.tcp_client.create_room(room_name, username, coalesce_ms, reliable, tagged=True)
+        return self.open(result['roomId'], room_name, result)
+
+    async def join_room(self, room_id, username):
+        """ルームに参加してセッションを返す"""
+        async with self.requests:
+            result = await self.tcp_client.join_room(room_id, username, tagged=True)
+        return self.open(room_id, result['roomName'], result)
+
+    async def join_rooms(self, room_ids, username):
+        """複数のルームに参加し、セッション（または例外）のリストを返す"""
+        return await asyncio.gather(*(self.join_room(room_id, username) for room_id in room_ids),
+                                    return_exceptions=True)
+
+    def open(self, room_id, room_name, result):
+        if not result.get('tagged'):
+            raise ValueError("サーバーがルームタグ付きの配信に対応していません")
+        session = RoomSession(self, room_id, room_name, result['token'], self.queue_size)
+        self.sessions[room_id.encode('utf-8')] = session
+        self.send_packet(session, session.header + KEEPALIVE)  # このソケットのアドレスを登録
+        return session
+
+    def forget(self, session):
+        self.sessions.pop(session.room_id.encode('utf-8'), None)
+
+    def send_packet(self, session, packet):
+        session.last_sent = time.monotonic()
+        self.transport.sendto(packet)
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        room_id, data = split_room_tag(data)
+        session = self.sessions.get(room_id)
+        if session is None:
+            self.unknown += 1
+            return
+        for message in unpack_datagram(data, session.tracker):
+            session.deliver(message)
+        if session.tracker.next_due is not None:
+            self.schedule_nacks(session)
+
+    def error_received(self, exc):
+        self.errors += 1
+
+    def schedule_nacks(self, session):
+        """セッションの次の再送要求の時刻にタイマーを合わせる"""
+        due = session.tracker.next_due
+        if due is None or (session.nack_timer and session.nack_timer.when() <= due):
+            return
+        if session.nack_timer:
+            session.nack_timer.cancel()
+        session.nack_timer = asyncio.get_running_loop().call_at(due, self.send_nacks, session)
+
+    def send_nacks(self, session):
+        session.nack_timer = None
+        if session.closed or self.transport.is_closing():
+            return
+        for packet in nack_packets(session.header, session.tracker):
+            self.send_packet(session, packet)
+        self.schedule_nacks(session)
+
+    async def keepalive_loop(self):
+        """keepalive秒で全セッションを一巡するよう、1秒ごとに順番に生存通知を送る"""
+        while True:
+            await asyncio.sleep(1)
+            sessions = list(self.sessions.values())
+            if not sessions:
+                continue
+            now = time.monotonic()
+            count = math.ceil(len(sessions) / self.keepalive)
+            for i in range(count):
+                session = sessions[(self.keepalive_cursor + i) % len(sessions)]
+                if now - session.last_sent >= self.keepalive / 2:
+                    self.send_packet(session, session.header + KEEPALIVE)
+            self.keepalive_cursor = (self.keepalive_cursor + count) % len(sessions)
+
+    def close(self):
+        """全セッションを閉じてソケットを閉じる"""
+        for session in list(self.sessions.values()):
+            session.close()
+        if self.keepalive_task:
+            self.keepalive_task.cancel()
+        if self.transport:
+            self.transport.close()
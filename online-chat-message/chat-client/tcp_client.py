@@ -3,8 +3,64 @@ TCP通信を担当するクライアントモジュール
 ルームの作成と参加を処理します
 """
 
-import socket
 import json
+import os
+import socket
+import sys
+import threading
+from concurrent.futures import Future
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'common'))
+
+from tcrp import (HEADER_SIZE, OP_CREATE, OP_HISTORY, OP_JOIN, OP_LIST, STATE_ERROR,
+                  STATE_REQUEST, encode_message, recv_exactly, unpack_header, unpack_request_id)
+
+def parse_response(state, data, room_size):
+    """レスポンスのボディを解釈（エラー状態ならValueError、ペイロードがなければNone）"""
+    if state == STATE_ERROR:  # エラー状態
+        error_message = data[room_size:].decode('utf-8')
+        raise ValueError(f"サーバーエラー: {error_message}")
+        
+    # ペイロードが存在する場合のみ処理
+    if len(data) > room_size:
+        try:
+            return json.loads(data[room_size:].decode('utf-8'))
+        except json.JSONDecodeError:
+            raise ValueError("サーバーからの無効なJSONレスポンス")
+    return None
+
+def create_payload(username, coalesce_ms=None, reliable=False, tagged=False):
+    """ルーム作成リクエストのペイロード（まとめ送信や信頼性モードを指定する場合はJSON）"""
+    if not coalesce_ms and not reliable and not tagged:
+        return username
+    payload = {"username": username}
+    if coalesce_ms:
+        payload["coalesceMs"] = coalesce_ms
+    if reliable:
+        payload["reliable"] = True
+    if tagged:
+        payload["tagged"] = True
+    return json.dumps(payload)
+
+def join_payload(username, tagged=False):
+    """ルーム参加リクエストのペイロード（taggedなら配信にルームタグを付けるよう求めるJSON）"""
+    return json.dumps({"username": username, "tagged": True}) if tagged else username
+
+def list_query(sort, limit, cursor):
+    """ルーム一覧リクエストのペイロード（JSON）"""
+    query = {"sort": sort, "limit": limit}
+    if cursor is not None:
+        query["cursor"] = cursor
+    return json.dumps(query)
+
+def history_query(token, count, since):
+    """履歴取得リクエストのペイロード（JSON）"""
+    query = {"token": token}
+    if count is not None:
+        query["count"] = count
+    if since is not None:
+        query["since"] = since
+    return json.dumps(query)
 
 class TCPClient:
     """TCPクライアント - ルーム作成・参加を担当"""
@@ -13,13 +69,35 @@ class TCPClient:
         self.host = host
         self.port = port
         
-    def create_room(self, room_name, username):
-        """新しいルームを作成"""
-        return self._send_tcp_request(1, 0, room_name, username)
+    def create_room(self, room_name, username, coalesce_ms=None, reliable=False, tagged=False):
+        """新しいルームを作成
+
+        coalesce_msを指定すると、サーバーがその時間（ミリ秒、サーバーの上限まで）内に届いた
+        メッセージをまとめて配信するルームになります。reliableを指定すると配信メッセージに連番が付き、
+        UDPClientが欠番の再送を要求する信頼性モードのルームになります。
+        taggedはjoin_roomと同じです。
+        """
+        return self._send_tcp_request(OP_CREATE, STATE_REQUEST, room_name,
+                                      create_payload(username, coalesce_ms, reliable, tagged))
     
-    def join_room(self, room_id, username):
-        """既存のルームに参加"""
-        return self._send_tcp_request(2, 0, room_id, username)
+    def join_room(self, room_id, username, tagged=False):
+        """既存のルームに参加（taggedを指定すると配信されるデータグラムにルームタグが付きます）"""
+        return self._send_tcp_request(OP_JOIN, STATE_REQUEST, room_id, join_payload(username, tagged))
+
+    def list_rooms(self, prefix='', sort='name', limit=20, cursor=None):
+        """ルームの一覧を取得（sortは name / members / activity、prefixはnameのときのみ）
+
+        戻り値の nextCursor を次の呼び出しの cursor に渡すと続きのページを取得できます。
+        """
+        return self._send_tcp_request(OP_LIST, STATE_REQUEST, prefix, list_query(sort, limit, cursor))
+
+    def history(self, room_id, token, count=None, since=None):
+        """参加中のルームの最近のメッセージを取得（tokenは参加時のトークン）
+
+        最新count件、またはsince（エポックミリ秒）以降のメッセージを古い順に返します。
+        戻り値の messages は {"sender", "content", "timestamp"} のリストです。
+        """
+        return self._send_tcp_request(OP_HISTORY, STATE_REQUEST, room_id, history_query(token, count, since))
         
     def _send_tcp_request(self, operation, state, room_id, payload):
         """TCPリクエストを送信"""
@@ -29,74 +107,212 @@ class TCPClient:
             client_socket.settimeout(10) # 10秒タイムアウト
             client_socket.connect((self.host, self.port))
             
-            # ヘッダーを構築
-            room_id_bytes = room_id.encode('utf-8')
-            room_id_size = len(room_id_bytes)
-            payload_bytes = payload.encode('utf-8')
-            payload_size = len(payload_bytes)
-            
-            header = bytearray(32)
-            header[0] = room_id_size
-            header[1] = operation
-            header[2] = state
-            
-            # ペイロードサイズをバイトに変換
-            payload_size_str = str(payload_size)
-            for i in range(min(len(payload_size_str), 29)):
-                header[3 + i] = ord(payload_size_str[i])
-            
             # リクエストを送信
-            client_socket.send(header + room_id_bytes + payload_bytes)
+            client_socket.sendall(encode_message(operation, state, room_id, payload))
             
             # レスポンスの受信
-            response_header = client_socket.recv(32)
-            if not response_header:
+            response_header = recv_exactly(client_socket, HEADER_SIZE)
+            if len(response_header) < HEADER_SIZE:
                 raise ConnectionError("サーバーからのレスポンスがありません")
                 
-            response_room_size = response_header[0]
-            response_operation = response_header[1]
-            response_state = response_header[2]
-            
-            # ペイロードサイズの解析
-            payload_size_bytes = response_header[3:32]
-            response_payload_size_str = ''
-            for b in payload_size_bytes:
-                if b == 0:  # ヌルバイトで終了
-                    break
-                if 48 <= b <= 57:  # ASCIIの0-9
-                    response_payload_size_str += chr(b)
-                    
-            response_payload_size = int(response_payload_size_str) if response_payload_size_str else 0
+            response_room_size, response_operation, response_state, response_payload_size = \
+                unpack_header(response_header)
             
             # データの受信
-            max_data_size = response_room_size + response_payload_size
-            data = bytearray()
-            total_received = 0
-            
-            while total_received < max_data_size:
-                chunk = client_socket.recv(min(4096, max_data_size - total_received))
-                if not chunk:
-                    break
-                data.extend(chunk)
-                total_received += len(chunk)
-                
-            room_name = data[:response_room_size].decode('utf-8')
-            
-            if response_state == 2:  # エラー状態
-                error_message = data[response_room_size:].decode('utf-8')
-                raise ValueError(f"サーバーエラー: {error_message}")
-                
-            # ペイロードが存在する場合のみ処理
-            if total_received > response_room_size:
-                payload_json = data[response_room_size:].decode('utf-8')
-                result = json.loads(payload_json)
-                return result
-            else:
-                return None
+            data = recv_exactly(client_socket, response_room_size + response_payload_size)
+            return parse_response(response_state, data, response_room_size)
                 
         except socket.timeout:
             raise TimeoutError("サーバーへの接続がタイムアウトしました")
-        except json.JSONDecodeError:
-            raise ValueError("サーバーからの無効なJSONレスポンス")
         finally:
-            client_socket.close() 
\ No newline at end of file
+            client_socket.close() 
+
+
+class PipelinedTCPClient:
+    """1本のTCP接続で複数のリクエストを続けて送るクライアント（リクエストID拡張を使用）
+
+    応答はリクエストIDで対応付けるため、送信順に返ってこなくても構いません。
+    応答待ちはmax_in_flight件（サーバーの1接続あたりの同時処理数と同じ既定32件）までで、
+    それを超える送信は空きができるまで待ちます。
+    接続が閉じられた場合、応答のなかったリクエストは新しい接続で送り直します
+    （サーバーは読んだリクエストに応答してから閉じるため、応答のないものは処理されていません）。
+    最初の応答にリクエストIDが付いていないサーバー（拡張に未対応）の場合は、
+    以降のリクエストをTCPClientと同じく1リクエストごとの接続で送ります。
+    """
+
+    MAX_RESENDS = 3  # 1件も応答がないまま接続が閉じられた場合に送り直す回数
+
+    def __init__(self, host, port, timeout=10, max_in_flight=32):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.socket = None
+        self.supported = None  # サーバーが拡張に対応しているか（最初の応答で判定）
+        self.slots = threading.BoundedSemaphore(max_in_flight)  # 応答待ちの上限
+        self.pending = {}  # request_id -> (Future, (operation, room_id, payload), 送り直した回数)
+        self.next_id = 0
+        self.lock = threading.Lock()
+        self.probe_lock = threading.Lock()
+        self.one_shot = TCPClient(host, port)
+
+    def create_room(self, room_name, username, coalesce_ms=None, reliable=False, tagged=False):
+        """新しいルームを作成（TCPClient.create_roomと同じ）"""
+        payload = create_payload(username, coalesce_ms, reliable, tagged)
+        return self.submit(OP_CREATE, room_name, payload).result(self.timeout)
+
+    def join_room(self, room_id, username, tagged=False):
+        """既存のルームに参加（TCPClient.join_roomと同じ）"""
+        return self.submit(OP_JOIN, room_id, join_payload(username, tagged)).result(self.timeout)
+
+    def list_rooms(self, prefix='', sort='name', limit=20, cursor=None):
+        """ルームの一覧を取得（TCPClient.list_roomsと同じ）"""
+        return self.submit(OP_LIST, prefix, list_query(sort, limit, cursor)).result(self.timeout)
+
+    def history(self, room_id, token, count=None, since=None):
+        """参加中のルームの最近のメッセージを取得（TCPClient.historyと同じ）"""
+        return self.submit(OP_HISTORY, room_id, history_query(token, count, since)).result(self.timeout)
+
+    def join_rooms(self, room_ids, username):
+        """複数のルームへの参加リクエストをまとめて送り、結果（または例外）のリストを返す"""
+        futures = [self.submit(OP_JOIN, room_id, username) for room_id in room_ids]
+        results = []
+        for future in futures:
+            try:
+                results.append(future.result(self.timeout))
+            except Exception as e:
+                results.append(e)
+        return results
+
+    def submit(self, operation, room_id, payload):
+        """リクエストを送信し、応答を受け取るFutureを返す"""
+        if self.supported is None:
+            # 対応状況が分かるまでは1件ずつ送る
+            with self.probe_lock:
+                if self.supported is None:
+                    future = self._send(operation, room_id, payload)
+                    try:
+                        future.exception(self.timeout)
+                    except Exception:
+                        pass
+                    return future
+        if not self.supported:
+            return self._send_one_shot(operation, room_id, payload)
+        return self._send(operation, room_id, payload)
+
+    def _send(self, operation, room_id, payload):
+        """応答待ちに空きができるまで待ってから送信"""
+        future = Future()
+        if not self.slots.acquire(timeout=self.timeout):
+            future.set_exception(TimeoutError("応答待ちのリクエストが多すぎます"))
+            return future
+        future.add_done_callback(lambda _: self.slots.release())
+        self._transmit(future, (operation, room_id, payload), 0)
+        return future
+
+    def _transmit(self, future, request, resends):
+        operation, room_id, payload = request
+        with self.lock:
+            request_id = self.next_id
+            self.next_id = (self.next_id + 1) & 0xFFFFFFFF
+            try:
+                if self.socket is None:
+                    self._connect()
+            except OSError as e:
+                future.set_exception(ConnectionError(f"リクエストを送信できません: {e}"))
+                return
+            self.pending[request_id] = (future, request, resends)
+            try:
+                self.socket.sendall(encode_message(operation, STATE_REQUEST, room_id, payload, request_id))
+            except OSError:
+                # サーバーが閉じた接続への送信（受信スレッドが切断を検出したときに送り直す）
+                try:
+                    self.socket.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+
+    def _send_one_shot(self, operation, room_id, payload, future=None):
+        future = future or Future()
+        try:
+            future.set_result(self.one_shot._send_tcp_request(operation, STATE_REQUEST, room_id, payload))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def _connect(self):
+        """接続して応答の受信スレッドを起動（lock取得済みで呼ぶ）"""
+        sock = socket.create_connection((self.host, self.port), self.timeout)
+        sock.settimeout(None)
+        self.socket = sock
+        receiver = threading.Thread(target=self._receive_loop, args=(sock,))
+        receiver.daemon = True
+        receiver.start()
+
+    def _receive_loop(self, sock):
+        """応答を受信してリクエストIDに対応するFutureへ渡す"""
+        answered = False
+        while True:
+            try:
+                header = recv_exactly(sock, HEADER_SIZE)
+                if len(header) < HEADER_SIZE:
+                    break
+                room_size, _, state, payload_size = unpack_header(header)
+                data = recv_exactly(sock, room_size + payload_size)
+            except OSError:
+                break
+            request_id = unpack_request_id(header)
+            with self.lock:
+                if request_id is None:
+                    # 拡張に未対応のサーバー（1件目の応答を返して接続を閉じる）
+                    self.supported = False
+                    entry = self.pending.pop(next(iter(self.pending)), None) if self.pending else None
+                else:
+                    self.supported = True
+                    entry = self.pending.pop(request_id, None)
+            if entry is None:
+                continue
+            answered = True
+            future = entry[0]
+            try:
+                future.set_result(parse_response(state, data, room_size))
+            except Exception as e:
+                future.set_exception(e)
+        self._disconnected(sock, answered)
+
+    def _disconnected(self, sock, answered):
+        """接続が閉じられたら応答待ちのリクエストを新しい接続で送り直す
+
+        パイプライン接続の上限に達したサーバーは最初のリクエストだけに応答して閉じるため、
+        応答があった接続の残りは回数に数えずに送り直します。1件も応答がないまま閉じられた場合は
+        MAX_RESENDS回まで送り直し、それでも応答がなければ失敗させます。
+        """
+        pending = {}
+        with self.lock:
+            if self.socket is sock:
+                self.socket = None
+                pending, self.pending = self.pending, {}
+        sock.close()
+        for future, request, resends in pending.values():
+            if not answered:
+                resends += 1
+            if resends > self.MAX_RESENDS:
+                future.set_exception(ConnectionError("サーバーとの接続が切断されました"))
+            elif self.supported is False:
+                self._send_one_shot(*request, future=future)
+            else:
+                self._transmit(future, request, resends)
+
+    def _fail(self, pending):
+        for future, _, _ in pending.values():
+            future.set_exception(ConnectionError("サーバーとの接続が切断されました"))
+
+    def close(self):
+        """接続を閉じる（応答待ちのリクエストは失敗させる）"""
+        with self.lock:
+            sock, self.socket = self.socket, None
+            pending, self.pending = self.pending, {}
+        if sock:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        self._fail(pending)
@@ -3,52 +3,183 @@ UDP通信を担当するクライアントモジュール
 チャットメッセージの送受信を処理します
 """
 
+import os
 import socket
+import sys
 import threading
+import time
+from collections import deque
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'common'))
+
+from udp_batch import split_datagram
+from udp_reliable import (KIND_ACK, KIND_LOST, MAX_NACK_RANGES, SequenceTracker, encode_nack,
+                          parse_sequenced)
+
+def packet_header(room_id, token):
+    """送信パケットのヘッダー（ルームIDとトークンの長さ・ルームID・トークン）"""
+    room_id_bytes = room_id.encode('utf-8')
+    token_bytes = token.encode('utf-8')
+    return bytes((len(room_id_bytes), len(token_bytes))) + room_id_bytes + token_bytes
+
+def unpack_datagram(data, tracker):
+    """受信したデータグラムを新しく届いたメッセージ（文字列）のリストにする
+
+    まとめ送信を分解し、信頼性モードの連番はtracker（SequenceTracker）で重複と欠番を確認します。
+    """
+    now = time.monotonic()
+    messages = []
+    for frame in split_datagram(data):
+        kind, stream, seq, body = parse_sequenced(frame)
+        if kind is not None:
+            if kind == KIND_LOST:
+                tracker.give_up(stream, seq)
+                continue
+            if not tracker.receive(stream, seq, now) or kind == KIND_ACK:
+                continue  # 重複、または自分のメッセージの連番の通知
+        messages.append(body.decode('utf-8', errors='replace'))
+    return messages
+
+def nack_packets(header, tracker):
+    """期限の来た欠番の再送要求パケットのリスト"""
+    packets = []
+    for stream, ranges in tracker.due(time.monotonic()):
+        for i in range(0, len(ranges), MAX_NACK_RANGES):
+            packets.append(header + encode_nack(stream, ranges[i:i + MAX_NACK_RANGES]))
+    return packets
 
 class UDPClient:
-    """UDPクライアント - メッセージ送受信を担当"""
+    """UDPクライアント - メッセージ送受信を担当
+
+    queue_sizeを指定すると送信はキューに入れるだけで戻り、送信スレッドがまとめて送ります
+    （flush_interval秒だけ待ってからキューを空にする）。キューが一杯なら送らずにFalseを返し、
+    send_statsに件数を数えます。
+    """
     
-    def __init__(self, host, port):
+    def __init__(self, host, port, queue_size=0, flush_interval=0.0):
         self.host = host
         self.port = port
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.socket.settimeout(1)  # 1秒タイムアウト（定期的にチェックするため）
+        # 送信のたびに名前解決しないよう宛先を解決しておく
+        self.address = socket.getaddrinfo(host, port, socket.AF_INET, socket.SOCK_DGRAM)[0][4]
+        self.pending = deque()  # まとめ送信で受信した未読のメッセージ
+        self.tracker = SequenceTracker()  # 信頼性モードのルームの欠番検出（statsに再送の統計）
+        self.nack_header = None  # 再送要求に付けるヘッダー（最後に送信したルームとトークン）
+        self.headers = {}  # (ルームID, トークン) -> エンコード済みのヘッダー
+        # 送信の統計: queued/sentはキュー経由の件数、droppedはキューが一杯で捨てた件数、
+        # backpressureはキューが半分以上埋まっていたときに追加した件数、errorsは送信スレッドでの送信失敗
+        self.send_stats = {'queued': 0, 'sent': 0, 'dropped': 0, 'backpressure': 0, 'flushes': 0, 'errors': 0}
+        self.queue_size = queue_size
+        self.flush_interval = flush_interval
+        self.outbound = None
+        if queue_size > 0:
+            self.outbound = deque()
+            self.wakeup = threading.Event()
+            self.closing = False
+            self.sender = threading.Thread(target=self.send_loop, daemon=True)
+            self.sender.start()
+
+    def header(self, room_id, token):
+        """ルームIDとトークンのヘッダー（セッションごとに1回だけエンコード）"""
+        key = (room_id, token)
+        header = self.headers.get(key)
+        if header is None:
+            header = self.headers[key] = packet_header(room_id, token)
+        self.nack_header = header
+        return header
         
     def send_message(self, room_id, token, message):
-        """メッセージを送信"""
+        """メッセージを送信（キュー使用時は一杯で捨てたらFalse）"""
+        packet = self.header(room_id, token) + message.encode('utf-8')
+        if self.outbound is not None:
+            return self.enqueue(packet)
         try:
-            # ヘッダーを構築
-            room_id_bytes = room_id.encode('utf-8')
-            room_id_size = len(room_id_bytes)
-            token_bytes = token.encode('utf-8')
-            token_size = len(token_bytes)
-            message_bytes = message.encode('utf-8')
-            
-            # データパケットを構築
-            header = bytearray(2)
-            header[0] = room_id_size
-            header[1] = token_size
-            
-            # メッセージを送信
-            packet = header + room_id_bytes + token_bytes + message_bytes
-            self.socket.sendto(packet, (self.host, self.port))
-            
+            self.socket.sendto(packet, self.address)
         except Exception as e:
             raise Exception(f"メッセージ送信エラー: {e}")
+        return True
+
+    def enqueue(self, packet):
+        """パケットを送信キューに入れて送信スレッドを起こす"""
+        depth = len(self.outbound)
+        stats = self.send_stats
+        if depth >= self.queue_size:
+            stats['dropped'] += 1
+            return False
+        if depth * 2 >= self.queue_size:
+            stats['backpressure'] += 1
+        stats['queued'] += 1
+        self.outbound.append(packet)
+        if not self.wakeup.is_set():  # 追加してから確認するので、送信スレッドが取りこぼすことはない
+            self.wakeup.set()
+        return True
+
+    def send_loop(self):
+        """送信スレッド: 起こされたらflush_interval秒待ってキューを空にする"""
+        while not self.closing:
+            self.wakeup.wait()
+            if self.flush_interval:
+                time.sleep(self.flush_interval)
+            self.wakeup.clear()
+            self.flush()
+
+    def flush(self):
+        """送信キューにたまったパケットをすべて送信"""
+        if not self.outbound:
+            return
+        outbound = self.outbound
+        sendto = self.socket.sendto
+        address = self.address
+        sent = errors = 0
+        while outbound:
+            try:
+                sendto(outbound.popleft(), address)
+                sent += 1
+            except IndexError:  # 他のスレッドが先に取り出した
+                break
+            except OSError:
+                errors += 1
+        stats = self.send_stats
+        stats['sent'] += sent
+        stats['errors'] += errors
+        stats['flushes'] += 1
         
     def receive_message(self):
-        """メッセージを受信"""
+        """メッセージを受信（まとめ送信のデータグラムは1件ずつ順に返す）
+
+        信頼性モードのルームでは重複を捨て、欠番があればサーバーに再送を要求します。
+        欠番の到着は待たずに届いた順に返します。
+        """
+        if self.pending:
+            return self.pending.popleft()
         try:
+            self.send_nacks()
+            # 再送要求の期限が近ければその時刻までに戻る
+            now = time.monotonic()
+            due = self.tracker.next_due
+            self.socket.settimeout(1 if due is None else min(1, max(0.001, due - now)))
             data, _ = self.socket.recvfrom(4096)
-            message = data.decode('utf-8')
-            return message
+            self.pending.extend(unpack_datagram(data, self.tracker))
+            return self.pending.popleft() if self.pending else None
         except socket.timeout:
             # タイムアウトは通常の動作（定期的なチェックのため）
             return None
         except Exception as e:
             raise Exception(f"メッセージ受信エラー: {e}")
+
+    def send_nacks(self):
+        """期限の来た欠番の再送を要求"""
+        if self.nack_header is None or self.tracker.next_due is None:
+            return
+        for packet in nack_packets(self.nack_header, self.tracker):
+            self.socket.sendto(packet, self.address)
             
     def close(self):
-        """ソケットをクローズ"""
+        """ソケットをクローズ（送信キューに残ったパケットは送ってから閉じる）"""
+        if self.outbound is not None:
+            self.closing = True
+            self.wakeup.set()
+            self.sender.join()
+            self.flush()
         self.socket.close() 
\ No newline at end of file
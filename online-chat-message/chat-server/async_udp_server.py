@@ -0,0 +1,118 @@
+"""
+asyncioベースのUDPリレーエンジン
+UDPServerと同じパケット形式のまま、ノンブロッキングでメッセージを配信します
+"""
+
+import asyncio
+import socket
+import threading
+from udp_server import UDPServer, log
+
+
+class RelayProtocol(asyncio.DatagramProtocol):
+    """受信したデータグラムをUDPServerのハンドラへ渡すプロトコル"""
+
+    def __init__(self, server):
+        self.server = server
+
+    def connection_made(self, transport):
+        self.server.transport = transport
+
+    def datagram_received(self, data, addr):
+        self.server.dispatch(data, addr)
+
+    def error_received(self, exc):
+        # ICMP到達不能などは配信先の問題なので無視して継続する
+        pass
+
+
+class AsyncUDPServer(UDPServer):
+    """asyncioイベントループ上で動作するUDPサーバー
+
+    受信はイベントループのコールバックで処理し、送信はトランスポートの
+    ノンブロッキング送信を使うため、送信バッファが詰まってもループは停止しません。
+    """
+
+    def __init__(self, tcp_server, host='0.0.0.0', port=10000, batch_send=True, batch_recv=False,
+                 reuse_port=False, room_workers=0, room_queue_size=1024, rate_limits=None):
+        # 受信はイベントループのコールバックで行うためbatch_recvは使用しない
+        super().__init__(tcp_server, host, port, batch_send, False, reuse_port,
+                         room_workers, room_queue_size, rate_limits)
+        self.transport = None
+        self.loop = None
+        self.loop_thread = None
+        self._stopped = None
+
+    def start(self):
+        """サーバーを起動（呼び出し元スレッドでイベントループを実行）"""
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_until_complete(self.serve())
+        finally:
+            self.loop.close()
+
+    async def serve(self):
+        """イベントループ上でデータグラムの受信を開始"""
+        self.socket = self.create_socket()
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4 * 1024 * 1024)
+        self.socket.setblocking(False)
+
+        loop = asyncio.get_running_loop()
+        self.loop_thread = threading.get_ident()
+        self._stopped = loop.create_future()
+        await loop.create_datagram_endpoint(lambda: RelayProtocol(self), sock=self.socket)
+        self.running = True
+        if self.scheduler:
+            self.scheduler.start()
+        self.coalescer.start()
+        log.info('listening', host=self.host, port=self.port, engine='asyncio',
+                 batch_send=self.batch_send)
+
+        try:
+            await self._stopped
+        finally:
+            self.transport.close()
+
+    def relay(self, data, addresses, skip=None):
+        """トランスポート経由でノンブロッキング送信
+
+        sendmmsgが使える場合はまとめて送信し、送信バッファが埋まって
+        送りきれなかった残りだけをトランスポートのバッファに積みます。
+        ルームワーカーのスレッドから呼ばれた場合はトランスポートを使わずソケットへ直接送信し、
+        送信バッファが埋まった分は破棄します。
+        """
+        if threading.get_ident() != self.loop_thread:
+            self.relay_direct(data, addresses, skip)
+            return
+        sent = 0
+        multi_sender = self.multi_sender
+        if multi_sender and len(addresses) > 2 and not self.transport.get_write_buffer_size():
+            sent = multi_sender.sendto_many(self.socket, data, addresses, skip)
+            if sent == len(addresses) - (skip is not None):
+                return
+        sendto = self.transport.sendto
+        remaining = [a for index, a in enumerate(addresses) if index != skip]
+        for client_address in remaining[sent:]:
+            sendto(data, client_address)
+
+    def relay_direct(self, data, addresses, skip=None):
+        """ノンブロッキングソケットへ直接送信"""
+        try:
+            super().relay(data, addresses, skip)
+        except BlockingIOError:
+            self.metrics.udp_dropped['send_buffer'].inc()
+
+    def stop(self):
+        """サーバーを停止（他スレッドから呼び出し可能）"""
+        self.running = False
+        if self.scheduler:
+            self.scheduler.stop()
+        self.coalescer.stop()
+        if self.loop and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self._finish)
+
+    def _finish(self):
+        if self._stopped and not self._stopped.done():
+            self._stopped.set_result(None)
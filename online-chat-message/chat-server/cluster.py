@@ -0,0 +1,235 @@
+"""
+マルチプロセス構成でルーム状態を共有するモジュール
+各ワーカーはSO_REUSEPORTで同じTCP/UDPポートを待ち受け、
+親プロセスのハブを経由してルームの作成・参加などのイベントを互いに複製します
+
+作成・参加の応答は、他の全ワーカーがそこまでのイベントを適用したことをハブ経由で確認してから返すため
+（ClusterNode.wait_replicated）、応答を受け取ったクライアントはどのワーカーにも参加・送信できます
+"""
+
+import itertools
+import multiprocessing
+import threading
+from datetime import datetime
+from multiprocessing.connection import wait
+from models import ClientInfo
+from server_log import get_logger
+
+log = get_logger('cluster')
+
+
+class ClusterHub:
+    """親プロセスで動作し、ワーカーから届いたイベントを他の全ワーカーへ中継する
+
+    確認付きのイベント (event, args, seq) は他のワーカーが適用して返す 'ack' を数え、
+    全員から届いたら送信元に 'acked' を返します。
+    """
+
+    def __init__(self, connections):
+        self.connections = list(connections)
+        self.ids = {conn: index for index, conn in enumerate(self.connections)}
+        self.pending = {}  # (送信元のワーカー番号, seq) -> 確認待ちの接続の集合
+
+    def start(self):
+        """中継スレッドを起動"""
+        thread = threading.Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def run(self):
+        """イベント中継ループ"""
+        while self.connections:
+            for conn in wait(self.connections):
+                try:
+                    message = conn.recv()
+                except (EOFError, OSError):
+                    self.disconnect(conn)
+                    continue
+                if message[0] == 'ack':
+                    self.acknowledge(conn, tuple(message[1][0]))
+                elif len(message) == 3:
+                    event, args, seq = message
+                    key = (self.ids[conn], seq)
+                    waiting = self.pending[key] = set()
+                    for other in self.connections:
+                        if other is not conn and self.send(other, (event, args, key)):
+                            waiting.add(other)
+                    self.acknowledge(None, key)
+                else:
+                    for other in self.connections:
+                        if other is not conn:
+                            self.send(other, message)
+
+    def send(self, conn, message):
+        try:
+            conn.send(message)
+            return True
+        except OSError:
+            return False
+
+    def acknowledge(self, conn, key):
+        """connからの確認を記録し、全員そろったら送信元へ通知"""
+        waiting = self.pending.get(key)
+        if waiting is None:
+            return
+        waiting.discard(conn)
+        if not waiting:
+            del self.pending[key]
+            origin = self.connections_by_id().get(key[0])
+            if origin is not None:
+                self.send(origin, ('acked', (key[1],)))
+
+    def connections_by_id(self):
+        return {self.ids[conn]: conn for conn in self.connections}
+
+    def disconnect(self, conn):
+        """終了したワーカーを外し、そのワーカーの確認を待っていたイベントを完了させる"""
+        self.connections.remove(conn)
+        for key, waiting in list(self.pending.items()):
+            if conn in waiting:
+                self.acknowledge(conn, key)
+
+
+class ClusterNode:
+    """ワーカープロセス側でルーム状態の変更を送受信する"""
+
+    def __init__(self, conn, tcp_server, touch_interval=5):
+        self.conn = conn
+        self.tcp_server = tcp_server
+        self.touch_interval = touch_interval
+        self.send_lock = threading.Lock()
+        self.touched = set()
+        self.sequence = itertools.count()
+        self.waiters = {}  # seq -> 確認を待つthreading.Event
+        self.udp_server = None  # 他のワーカー宛ての再送要求に答えるUDPサーバー
+
+    def start(self):
+        """受信スレッドと最終活動時刻の同期スレッドを起動"""
+        for target in (self.receive_loop, self.flush_loop):
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+
+    def publish(self, event, *args):
+        """イベントを他のワーカーへ送信"""
+        with self.send_lock:
+            self.conn.send((event, args))
+
+    def wait_replicated(self, timeout=5.0):
+        """ここまでに送ったイベントを他の全ワーカーが適用するまで待つ（確認できればTrue）"""
+        seq = next(self.sequence)
+        done = self.waiters[seq] = threading.Event()
+        try:
+            with self.send_lock:
+                self.conn.send(('sync', (), seq))
+            if done.wait(timeout):
+                return True
+            log.warning('replication_timeout', seq=seq, timeout=timeout)
+            return False
+        finally:
+            self.waiters.pop(seq, None)
+
+    def touch(self, room_id, token):
+        """メッセージ受信を記録（まとめて他のワーカーへ通知する）"""
+        self.touched.add((room_id, token))
+
+    def flush_loop(self):
+        """最終活動時刻を一定間隔でまとめて通知"""
+        while True:
+            threading.Event().wait(self.touch_interval)
+            touched, self.touched = self.touched, set()
+            if touched:
+                self.publish('touch', list(touched))
+
+    def receive_loop(self):
+        """他のワーカーからのイベントを適用"""
+        while True:
+            try:
+                message = self.conn.recv()
+            except (EOFError, OSError):
+                return
+            event, args = message[0], message[1]
+            try:
+                getattr(self, f'on_{event}')(*args)
+            except Exception as e:
+                log.exception('event_error', cluster_event=event, error=str(e))
+            if len(message) == 3:
+                # 確認付きのイベント: 適用したことをハブに返す
+                self.publish('ack', message[2])
+
+    def on_sync(self):
+        pass
+
+    def on_acked(self, seq):
+        done = self.waiters.get(seq)
+        if done:
+            done.set()
+
+    def on_room_created(self, room_id, name, coalesce_delay=0.0, reliable=False):
+        room = self.tcp_server.new_room(name, room_id=room_id, coalesce_delay=coalesce_delay,
+                                        reliable=reliable)
+        self.tcp_server.register_room(room, replicate=False)
+
+    def on_client_joined(self, room_id, token, username, address, is_host, tagged=False):
+        room = self.tcp_server.rooms.get(room_id)
+        if room is None:
+            return
+        client_info = ClientInfo(
+            address=address,
+            last_message_time=datetime.now(),
+            username=username,
+            tagged=tagged
+        )
+        self.tcp_server.register_client(room, token, client_info, is_host=is_host, replicate=False)
+
+    def on_address(self, room_id, token, address):
+        room = self.tcp_server.rooms.get(room_id)
+        if room and token in room.clients:
+            room.update_client_address(token, address)
+
+    def on_touch(self, entries):
+        for room_id, token in entries:
+            room = self.tcp_server.rooms.get(room_id)
+            if room and token in room.clients:
+                client_info = room.clients[token]
+                client_info.update_message_time()
+                self.tcp_server.room_index.touch(room, client_info.last_active)
+
+    def on_client_removed(self, room_id, token):
+        self.tcp_server.unregister_client(room_id, token, replicate=False)
+
+    def on_room_removed(self, room_id):
+        self.tcp_server.remove_room(room_id, replicate=False)
+
+    def on_nack(self, room_id, stream, ranges, address, tagged=False, token=None):
+        # 連番はワーカーごとなので、このワーカーが配信したストリームへの要求にだけ答える
+        room = self.tcp_server.rooms.get(room_id)
+        if room and stream == self.tcp_server.worker_index and self.udp_server:
+            self.udp_server.retransmit(room, ranges, address, room.tag if tagged else b'', token)
+
+
+def run_workers(count, target, **kwargs):
+    """count個のワーカープロセスを起動し、ハブでルーム状態を中継する
+
+    targetはcluster_conn引数でワーカー側のパイプを、worker_index引数で0から始まる番号を受け取ります。
+    """
+    processes = []
+    hub_connections = []
+    for index in range(count):
+        hub_conn, worker_conn = multiprocessing.Pipe()
+        process = multiprocessing.Process(target=target, kwargs=dict(kwargs, cluster_conn=worker_conn,
+                                                                     worker_index=index))
+        process.start()
+        worker_conn.close()
+        processes.append(process)
+        hub_connections.append(hub_conn)
+
+    ClusterHub(hub_connections).start()
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        log.info('shutting_down', workers=len(processes))
+        for process in processes:
+            process.terminate()
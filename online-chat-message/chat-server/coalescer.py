@@ -0,0 +1,149 @@
+"""
+まとめ送信（Nagle方式のバッチ）が有効なルームのメッセージを短時間ためて配信するモジュール
+ルームの最初のメッセージからcoalesce_delay秒以内に届いたメッセージを
+1つのデータグラム（common/udp_batch.pyの形式）にまとめ、送信回数とパケット数を減らします
+"""
+
+import os
+import sys
+import threading
+import time
+from server_log import get_logger
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'common'))
+
+from udp_batch import (BATCH_HEADER_SIZE, FRAME_OVERHEAD, MAX_DATAGRAM_SIZE, MAX_FRAMES,
+                       encode_batch)
+from udp_reliable import encode_ack
+
+log = get_logger('coalescer')
+
+
+class PendingBatch:
+    """ルームごとの送信待ちメッセージ"""
+
+    __slots__ = ('room', 'deadline', 'frames', 'size')
+
+    def __init__(self, room, deadline):
+        self.room = room
+        self.deadline = deadline
+        self.frames = []  # (送信者のトークン, "ユーザー名: 本文")
+        self.size = BATCH_HEADER_SIZE
+
+
+class RoomCoalescer:
+    """ルームごとにメッセージをためて、期限が来るか満杯になったらまとめて配信する
+
+    送信者には自分のメッセージを除いた（信頼性モードのルームでは連番の通知に置き換えた）データグラムを
+    別に送ります（それ以外の全員には同じデータグラム）。
+    期限の管理は1つのスレッドで行い、満杯になったバッチは追加した側のスレッドで送信します。
+    """
+
+    def __init__(self, server):
+        self.server = server  # UDPServer（relayで送信する）
+        self.metrics = server.metrics
+        self.pending = {}  # ルームID -> PendingBatch
+        self.lock = threading.Lock()
+        self.wakeup = threading.Condition(self.lock)
+        self.running = False
+
+    def start(self):
+        """期限の来たバッチを送信するスレッドを起動"""
+        self.running = True
+        thread = threading.Thread(target=self.flush_loop)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        with self.lock:
+            self.running = False
+            self.wakeup.notify()
+
+    def add(self, room, token, frame):
+        """メッセージをルームのバッチに追加（1つのデータグラムに収まらない大きさならFalse）"""
+        limit = MAX_DATAGRAM_SIZE - len(room.tag)  # タグ付きで配信しても上限に収まる大きさ
+        if BATCH_HEADER_SIZE + FRAME_OVERHEAD + len(frame) > limit:
+            return False
+        full = None
+        with self.lock:
+            batch = self.pending.get(room.id)
+            if batch is not None and (batch.size + FRAME_OVERHEAD + len(frame) > limit
+                                      or len(batch.frames) >= MAX_FRAMES):
+                full = self.pending.pop(room.id)
+                batch = None
+            if batch is None:
+                batch = self.pending[room.id] = PendingBatch(room, time.monotonic() + room.coalesce_delay)
+                self.wakeup.notify()
+            batch.frames.append((token, frame))
+            batch.size += FRAME_OVERHEAD + len(frame)
+        if full is not None:
+            self.flush(full)
+        return True
+
+    def flush_loop(self):
+        """期限の来たバッチを送信"""
+        while True:
+            with self.lock:
+                if not self.running:
+                    return
+                now = time.monotonic()
+                due = [batch for batch in self.pending.values() if batch.deadline <= now]
+                if not due:
+                    timeout = min((batch.deadline for batch in self.pending.values()), default=None)
+                    self.wakeup.wait(None if timeout is None else timeout - now)
+                    continue
+                for batch in due:
+                    del self.pending[batch.room.id]
+            for batch in due:
+                try:
+                    self.flush(batch)
+                except Exception as e:
+                    log.exception('flush_error', room_id=batch.room.id, error=str(e))
+
+    def flush(self, batch):
+        """バッチをルームの全員へ送信（ルームタグを付けるクライアントには別に送る）"""
+        room = batch.room
+        acked = room.retransmit is not None
+        self.flush_to(batch.frames, *room.recipient_list(), b'', acked)
+        tagged, positions = room.tagged_recipient_list()
+        if tagged:
+            self.flush_to(batch.frames, tagged, positions, room.tag, acked)
+        if len(batch.frames) > 1:
+            self.metrics.udp_batches.inc()
+            self.metrics.udp_coalesced.inc(len(batch.frames))
+
+    def flush_to(self, frames, addresses, positions, tag, acked=False):
+        """フレームをaddressesへ送信
+
+        送信者には自分のメッセージを除いたもの（ackedなら自分のメッセージを連番の通知に置き換えたもの）を送ります。
+        """
+        relay = self.server.relay
+        if len(frames) == 1:
+            token, frame = frames[0]
+            index = positions.get(token)
+            relay(tag + frame, addresses, index)
+            if acked and index is not None:
+                relay(tag + encode_ack(frame), (addresses[index],))
+            return
+
+        senders = {}  # バッチ内のメッセージの送信者 -> 配信先リスト内の位置
+        for token, _ in frames:
+            index = positions.get(token)
+            if index is not None:
+                senders[token] = index
+        if senders:
+            skip = set(senders.values())
+            targets = [address for index, address in enumerate(addresses) if index not in skip]
+        else:
+            targets = addresses
+        relay(tag + encode_batch([frame for _, frame in frames]), targets)
+        datagrams = len(targets)
+        for token, index in senders.items():
+            if acked:
+                others = [frame if sender != token else encode_ack(frame) for sender, frame in frames]
+            else:
+                others = [frame for sender, frame in frames if sender != token]
+            if others:
+                relay(tag + (encode_batch(others) if len(others) > 1 else others[0]), (addresses[index],))
+                datagrams += 1
+        self.metrics.udp_batch_datagrams.inc(datagrams)
@@ -0,0 +1,90 @@
+"""
+非アクティブなクライアントを検出するタイミングホイール
+全クライアントを毎回走査する代わりに、期限が来たスロットのクライアントだけを確認します
+"""
+
+import threading
+import time
+
+
+class TimingWheel:
+    """一定間隔(resolution秒)のスロットを持つハッシュ式タイミングホイール
+
+    期限がホイール1周より先のエントリは、該当スロットを通過するたびに
+    期限を確認して次の周回まで残します。
+    """
+
+    def __init__(self, resolution=1.0, slots=512):
+        self.resolution = resolution
+        self.slots = [[] for _ in range(slots)]
+        self.current_tick = int(time.monotonic() / resolution)
+        self.size = 0
+
+    def schedule(self, item, deadline):
+        """deadline（time.monotonic基準）にitemを登録"""
+        tick = max(int(deadline / self.resolution), self.current_tick + 1)
+        self.slots[tick % len(self.slots)].append((deadline, item))
+        self.size += 1
+
+    def advance(self, now=None):
+        """nowまでに期限を迎えたitemのリストを返す"""
+        now = time.monotonic() if now is None else now
+        target = int(now / self.resolution)
+        expired = []
+        # 長時間呼ばれなかった場合でもホイール1周分を処理すれば全スロットを確認できる
+        start = max(self.current_tick + 1, target - len(self.slots) + 1)
+        for tick in range(start, target + 1):
+            index = tick % len(self.slots)
+            slot = self.slots[index]
+            if not slot:
+                continue
+            remaining = []
+            for entry in slot:
+                if entry[0] <= now:
+                    expired.append(entry[1])
+                else:
+                    remaining.append(entry)
+            self.slots[index] = remaining
+            self.size -= len(slot) - len(remaining)
+        self.current_tick = max(self.current_tick, target)
+        return expired
+
+
+class ExpiryIndex:
+    """クライアントの最終活動時刻からタイムアウトを判定するインデックス
+
+    ClientInfo.update_message_timeは最終活動時刻を記録するだけで、
+    ホイール上の期限は動かしません。期限が来た時点で最終活動時刻を確認し、
+    その後に活動していれば新しい期限で登録し直します。
+    """
+
+    def __init__(self, timeout=180.0, resolution=1.0):
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        slots = max(1, int(timeout / resolution) + 1)
+        self.wheel = TimingWheel(resolution, slots)
+
+    def track(self, room_id, token, client_info):
+        """クライアントを監視対象に追加"""
+        with self.lock:
+            self.wheel.schedule((room_id, token, client_info),
+                                client_info.last_active + self.timeout)
+
+    def expired(self, rooms, now=None):
+        """タイムアウトしたクライアントの (room_id, token) のリストを返す"""
+        now = time.monotonic() if now is None else now
+        result = []
+        with self.lock:
+            for room_id, token, client_info in self.wheel.advance(now):
+                room = rooms.get(room_id)
+                if room is None or room.clients.get(token) is not client_info:
+                    continue  # 既に退出済み
+                deadline = client_info.last_active + self.timeout
+                if deadline > now:
+                    self.wheel.schedule((room_id, token, client_info), deadline)
+                else:
+                    result.append((room_id, token))
+        return result
+
+    def __len__(self):
+        return self.wheel.size
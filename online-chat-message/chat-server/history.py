@@ -0,0 +1,160 @@
+"""
+ルームのメッセージ履歴を保持するモジュール
+件数とバイト数の上限を持つリングバッファで、上限を超えると古いメッセージから破棄します
+"""
+
+import sys
+import threading
+import time
+from collections import deque
+from itertools import islice
+
+DEFAULT_MAX_MESSAGES = 1000
+DEFAULT_MAX_BYTES = 256 * 1024       # ルームごとの上限
+DEFAULT_TOTAL_BYTES = 64 * 1024 * 1024  # サーバー全体の上限
+
+
+class MessageRecord:
+    """履歴の1メッセージ（本文はUTF-8のバイト列、時刻はエポックミリ秒）"""
+    __slots__ = ('sender', 'content', 'timestamp')
+
+    def __init__(self, sender, content, timestamp):
+        self.sender = sender
+        self.content = content
+        self.timestamp = timestamp
+
+    @property
+    def size(self):
+        """このメッセージが使うおおよそのバイト数"""
+        return RECORD_OVERHEAD + len(self.content)
+
+    def to_dict(self):
+        return {
+            "sender": self.sender,
+            "content": self.content.decode('utf-8', errors='replace'),
+            "timestamp": self.timestamp,
+        }
+
+
+# レコード本体・本文のbytesオブジェクト・時刻のintと、両端キューの参照の分
+RECORD_OVERHEAD = (sys.getsizeof(MessageRecord('', b'', 0)) + sys.getsizeof(b'')
+                   + sys.getsizeof(2 ** 40) + 2 * 8)
+
+
+def now_millis():
+    """現在時刻（エポックミリ秒）"""
+    return time.time_ns() // 1_000_000
+
+
+class HistoryBudget:
+    """全ルームの履歴で共有するバイト数の上限
+
+    追加された順番にどの履歴のメッセージかを記録しておき、
+    上限を超えたときはサーバー全体で最も古いメッセージから破棄します。
+    """
+
+    def __init__(self, max_bytes=DEFAULT_TOTAL_BYTES):
+        self.max_bytes = max_bytes
+        self.used = 0
+        self.live = 0  # 保持中のメッセージ数
+        self.lock = threading.Lock()
+        self.order = deque()  # 追加順のMessageHistory
+
+    def charge(self, history, size):
+        """履歴への追加を記録し、上限を超えた分を古い順に破棄（lock取得済みで呼ぶ）"""
+        self.used += size
+        self.live += 1
+        self.order.append(history)
+        while self.used > self.max_bytes and self.order:
+            oldest = self.order.popleft()
+            if oldest.stale:
+                # 既にルーム側の上限で破棄された分
+                oldest.stale -= 1
+            elif oldest.records:
+                oldest.evict_oldest(from_budget=True)
+        if len(self.order) > 2 * self.live + 1024:
+            self.compact()
+
+    def release(self, size):
+        self.used -= size
+        self.live -= 1
+
+    def compact(self):
+        """破棄済みのメッセージを追加順の記録から取り除く（lock取得済みで呼ぶ）"""
+        order = deque()
+        for history in self.order:
+            if history.stale:
+                history.stale -= 1
+            else:
+                order.append(history)
+        self.order = order
+
+
+class MessageHistory:
+    """ルームごとのメッセージ履歴（件数・バイト数上限付きのリングバッファ）"""
+
+    def __init__(self, max_messages=DEFAULT_MAX_MESSAGES, max_bytes=DEFAULT_MAX_BYTES, budget=None):
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.budget = budget
+        self.lock = budget.lock if budget else threading.Lock()
+        self.records = deque()
+        self.bytes = 0
+        self.evicted = 0
+        self.stale = 0  # budget.orderに残っている、既に破棄済みのメッセージ数
+
+    def append(self, sender, content, timestamp=None):
+        """メッセージを追加（contentはstrまたはUTF-8のbytes）"""
+        if isinstance(content, str):
+            content = content.encode('utf-8')
+        record = MessageRecord(sender, content, timestamp if timestamp is not None else now_millis())
+        with self.lock:
+            self.records.append(record)
+            self.bytes += record.size
+            while len(self.records) > self.max_messages or self.bytes > self.max_bytes:
+                self.evict_oldest()
+            if self.budget:
+                self.budget.charge(self, record.size)
+        return record
+
+    def evict_oldest(self, from_budget=False):
+        """最も古いメッセージを破棄（lock取得済みで呼ぶ）"""
+        record = self.records.popleft()
+        self.bytes -= record.size
+        self.evicted += 1
+        if self.budget:
+            self.budget.release(record.size)
+            if not from_budget:
+                self.stale += 1
+
+    def clear(self):
+        """全メッセージを破棄（ルーム削除時）"""
+        with self.lock:
+            while self.records:
+                self.evict_oldest()
+
+    def latest(self, count):
+        """最新のcount件を古い順で返す"""
+        with self.lock:
+            return list(islice(reversed(self.records), count))[::-1]
+
+    def since(self, timestamp):
+        """timestamp（エポックミリ秒）以降のメッセージを返す"""
+        with self.lock:
+            return [record for record in self.records if record.timestamp >= timestamp]
+
+    def stats(self):
+        """メモリ使用量の統計"""
+        return {
+            'messages': len(self.records),
+            'bytes': self.bytes,
+            'evicted': self.evicted,
+            'max_messages': self.max_messages,
+            'max_bytes': self.max_bytes,
+        }
+
+    def __len__(self):
+        return len(self.records)
+
+    def __iter__(self):
+        return iter(self.latest(len(self.records)))
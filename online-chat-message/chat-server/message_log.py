@@ -0,0 +1,301 @@
+"""
+ルームのメッセージを追記専用のセグメントファイルに保存するモジュール
+書き込みは専用スレッドでまとめて行い、読み出しはmmapで必要な範囲だけを走査します
+
+レコード形式（リトルエンディアン）:
+    timestamp(8) | sender_len(2) | content_len(4) | sender | content | record_len(4)
+末尾のrecord_lenを使って、ファイルの末尾から逆方向にも読み進められます。
+"""
+
+import mmap
+import os
+import queue
+import struct
+import threading
+from collections import OrderedDict
+from history import MessageRecord
+from server_log import get_logger
+
+log = get_logger('message_log')
+
+RECORD_HEADER = struct.Struct('<qHI')
+RECORD_TRAILER = struct.Struct('<I')
+RECORD_FRAMING = RECORD_HEADER.size + RECORD_TRAILER.size
+SEGMENT_SUFFIX = '.log'
+DEFAULT_SEGMENT_BYTES = 16 * 1024 * 1024
+DEFAULT_MAX_OPEN_FILES = 256  # 同時に開いておくセグメントファイル数の上限
+
+
+def encode_record(sender, content, timestamp):
+    """1件のレコードをバイト列に変換"""
+    sender_bytes = sender.encode('utf-8') if isinstance(sender, str) else sender
+    content_bytes = content.encode('utf-8') if isinstance(content, str) else content
+    total = RECORD_FRAMING + len(sender_bytes) + len(content_bytes)
+    return b''.join((RECORD_HEADER.pack(timestamp, len(sender_bytes), len(content_bytes)),
+                     sender_bytes, content_bytes, RECORD_TRAILER.pack(total)))
+
+
+def segment_name(index):
+    return f'{index:010d}{SEGMENT_SUFFIX}'
+
+
+def list_segments(room_dir):
+    """ルームのセグメントファイルを古い順に返す"""
+    try:
+        names = os.listdir(room_dir)
+    except FileNotFoundError:
+        return []
+    return [os.path.join(room_dir, name) for name in sorted(names) if name.endswith(SEGMENT_SUFFIX)]
+
+
+class RoomLogWriter:
+    """1ルーム分のセグメントファイルへの追記
+
+    バッチごとに1回のwriteでO_APPENDのファイルへ書き込むため、
+    --workersで複数プロセスが同じルームに書き込んでもレコードは混ざりません。
+    """
+
+    def __init__(self, room_dir, segment_bytes):
+        self.room_dir = room_dir
+        self.segment_bytes = segment_bytes
+        os.makedirs(room_dir, exist_ok=True)
+        self.index = self.last_index()
+        self.file = self.open_segment()
+
+    def last_index(self):
+        segments = list_segments(self.room_dir)
+        return int(os.path.basename(segments[-1])[:-len(SEGMENT_SUFFIX)]) if segments else 0
+
+    def open_segment(self):
+        return open(os.path.join(self.room_dir, segment_name(self.index)), 'ab', buffering=0)
+
+    def write(self, data):
+        size = os.fstat(self.file.fileno()).st_size
+        if size and size + len(data) > self.segment_bytes:
+            self.roll()
+        self.file.write(data)
+
+    def roll(self):
+        """新しいセグメントへ切り替え（他のプロセスが先に切り替えていればそれを使う）"""
+        self.file.close()
+        latest = self.last_index()
+        self.index = latest if latest > self.index else self.index + 1
+        self.file = self.open_segment()
+
+    def close(self):
+        self.file.close()
+
+
+class MessageLog:
+    """全ルームのメッセージログ
+
+    append()はキューに積むだけで戻り、書き込みスレッドが溜まった分を
+    ルームごとにまとめてファイルへ書き出します。
+    開いておくファイルは最近書き込んだmax_open_filesルーム分までで、それより古いものは閉じます
+    （多数のルームでファイルディスクリプタを使い切らないため）。
+    """
+
+    def __init__(self, log_dir, segment_bytes=DEFAULT_SEGMENT_BYTES, batch_size=1024,
+                 max_open_files=DEFAULT_MAX_OPEN_FILES):
+        self.log_dir = log_dir
+        self.segment_bytes = segment_bytes
+        self.batch_size = batch_size
+        self.max_open_files = max_open_files
+        self.queue = queue.SimpleQueue()
+        self.writers = OrderedDict()  # room_id -> RoomLogWriter（最近書き込んだ順）
+        self.written = 0
+        os.makedirs(log_dir, exist_ok=True)
+        self.thread = threading.Thread(target=self.write_loop)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def room_dir(self, room_id):
+        return os.path.join(self.log_dir, room_id)
+
+    def append(self, room_id, record):
+        """MessageRecordを書き込み待ちに追加"""
+        self.queue.put((room_id, record))
+
+    def close_room(self, room_id):
+        """ルームのファイルを閉じる（ログ自体は残す）"""
+        self.queue.put((room_id, None))
+
+    def flush(self):
+        """書き込み待ちがすべてファイルへ書き出されるまで待つ"""
+        done = threading.Event()
+        self.queue.put((None, done))
+        done.wait()
+
+    def write_loop(self):
+        """書き込みスレッド"""
+        while True:
+            batch = [self.queue.get()]
+            try:
+                while len(batch) < self.batch_size:
+                    batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                pass
+            self.write_batch(batch)
+
+    def write_batch(self, batch):
+        pending = {}  # room_id -> [エンコード済みレコード]
+        waiters = []
+        for room_id, record in batch:
+            if room_id is None:
+                waiters.append(record)
+            elif record is None:
+                self.flush_pending(pending)
+                pending = {}
+                writer = self.writers.pop(room_id, None)
+                if writer:
+                    writer.close()
+            else:
+                pending.setdefault(room_id, []).append(
+                    encode_record(record.sender, record.content, record.timestamp))
+        self.flush_pending(pending)
+        for waiter in waiters:
+            waiter.set()
+
+    def flush_pending(self, pending):
+        for room_id, records in pending.items():
+            try:
+                writer = self.writers.get(room_id)
+                if writer is None:
+                    while len(self.writers) >= self.max_open_files:
+                        self.writers.popitem(last=False)[1].close()
+                    writer = self.writers[room_id] = RoomLogWriter(self.room_dir(room_id),
+                                                                   self.segment_bytes)
+                else:
+                    self.writers.move_to_end(room_id)
+                writer.write(b''.join(records))
+                self.written += len(records)
+            except OSError as e:
+                log.error('write_error', room_id=room_id, error=str(e))
+
+    def reader(self, room_id):
+        """ルームのログを読み出すRoomLogReaderを取得"""
+        return RoomLogReader(self.room_dir(room_id))
+
+
+class RoomLogReader:
+    """mmapでルームのログを読み出す"""
+
+    def __init__(self, room_dir):
+        self.room_dir = room_dir
+        self.sender_cache = {}
+
+    def _map(self, path):
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if size == 0:
+                return None
+            return mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+
+    def _sender(self, raw):
+        sender = self.sender_cache.get(raw)
+        if sender is None:
+            sender = self.sender_cache[raw] = raw.decode('utf-8', errors='replace')
+        return sender
+
+    def _iter_records(self, data, offset=0):
+        """offsetから末尾までのレコードを (timestamp, sender_bytes, content) で順に返す
+
+        ヘッダーはstruct.unpack_fromでその場で読み、送信者と本文だけをコピーします。
+        """
+        unpack = RECORD_HEADER.unpack_from
+        header_size = RECORD_HEADER.size
+        trailer_size = RECORD_TRAILER.size
+        end = len(data)
+        limit = end - RECORD_FRAMING
+        while offset <= limit:
+            timestamp, sender_len, content_len = unpack(data, offset)
+            start = offset + header_size
+            content_start = start + sender_len
+            content_end = content_start + content_len
+            offset = content_end + trailer_size
+            if offset > end:
+                break  # 書き込み途中のレコード
+            yield timestamp, data[start:content_start], data[content_start:content_end]
+
+    def _scan(self, mm, offset=0):
+        """offsetから末尾までのレコードのリスト"""
+        return list(self._iter_records(mm, offset))
+
+    def _to_record(self, raw):
+        timestamp, sender, content = raw
+        return MessageRecord(self._sender(sender), content, timestamp)
+
+    def _record_offsets_backward(self, mm, count):
+        """末尾から最大count件のレコードの開始位置を返す（新しい順）"""
+        offsets = []
+        offset = len(mm)
+        while offset >= RECORD_FRAMING and len(offsets) < count:
+            (total,) = RECORD_TRAILER.unpack_from(mm, offset - RECORD_TRAILER.size)
+            if total < RECORD_FRAMING or total > offset:
+                break
+            offset -= total
+            offsets.append(offset)
+        return offsets
+
+    def replay(self):
+        """全メッセージを古い順に返すジェネレータ
+
+        大量のレコードを速く読み出すため、MessageRecordではなく
+        (timestamp, sender_bytes, content) のタプルを返します。
+        セグメントは先頭から最後まで読むため、mmapではなく1回のreadで読み込み、
+        レコードをリストにためずに1件ずつ返します。
+        """
+        for path in list_segments(self.room_dir):
+            with open(path, 'rb') as f:
+                data = f.read()
+            yield from self._iter_records(data)
+
+    def latest(self, count):
+        """最新のcount件を古い順で返す"""
+        result = []
+        for path in reversed(list_segments(self.room_dir)):
+            if len(result) >= count:
+                break
+            mm = self._map(path)
+            if mm is None:
+                continue
+            try:
+                offsets = self._record_offsets_backward(mm, count - len(result))
+                if offsets:
+                    result = [self._to_record(raw) for raw in self._scan(mm, offsets[-1])] + result
+            finally:
+                mm.close()
+        return result[-count:] if count else []
+
+    def since(self, timestamp):
+        """timestamp（エポックミリ秒）以降のメッセージを古い順で返す
+
+        タイムスタンプはルーム内で単調増加するため、末尾から逆方向に
+        timestampより古いレコードが見つかるまでだけを読みます。
+        """
+        result = []
+        for path in reversed(list_segments(self.room_dir)):
+            mm = self._map(path)
+            if mm is None:
+                continue
+            try:
+                offset, complete = self._offset_since(mm, timestamp)
+                result = [self._to_record(raw) for raw in self._scan(mm, offset)] + result
+            finally:
+                mm.close()
+            if complete:
+                break
+        return result
+
+    def _offset_since(self, mm, timestamp):
+        """timestamp以降の最初のレコード位置と、それより古いレコードがこのセグメントにあるかを返す"""
+        offset = len(mm)
+        while offset >= RECORD_FRAMING:
+            (total,) = RECORD_TRAILER.unpack_from(mm, offset - RECORD_TRAILER.size)
+            if total < RECORD_FRAMING or total > offset:
+                break
+            start = offset - total
+            if RECORD_HEADER.unpack_from(mm, start)[0] < timestamp:
+                return offset, True
+            offset = start
+        return offset, False
@@ -0,0 +1,335 @@
+"""
+サーバーの計測値（カウンター・ヒストグラム・ゲージ）とPrometheusテキスト形式での公開
+記録はスレッドごとの領域に対して行うためロックを取らず、読み出し時に全スレッド分を合計します
+"""
+
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# HDR形式のヒストグラム: 2のべき乗の区間をそれぞれSUB_BUCKETS個に等分（相対誤差 約1/16）
+# 記録できる値は0以上2**64未満の整数
+SUB_BUCKET_BITS = 4
+SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+BUCKET_COUNT = (64 - SUB_BUCKET_BITS + 1) * SUB_BUCKETS
+
+# Prometheusに公開するバケットの上限（1-2-5系列、記録単位で指定）
+LATENCY_BOUNDS_NS = [m * 10 ** e for e in range(3, 10) for m in (1, 2, 5)]  # 1us〜5s
+SIZE_BOUNDS = [m * 10 ** e for e in range(0, 5) for m in (1, 2, 5)]  # 1〜50000
+QUANTILES = (0.5, 0.9, 0.99, 0.999)
+
+
+def bucket_index(value):
+    """値（0以上の整数）のバケット番号"""
+    if value < SUB_BUCKETS:
+        return value if value > 0 else 0
+    shift = value.bit_length() - 1 - SUB_BUCKET_BITS
+    return ((shift + 1) << SUB_BUCKET_BITS) + (value >> shift) - SUB_BUCKETS
+
+
+def bucket_upper(index):
+    """バケットに入る値の上限（この値未満）"""
+    if index < SUB_BUCKETS:
+        return index + 1
+    shift = (index >> SUB_BUCKET_BITS) - 1
+    return ((index & (SUB_BUCKETS - 1)) + SUB_BUCKETS + 1) << shift
+
+
+def format_value(value):
+    """整数は桁を落とさずにそのまま、小数は最短の表現で出力"""
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in labels) + '}'
+
+
+class Counter:
+    """単調増加するカウンター（スレッドごとに加算し、読み出し時に合計）"""
+
+    def __init__(self, name, help_text, labels=None):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(sorted((labels or {}).items()))
+        self._local = threading.local()
+        self._cells = []
+        self._lock = threading.Lock()  # スレッドの初回登録時だけ使う
+
+    def _cell(self):
+        cell = [0]
+        with self._lock:
+            self._cells.append(cell)
+        self._local.cell = cell
+        return cell
+
+    def inc(self, amount=1):
+        try:
+            self._local.cell[0] += amount
+        except AttributeError:
+            self._cell()[0] += amount
+
+    @property
+    def value(self):
+        return sum(cell[0] for cell in list(self._cells))
+
+    def samples(self):
+        yield self.name + '_total', self.labels, self.value
+
+
+class HistogramState:
+    __slots__ = ('counts', 'total', 'max')
+
+    def __init__(self):
+        self.counts = [0] * BUCKET_COUNT
+        self.total = 0
+        self.max = 0
+
+
+class Histogram:
+    """HDR形式のヒストグラム（整数値を記録し、公開時にscaleを掛ける）
+
+    記録は固定長配列の1要素を増やすだけで、公開時にbounds区切りの累積バケットと
+    分位点（QUANTILES）に変換します。
+    """
+
+    def __init__(self, name, help_text, bounds, scale=1.0, labels=None):
+        self.name = name
+        self.help = help_text
+        self.bounds = bounds
+        self.scale = scale
+        self.labels = tuple(sorted((labels or {}).items()))
+        self._local = threading.local()
+        self._states = []
+        self._lock = threading.Lock()
+
+    def _state(self):
+        state = HistogramState()
+        with self._lock:
+            self._states.append(state)
+        self._local.state = state
+        return state
+
+    def record(self, value):
+        try:
+            state = self._local.state
+        except AttributeError:
+            state = self._state()
+        # bucket_index()を展開（記録はパケットごとに呼ばれるため）
+        if value < SUB_BUCKETS:
+            state.counts[value if value > 0 else 0] += 1
+        else:
+            shift = value.bit_length() - 1 - SUB_BUCKET_BITS
+            state.counts[((shift + 1) << SUB_BUCKET_BITS) + (value >> shift) - SUB_BUCKETS] += 1
+        state.total += value
+        if value > state.max:
+            state.max = value
+
+    def snapshot(self):
+        """全スレッド分を合計した (バケット配列, 合計, 件数, 最大値)"""
+        counts = [0] * BUCKET_COUNT
+        total = count = maximum = 0
+        for state in list(self._states):
+            for index, n in enumerate(state.counts):
+                if n:
+                    counts[index] += n
+            total += state.total
+            maximum = max(maximum, state.max)
+        return counts, total, sum(counts), maximum
+
+    def percentile(self, p, snapshot=None):
+        counts, _, count, maximum = snapshot or self.snapshot()
+        if not count:
+            return 0
+        target = p * count
+        seen = 0
+        for index, n in enumerate(counts):
+            seen += n
+            if n and seen >= target:
+                return min(bucket_upper(index), maximum)
+        return maximum
+
+    def samples(self):
+        snapshot = self.snapshot()
+        counts, total, count, _ = snapshot
+        cumulative = 0
+        index = 0
+        for bound in self.bounds:
+            # bound以下の値だけが入るバケットまでを累積（境界をまたぐバケットは次の区間に数える）
+            while index < BUCKET_COUNT and bucket_upper(index) <= bound + 1:
+                cumulative += counts[index]
+                index += 1
+            yield self.name + '_bucket', self.labels + (('le', f'{bound * self.scale:g}'),), cumulative
+        yield self.name + '_bucket', self.labels + (('le', '+Inf'),), count
+        yield self.name + '_sum', self.labels, total * self.scale
+        yield self.name + '_count', self.labels, count
+
+    def quantile_samples(self):
+        snapshot = self.snapshot()
+        for q in QUANTILES:
+            yield (self.name + '_quantile', self.labels + (('quantile', str(q)),),
+                   self.percentile(q, snapshot) * self.scale)
+
+
+class Gauge:
+    """読み出し時に関数を呼んで値を得るゲージ"""
+
+    suffix = ''
+
+    def __init__(self, name, help_text, func, labels=None):
+        self.name = name
+        self.help = help_text
+        self.func = func
+        self.labels = tuple(sorted((labels or {}).items()))
+
+    def samples(self):
+        yield self.name + self.suffix, self.labels, self.func()
+
+
+class GaugeSet(Gauge):
+    """読み出し時に関数を呼んで (ラベルの辞書, 値) の組を得るゲージ（ルームごとなどラベルが変わる値に使う）"""
+
+    def samples(self):
+        for labels, value in self.func():
+            yield self.name, self.labels + tuple(sorted(labels.items())), value
+
+
+class CounterFunc(Gauge):
+    """読み出し時に関数を呼んで値を得るカウンター（他の計測値から求められる場合に使う）"""
+
+    suffix = '_total'
+
+
+class Registry:
+    """計測値の登録とPrometheusテキスト形式への変換"""
+
+    def __init__(self):
+        self.families = {}  # name -> (type, help, [metric])
+
+    def _add(self, kind, metric):
+        family = self.families.setdefault(metric.name, (kind, metric.help, []))
+        family[2].append(metric)
+        return metric
+
+    def counter(self, name, help_text, labels=None):
+        return self._add('counter', Counter(name, help_text, labels))
+
+    def histogram(self, name, help_text, bounds, scale=1.0, labels=None):
+        return self._add('histogram', Histogram(name, help_text, bounds, scale, labels))
+
+    def gauge(self, name, help_text, func, labels=None):
+        return self._add('gauge', Gauge(name, help_text, func, labels))
+
+    def gauge_set(self, name, help_text, func, labels=None):
+        return self._add('gauge', GaugeSet(name, help_text, func, labels))
+
+    def counter_func(self, name, help_text, func, labels=None):
+        return self._add('counter', CounterFunc(name, help_text, func, labels))
+
+    def render(self):
+        """Prometheusテキスト形式（version 0.0.4）の文字列"""
+        lines = []
+        quantiles = []
+        for name, (kind, help_text, metrics) in list(self.families.items()):
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            for metric in metrics:
+                for sample_name, labels, value in metric.samples():
+                    lines.append(f'{sample_name}{format_labels(labels)} {format_value(value)}')
+                if kind == 'histogram':
+                    quantiles.append(metric)
+        for metric in quantiles:
+            name = metric.name + '_quantile'
+            lines.append(f'# HELP {name} {metric.help} (quantiles)')
+            lines.append(f'# TYPE {name} gauge')
+            for sample_name, labels, value in metric.quantile_samples():
+                lines.append(f'{sample_name}{format_labels(labels)} {format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+class ServerMetrics:
+    """チャットサーバーの計測値一式（TCPServer.metrics）"""
+
+    def __init__(self):
+        self.registry = registry = Registry()
+        self.udp_received = registry.counter('chat_udp_packets_received', 'UDP packets received')
+        self.udp_dropped = {
+            reason: registry.counter('chat_udp_packets_dropped', 'UDP packets dropped',
+                                     {'reason': reason})
+            for reason in ('invalid_token', 'room_mismatch', 'error', 'queue_full', 'send_buffer',
+                           'rate_token', 'rate_address', 'rate_room')
+        }
+        self.udp_fanout = registry.histogram('chat_udp_fanout', 'Recipients per relayed message',
+                                             SIZE_BOUNDS)
+        # 転送数は配信先数のヒストグラムの合計と同じなので、記録せずに読み出し時に求める
+        registry.counter_func('chat_udp_packets_relayed', 'UDP packets sent to room members',
+                              lambda: self.udp_fanout.snapshot()[1])
+        self.udp_batches = registry.counter('chat_udp_batches', 'Coalesced datagrams built for rooms')
+        self.udp_batch_datagrams = registry.counter('chat_udp_batch_datagrams',
+                                                    'Datagrams sent for coalesced batches')
+        self.udp_coalesced = registry.counter('chat_udp_coalesced_messages',
+                                              'Messages delivered inside coalesced batches')
+        self.udp_nacks = registry.counter('chat_udp_nacks', 'Retransmit requests received from clients')
+        self.udp_retransmitted = registry.counter('chat_udp_retransmitted_frames',
+                                                  'Messages resent in answer to retransmit requests')
+        self.udp_retransmit_missing = registry.counter('chat_udp_retransmit_missing',
+                                                       'Requested messages no longer in the retransmit buffer')
+        self.udp_retransmit_limited = registry.counter('chat_udp_retransmit_limited',
+                                                       'Requested messages not resent because of the rate limit')
+        self.udp_relay_latency = registry.histogram(
+            'chat_udp_relay_latency_seconds', 'Time from packet handling start to relay completion',
+            LATENCY_BOUNDS_NS, scale=1e-9)
+        self.tcp_requests = {
+            op: registry.counter('chat_tcp_requests', 'TCRP requests handled', {'op': op})
+            for op in ('create', 'join', 'list', 'history', 'other')
+        }
+        self.tcp_errors = registry.counter('chat_tcp_errors', 'TCRP connections that ended with an error')
+        self.tcp_connections = registry.counter('chat_tcp_connections', 'TCRP connections accepted')
+        self.tcp_latency = registry.histogram('chat_tcp_request_duration_seconds',
+                                              'TCRP request handling time', LATENCY_BOUNDS_NS, scale=1e-9)
+        self.cleanup_runs = registry.counter('chat_cleanup_runs', 'Inactive client cleanup runs')
+        self.cleanup_expired = registry.counter('chat_cleanup_expired_clients',
+                                                'Clients removed for inactivity')
+        self.cleanup_duration = registry.histogram('chat_cleanup_duration_seconds',
+                                                   'Inactive client cleanup duration',
+                                                   LATENCY_BOUNDS_NS, scale=1e-9)
+
+    def gauge(self, name, help_text, func, labels=None):
+        """サーバーの状態を読み出すゲージを追加"""
+        return self.registry.gauge(name, help_text, func, labels)
+
+    def gauge_set(self, name, help_text, func, labels=None):
+        """ラベルの値が変わる状態（ルームごとなど）を読み出すゲージを追加"""
+        return self.registry.gauge_set(name, help_text, func, labels)
+
+    def render(self):
+        return self.registry.render()
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """GET /metrics でPrometheusテキスト形式を返す"""
+
+    def do_GET(self):
+        if self.path.split('?', 1)[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = self.server.metrics.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # アクセスログは出力しない
+
+
+def serve_metrics(metrics, host='127.0.0.1', port=9100):
+    """計測値のHTTPエンドポイントをデーモンスレッドで起動"""
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    server.metrics = metrics
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
@@ -0,0 +1,224 @@
+"""
+sendmmsg/recvmmsgによるバッチ送受信モジュール
+Linuxのlibcが提供するシステムコールをctypes経由で呼び出します
+利用できない環境ではMMSG_AVAILABLEがFalseになり、呼び出し側は通常のループにフォールバックします
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import socket
+import sys
+
+MAX_DATAGRAM_SIZE = 4096
+MSG_WAITFORONE = 0x10000
+MSG_DONTWAIT = 0x40
+
+
+class iovec(ctypes.Structure):
+    _fields_ = [
+        ('iov_base', ctypes.c_void_p),
+        ('iov_len', ctypes.c_size_t),
+    ]
+
+
+class msghdr(ctypes.Structure):
+    _fields_ = [
+        ('msg_name', ctypes.c_void_p),
+        ('msg_namelen', ctypes.c_uint32),
+        ('msg_iov', ctypes.POINTER(iovec)),
+        ('msg_iovlen', ctypes.c_size_t),
+        ('msg_control', ctypes.c_void_p),
+        ('msg_controllen', ctypes.c_size_t),
+        ('msg_flags', ctypes.c_int),
+    ]
+
+
+class mmsghdr(ctypes.Structure):
+    _fields_ = [
+        ('msg_hdr', msghdr),
+        ('msg_len', ctypes.c_uint),
+    ]
+
+
+SOCKADDR_IN_SIZE = 16
+
+
+def _load_libc():
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or None, use_errno=True)
+        sendmmsg = libc.sendmmsg
+        recvmmsg = libc.recvmmsg
+    except (OSError, AttributeError):
+        return None
+    sendmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(mmsghdr), ctypes.c_uint, ctypes.c_int]
+    sendmmsg.restype = ctypes.c_int
+    recvmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(mmsghdr), ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+    recvmmsg.restype = ctypes.c_int
+    return libc
+
+
+_libc = _load_libc()
+MMSG_AVAILABLE = _libc is not None
+
+
+def pack_sockaddr_in(address):
+    """(host, port) をsockaddr_in構造体のバイト列に変換"""
+    host, port = address[0], address[1]
+    return (socket.AF_INET.to_bytes(2, sys.byteorder) + port.to_bytes(2, 'big')
+            + socket.inet_aton(host) + bytes(8))
+
+
+def unpack_sockaddr_in(raw):
+    """sockaddr_in構造体のバイト列を (host, port) に変換"""
+    return (socket.inet_ntoa(raw[4:8]), int.from_bytes(raw[2:4], 'big'))
+
+
+class MultiSender:
+    """同一データを複数アドレスへsendmmsgでまとめて送信する
+
+    直前に送信したアドレス列と同じオブジェクトが渡された場合は、
+    sockaddr配列を作り直さずにそのまま再利用します。
+    """
+
+    MAX_BATCH = 1024  # 1回のsendmmsgで送れる最大件数（UIO_MAXIOV）
+
+    def __init__(self, capacity=1024):
+        self.iov = iovec()
+        self._sockaddr_cache = {}
+        self._allocate(capacity)
+
+    def _allocate(self, capacity):
+        self.capacity = capacity
+        self.names = ctypes.create_string_buffer(SOCKADDR_IN_SIZE * capacity)
+        self.msgs = (mmsghdr * capacity)()
+        names_base = ctypes.addressof(self.names)
+        iov_pointer = ctypes.pointer(self.iov)
+        for i in range(capacity):
+            hdr = self.msgs[i].msg_hdr
+            hdr.msg_name = names_base + i * SOCKADDR_IN_SIZE
+            hdr.msg_namelen = SOCKADDR_IN_SIZE
+            hdr.msg_iov = iov_pointer
+            hdr.msg_iovlen = 1
+        self._loaded = None
+
+    def _sockaddr(self, address):
+        raw = self._sockaddr_cache.get(address)
+        if raw is None:
+            raw = pack_sockaddr_in(address)
+            if len(self._sockaddr_cache) > 100000:
+                self._sockaddr_cache.clear()
+            self._sockaddr_cache[address] = raw
+        return raw
+
+    def load(self, addresses):
+        """送信先アドレスをsockaddr配列に書き込む"""
+        if addresses is self._loaded:
+            return
+        if len(addresses) > self.capacity:
+            self._allocate(max(len(addresses), self.capacity * 2))
+        sockaddr = self._sockaddr
+        packed = b''.join([sockaddr(a) for a in addresses])
+        ctypes.memmove(self.names, packed, len(packed))
+        self._loaded = addresses
+
+    def sendto_many(self, sock, data, addresses, skip=None):
+        """dataをaddresses全体（skip番目を除く）へ送信し、送信できた件数を返す
+
+        ノンブロッキングソケットで送信バッファが埋まった場合は、その時点までの件数を返します。
+        """
+        buf = ctypes.c_char_p(bytes(data))
+        self.iov.iov_base = ctypes.cast(buf, ctypes.c_void_p)
+        self.iov.iov_len = len(data)
+        self.load(addresses)
+        fd = sock.fileno()
+        total = len(addresses)
+        if skip is None:
+            return self._send_range(fd, 0, total)
+        sent = self._send_range(fd, 0, skip)
+        if sent < skip:
+            return sent
+        return sent + self._send_range(fd, skip + 1, total)
+
+    def _send_range(self, fd, start, end):
+        # start番目からend番目の手前までをMAX_BATCH件ずつ送信する
+        offset = start
+        while offset < end:
+            count = min(end - offset, self.MAX_BATCH)
+            result = self._send_from(fd, offset, count)
+            if result < 0:
+                err = ctypes.get_errno()
+                if err in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                raise OSError(err, f"sendmmsg failed: {err}")
+            offset += result
+        return offset - start
+
+    def _send_from(self, fd, offset, count):
+        start = ctypes.cast(ctypes.byref(self.msgs, offset * ctypes.sizeof(mmsghdr)),
+                            ctypes.POINTER(mmsghdr))
+        return _libc.sendmmsg(fd, start, count, 0)
+
+
+class MultiReceiver:
+    """recvmmsgで複数のデータグラムをまとめて受信する"""
+
+    def __init__(self, capacity=64, size=MAX_DATAGRAM_SIZE):
+        self.capacity = capacity
+        self.size = size
+        self.buffer = ctypes.create_string_buffer(size * capacity)
+        self.names = ctypes.create_string_buffer(SOCKADDR_IN_SIZE * capacity)
+        self.iovs = (iovec * capacity)()
+        self.msgs = (mmsghdr * capacity)()
+        buffer_base = ctypes.addressof(self.buffer)
+        names_base = ctypes.addressof(self.names)
+        for i in range(capacity):
+            self.iovs[i].iov_base = buffer_base + i * size
+            self.iovs[i].iov_len = size
+            hdr = self.msgs[i].msg_hdr
+            hdr.msg_name = names_base + i * SOCKADDR_IN_SIZE
+            hdr.msg_iov = ctypes.pointer(self.iovs[i])
+            hdr.msg_iovlen = 1
+            hdr.msg_namelen = SOCKADDR_IN_SIZE
+        self.view = memoryview(self.buffer).cast('B')
+        self.names_view = memoryview(self.names).cast('B')
+        # msg_lenをctypes経由でなくmemoryviewから直接読むためのビュー
+        self.lengths_view = memoryview(self.msgs).cast('B').cast('I')
+        self.lengths_stride = ctypes.sizeof(mmsghdr) // 4
+        self.lengths_offset = mmsghdr.msg_len.offset // 4
+        self._used = 0
+
+    def recv(self, sock, flags=MSG_WAITFORONE):
+        """受信したデータグラムを (data, address) のリストで返す"""
+        # カーネルが書き換えたアドレス長を前回使った分だけ戻す
+        msgs = self.msgs
+        for i in range(self._used):
+            msgs[i].msg_hdr.msg_namelen = SOCKADDR_IN_SIZE
+        self._used = 0
+        count = _libc.recvmmsg(sock.fileno(), self.msgs, self.capacity, flags, None)
+        if count < 0:
+            err = ctypes.get_errno()
+            if err in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return []
+            raise OSError(err, f"recvmmsg failed: {err}")
+        self._used = count
+        view = self.view
+        names = self.names_view
+        lengths = self.lengths_view
+        stride = self.lengths_stride
+        offset = self.lengths_offset
+        size = self.size
+        addresses = {}
+        result = []
+        for i in range(count):
+            start = i * size
+            data = bytes(view[start:start + lengths[i * stride + offset]])
+            name_start = i * SOCKADDR_IN_SIZE
+            raw = bytes(names[name_start:name_start + SOCKADDR_IN_SIZE])
+            address = addresses.get(raw)
+            if address is None:
+                address = addresses[raw] = unpack_sockaddr_in(raw)
+            result.append((data, address))
+        return result
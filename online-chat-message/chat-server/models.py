@@ -2,9 +2,18 @@
 チャットシステムのデータモデルを定義するモジュール
 """
 
+import itertools
+import time
 import uuid
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from datetime import datetime
+import os
+import sys
+from history import MessageHistory
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'common'))
+
+from udp_batch import room_tag
 
 @dataclass
 class ClientInfo:
@@ -13,25 +22,45 @@ class ClientInfo:
     last_message_time: datetime
     username: str
     is_host: bool = False
+    tagged: bool = False  # 配信にルームタグを付ける（1つのソケットで複数のルームに参加するクライアント）
+    last_active: float = field(default_factory=time.monotonic)  # タイムアウト判定用
+    prefix: bytes = field(init=False, repr=False)  # 配信メッセージの先頭に付ける "username: "
+
+    def __post_init__(self):
+        self.prefix = f"{self.username}: ".encode('utf-8')
     
     def update_message_time(self):
         """最終メッセージ時間を更新"""
         self.last_message_time = datetime.now()
+        self.last_active = time.monotonic()
 
 
 class Room:
     """チャットルームクラス"""
-    def __init__(self, name, password=None):
-        self.id = str(uuid.uuid4())[:8]  # 短いIDを生成
+    def __init__(self, name, password=None, room_id=None, history=None, log=None, coalesce_delay=0.0,
+                 retransmit=None):
+        self.id = room_id or str(uuid.uuid4())[:8]  # 短いIDを生成
+        self.id_bytes = self.id.encode('utf-8')  # UDPパケットとの照合用
+        self.tag = room_tag(self.id_bytes)  # タグ付きで配信するクライアント向けの先頭
         self.name = name
         self.password = password
         self.clients = {}  # token -> ClientInfo
         self.host_token = None
-        self.messages = []
+        self.messages = history if history is not None else MessageHistory()
+        self.log = log  # 永続化用のmessage_log.MessageLog（任意）
+        self.coalesce_delay = coalesce_delay  # まとめ送信の待ち時間（秒、0なら1件ずつ配信）
+        self.retransmit = retransmit  # 信頼性モードの再送バッファ（retransmit.RetransmitBuffer、Noneなら連番なし）
+        # 配信先アドレスのキャッシュ（メンバーやアドレスが変わるまで再利用）
+        # (アドレスのタプル, token -> 位置, タグ付きのアドレスのタプル, タグ付きの位置, 作成時のバージョン)
+        # メンバーかアドレスが変わるたびに増やす（itertools.countのためロックなしで複数スレッドから更新できる）
+        self._versions = itertools.count(1)
+        self._members_version = 0
+        self._recipients = ((), {}, (), {}, 0)
 
     def add_client(self, token, client_info, is_host=False):
         """クライアントをルームに追加"""
         self.clients[token] = client_info
+        self._members_version = next(self._versions)
         if is_host:
             self.host_token = token
             client_info.is_host = True
@@ -44,21 +73,84 @@ class Room:
         """
         if token in self.clients:
             del self.clients[token]
+            self._members_version = next(self._versions)
         # ホストが退出したら部屋を閉じる
         if token == self.host_token:
             return False
         return True
 
+    def update_client_address(self, token, address):
+        """クライアントのアドレスを更新（変更があった場合はTrue）"""
+        client_info = self.clients[token]
+        if client_info.address == address:
+            return False
+        client_info.address = address
+        self._members_version = next(self._versions)
+        return True
+
+    def recipient_list(self):
+        """クライアント（タグ付きを除く）のアドレスのタプルと、トークンからその位置への辞書を取得
+
+        メンバーかアドレスが変わったときだけ作り直すため、
+        メッセージごとの配信では新しいリストを確保しません。
+        """
+        cache = self._recipients
+        if cache[4] != self._members_version:
+            cache = self._rebuild_recipients()
+        return cache[0], cache[1]
+
+    def tagged_recipient_list(self):
+        """ルームタグを付けて配信するクライアントのアドレスと位置（recipient_listと同じ形）"""
+        cache = self._recipients
+        if cache[4] != self._members_version:
+            cache = self._rebuild_recipients()
+        return cache[2], cache[3]
+
+    def _rebuild_recipients(self):
+        """配信先を作り直す
+
+        作り直しの間に別スレッドでメンバーが変わった場合は、古い内容がキャッシュに残らないよう
+        バージョンが変わっていないときだけキャッシュに入れます（次の呼び出しでまた作り直す）。
+        """
+        while True:
+            version = self._members_version
+            try:
+                members = list(self.clients.items())
+            except RuntimeError:  # 走査中に辞書が変更された
+                continue
+            break
+        plain = [(token, client) for token, client in members if not client.tagged]
+        tagged = [(token, client) for token, client in members if client.tagged]
+        cache = (tuple(client.address for _, client in plain),
+                 {token: i for i, (token, _) in enumerate(plain)},
+                 tuple(client.address for _, client in tagged),
+                 {token: i for i, (token, _) in enumerate(tagged)},
+                 version)
+        if self._members_version == version:
+            self._recipients = cache
+        return cache
+
     def get_client_addresses(self, except_token=None):
         """特定のクライアントを除くすべてのクライアントのアドレスリストを取得"""
-        return [client.address for token, client in self.clients.items() if token != except_token]
+        addresses, positions = self.recipient_list()
+        index = positions.get(except_token)
+        if index is None:
+            return list(addresses)
+        return list(addresses[:index] + addresses[index + 1:])
 
     def add_message(self, sender, content):
-        """メッセージをルームに追加"""
-        message = {
-            "sender": sender,
-            "content": content,
-            "timestamp": datetime.now().isoformat()
-        }
-        self.messages.append(message)
-        return message 
\ No newline at end of file
+        """メッセージをルームに追加（上限を超えた古いメッセージは破棄される）"""
+        record = self.messages.append(sender, content)
+        if self.log:
+            self.log.append(self.id, record)
+        return record
+
+    def close(self):
+        """ルームを閉じて履歴を解放"""
+        self.messages.clear()
+        if self.log:
+            self.log.close_room(self.id)
+
+    def history_stats(self):
+        """履歴のメモリ使用量"""
+        return self.messages.stats() 
\ No newline at end of file
@@ -0,0 +1,120 @@
+"""
+UDPメッセージの流量制限（トークンバケット）
+トークン（クライアント）ごと・送信元IPアドレスごと・ルームごとに毎秒の件数を制限し、
+超えたパケットは履歴への保存や転送を行う前に破棄します
+再送要求で送り直すフレーム数もトークンごとに制限します（1つの再送要求で多数のフレームを送らせる増幅の防止）
+"""
+
+DEFAULT_MAX_KEYS = 100000
+
+
+class RateLimiter:
+    """キーごとのトークンバケット
+
+    バケットは毎秒rate個ずつ最大burst個まで補充され、1パケットごとに1個消費します。
+    満杯まで補充されるだけの時間使われていないバケットはprune()で削除します（削除しても結果は同じ）。
+    ロックは取らないため、複数スレッドから同じキーを同時に更新すると多少ずれることがあります。
+    """
+
+    def __init__(self, rate, burst=None, max_keys=DEFAULT_MAX_KEYS):
+        self.rate = float(rate)
+        self.burst = float(burst if burst else max(1.0, rate * 2))
+        self.max_keys = max_keys
+        self.idle = self.burst / self.rate  # 空のバケットが満杯に戻るまでの秒数
+        self.buckets = {}  # キー -> [残りトークン数, 最終更新時刻]
+
+    def allow(self, key, now):
+        """1パケット分のトークンを消費できればTrue"""
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            if len(self.buckets) >= self.max_keys:
+                self.prune(now)
+                if len(self.buckets) >= self.max_keys:
+                    # 送信元を偽装した大量のキーでメモリを使い切られないよう、記録せずに通す
+                    return True
+            self.buckets[key] = [self.burst - 1, now]
+            return True
+        tokens = bucket[0] + (now - bucket[1]) * self.rate
+        if tokens > self.burst:
+            tokens = self.burst
+        bucket[1] = now
+        if tokens < 1:
+            bucket[0] = tokens
+            return False
+        bucket[0] = tokens - 1
+        return True
+
+    def take(self, key, now, count):
+        """最大count個のトークンを消費し、消費できた個数を返す（足りない分は消費しない）"""
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            if len(self.buckets) >= self.max_keys:
+                self.prune(now)
+                if len(self.buckets) >= self.max_keys:
+                    return count
+            bucket = self.buckets[key] = [self.burst, now]
+        tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+        granted = min(count, int(tokens))
+        bucket[0] = tokens - granted
+        bucket[1] = now
+        return granted
+
+    def prune(self, now):
+        """満杯まで補充されているはずのバケットを削除"""
+        idle = self.idle
+        for key, bucket in list(self.buckets.items()):
+            if now - bucket[1] >= idle:
+                self.buckets.pop(key, None)
+
+    def __len__(self):
+        return len(self.buckets)
+
+
+class RateLimits:
+    """トークン・送信元IPアドレス・ルームごとの制限と、トークンごとの再送フレーム数の制限の組
+    （Noneの制限は行わない）"""
+
+    def __init__(self, token=None, address=None, room=None, retransmit=None, max_keys=DEFAULT_MAX_KEYS):
+        self.token = RateLimiter(*token, max_keys=max_keys) if token else None
+        self.address = RateLimiter(*address, max_keys=max_keys) if address else None
+        self.room = RateLimiter(*room, max_keys=max_keys) if room else None
+        self.retransmit = RateLimiter(*retransmit, max_keys=max_keys) if retransmit else None
+        self.pruned = 0.0
+
+    def allow_address(self, address, now):
+        """送信元IPアドレスの制限（パケットの解析前に確認）"""
+        return self.address is None or self.address.allow(address[0], now)
+
+    def check_sender(self, token_key, room_key, now):
+        """トークンとルームの制限を確認し、超えていれば理由（'rate_token' / 'rate_room'）を返す"""
+        if self.token is not None and not self.token.allow(token_key, now):
+            return 'rate_token'
+        if self.room is not None and not self.room.allow(room_key, now):
+            return 'rate_room'
+        return None
+
+    def retransmit_frames(self, token_key, frames, now):
+        """再送要求でframes件を送り直してよいか確認し、送ってよい件数を返す"""
+        if self.retransmit is None or not frames:
+            return frames
+        return self.retransmit.take(token_key, now, frames)
+
+    def prune(self, now):
+        """使われていないバケットを削除（前回から最も長いidle秒数が経った場合だけ走査）"""
+        limiters = [limiter for limiter in (self.token, self.address, self.room, self.retransmit)
+                    if limiter]
+        if not limiters or now - self.pruned < max(limiter.idle for limiter in limiters):
+            return
+        self.pruned = now
+        for limiter in limiters:
+            limiter.prune(now)
+
+
+def parse_rate(value):
+    """コマンドライン引数の RATE[:BURST] を (rate, burst) に変換（0または空なら制限なしでNone）"""
+    if not value:
+        return None
+    rate, _, burst = value.partition(':')
+    if float(rate) <= 0:
+        return None
+    return float(rate), float(burst) if burst else None
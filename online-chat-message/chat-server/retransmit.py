@@ -0,0 +1,66 @@
+"""
+信頼性モードのルームの再送バッファ
+配信したメッセージに連番を付けて直近capacity件を保持し、クライアントの再送要求（NACK）に答えます
+"""
+
+import itertools
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'common'))
+
+from udp_reliable import KIND_LOST, encode_ack, encode_sequenced
+
+DEFAULT_RETRANSMIT_SIZE = 1024
+MAX_RETRANSMIT_PER_NACK = 256  # 1回の再送要求で送り直す最大件数（増幅攻撃の防止）
+
+
+def limit_ranges(ranges, limit):
+    """再送要求の範囲 [(先頭, 件数)] を先頭から合計limit件までに切り詰める"""
+    limited = []
+    for start, count in ranges:
+        if limit <= 0:
+            break
+        count = min(count, limit)
+        limited.append((start, count))
+        limit -= count
+    return limited
+
+
+class RetransmitBuffer:
+    """連番 -> 連番付きフレームのリングバッファ
+
+    連番の採番はitertools.countで行うため、ロックなしで複数スレッドから呼び出せます。
+    """
+
+    def __init__(self, capacity=DEFAULT_RETRANSMIT_SIZE, stream=0):
+        self.capacity = capacity
+        self.stream = stream  # ワーカー番号（マルチプロセス構成で連番を区別する）
+        self.slots = [None] * capacity  # 連番 % capacity -> (連番, フレーム, 送信者のトークン)
+        self.sequence = itertools.count()
+
+    def add(self, frame, sender=None):
+        """フレームに連番を付けて保持し、配信するフレームを返す（senderは送信者のトークン）"""
+        seq = next(self.sequence)
+        sequenced = encode_sequenced(self.stream, seq, frame)
+        self.slots[seq % self.capacity] = (seq, sequenced, sender)
+        return sequenced
+
+    def get(self, seq, requester=None):
+        """連番のフレーム（バッファから消えていれば再送できない通知、要求者自身のメッセージなら連番の通知）"""
+        entry = self.slots[seq % self.capacity]
+        if entry is not None and entry[0] == seq:
+            if requester is not None and entry[2] == requester:
+                return encode_ack(entry[1])
+            return entry[1]
+        return encode_sequenced(self.stream, seq, b'', KIND_LOST)
+
+    def lookup(self, ranges, limit=MAX_RETRANSMIT_PER_NACK, requester=None):
+        """再送要求の範囲 [(先頭, 件数)] に答えるフレームのリスト（limit件まで、requesterは要求者のトークン）"""
+        frames = []
+        for start, count in ranges:
+            for seq in range(start, start + min(count, limit - len(frames))):
+                frames.append(self.get(seq, requester))
+            if len(frames) >= limit:
+                break
+        return frames
@@ -0,0 +1,164 @@
+"""
+ルームの一覧・検索用のインデックス
+ルーム名の前方一致・参加人数順・最近の活動順の一覧を、全ルームを走査せずにページ単位で返します
+"""
+
+import threading
+import time
+from bisect import bisect_left, bisect_right, insort
+
+SORT_NAME = 'name'
+SORT_MEMBERS = 'members'
+SORT_ACTIVITY = 'activity'
+SORT_ORDERS = (SORT_NAME, SORT_MEMBERS, SORT_ACTIVITY)
+
+DEFAULT_LIMIT = 20
+MAX_LIMIT = 100
+
+
+def name_key(name):
+    """大文字・小文字を区別しない検索用のキー"""
+    return name.casefold()
+
+
+class RoomIndex:
+    """TCPServerがルームの作成・削除・参加・退出のたびに更新するインデックス
+
+    - 名前順: (casefoldした名前, room_id) のソート済みリスト（前方一致は二分探索）
+    - 参加人数順: (-人数, room_id) のソート済みリスト
+    - 活動順: (-最終活動時刻, room_id) のソート済みリスト
+
+    活動の記録はメッセージごとに呼ばれるため辞書の更新だけにとどめ（O(1)）、活動順のリストは
+    活動順のページが要求されたときに作り直します。作り直しは最大でactivity_resolution秒に1回で、
+    その間のページは同じリストから返すため、ページをたどる途中で並び順が変わることもありません。
+
+    どの並び順も直前のページの最後の要素をカーソルにして続きを二分探索で求めるため、
+    ページの位置によらず1ページのコストは一定で、ページの間にルームが増減しても重複・欠落しません。
+    """
+
+    def __init__(self, activity_resolution=1.0):
+        self.activity_resolution = activity_resolution
+        self.lock = threading.Lock()
+        self.rooms = {}  # room_id -> Room
+        self.names = []  # [(name_key, room_id)]
+        self.members = []  # [(-人数, room_id)]
+        self.counts = {}  # room_id -> インデックス上の人数
+        self.activity = {}  # room_id -> 最終活動時刻（time.monotonic）
+        self.recent = None  # [(-最終活動時刻, room_id)]（活動順のページを返すときに作る、Noneなら作り直し）
+        self.recent_stale = False  # recentの作成後に活動があった
+        self.recent_built = 0.0  # recentを作った時刻
+
+    def add(self, room):
+        """ルームを追加"""
+        with self.lock:
+            if room.id in self.rooms:
+                return
+            self.rooms[room.id] = room
+            insort(self.names, (name_key(room.name), room.id))
+            count = len(room.clients)
+            self.counts[room.id] = count
+            insort(self.members, (-count, room.id))
+            self.activity[room.id] = time.monotonic()
+            self.recent = None  # 追加・削除は次のページから必ず反映する
+
+    def remove(self, room):
+        """ルームを削除"""
+        with self.lock:
+            if self.rooms.pop(room.id, None) is None:
+                return
+            self._discard(self.names, (name_key(room.name), room.id))
+            self._discard(self.members, (-self.counts.pop(room.id), room.id))
+            del self.activity[room.id]
+            self.recent = None
+
+    def update_members(self, room):
+        """参加人数の変化を反映"""
+        with self.lock:
+            old = self.counts.get(room.id)
+            count = len(room.clients)
+            if old is None or old == count:
+                return
+            self._discard(self.members, (-old, room.id))
+            insort(self.members, (-count, room.id))
+            self.counts[room.id] = count
+
+    def touch(self, room, now):
+        """ルームでの活動を記録（activity_resolution秒に1回だけ更新し、並び順は次の活動順のページで反映）"""
+        last = self.activity.get(room.id)
+        if last is None or now - last < self.activity_resolution:
+            return
+        with self.lock:
+            if room.id in self.activity:
+                self.activity[room.id] = now
+                self.recent_stale = True
+
+    def _discard(self, entries, key):
+        index = bisect_left(entries, key)
+        if index < len(entries) and entries[index] == key:
+            del entries[index]
+
+    def query(self, sort=SORT_NAME, prefix='', limit=DEFAULT_LIMIT, cursor=None):
+        """一覧の1ページを返す
+
+        戻り値:
+            dict: rooms（ルームの辞書のリスト）, total（条件に合う件数）, nextCursor（続きがなければNone）
+        """
+        if sort not in SORT_ORDERS:
+            raise ValueError(f"Unknown sort order: {sort}")
+        if prefix and sort != SORT_NAME:
+            raise ValueError("prefix is only supported with sort=name")
+        limit = max(1, min(int(limit), MAX_LIMIT))
+        with self.lock:
+            if sort == SORT_NAME:
+                ids, total, next_cursor = self._query_names(prefix, limit, cursor)
+            elif sort == SORT_MEMBERS:
+                ids, total, next_cursor = self._query_members(limit, cursor)
+            else:
+                ids, total, next_cursor = self._query_activity(limit, cursor)
+            now = time.monotonic()
+            rooms = [self._describe(room_id, now) for room_id in ids]
+        return {"rooms": rooms, "total": total, "nextCursor": next_cursor}
+
+    def _query_names(self, prefix, limit, cursor):
+        key = name_key(prefix)
+        first = bisect_left(self.names, (key,))
+        end = bisect_left(self.names, (key + '\U0010ffff',)) if key else len(self.names)
+        start = first
+        if cursor is not None:
+            start = max(first, bisect_right(self.names, tuple(cursor)))
+        page = self.names[start:min(start + limit, end)]
+        next_cursor = list(page[-1]) if page and start + limit < end else None
+        return [room_id for _, room_id in page], end - first, next_cursor
+
+    def _query_members(self, limit, cursor):
+        start = bisect_right(self.members, tuple(cursor)) if cursor is not None else 0
+        page = self.members[start:start + limit]
+        next_cursor = list(page[-1]) if page and start + limit < len(self.members) else None
+        return [room_id for _, room_id in page], len(self.members), next_cursor
+
+    def _refresh_recent(self):
+        now = time.monotonic()
+        if self.recent is None or (
+                self.recent_stale and now - self.recent_built >= self.activity_resolution):
+            self.recent = sorted((-last, room_id) for room_id, last in self.activity.items())
+            self.recent_stale = False
+            self.recent_built = now
+
+    def _query_activity(self, limit, cursor):
+        self._refresh_recent()
+        start = bisect_right(self.recent, tuple(cursor)) if cursor is not None else 0
+        page = self.recent[start:start + limit]
+        next_cursor = list(page[-1]) if page and start + limit < len(self.recent) else None
+        return [room_id for _, room_id in page], len(self.recent), next_cursor
+
+    def _describe(self, room_id, now):
+        room = self.rooms[room_id]
+        return {
+            "roomId": room_id,
+            "roomName": room.name,
+            "members": self.counts[room_id],
+            "idleSeconds": int(now - self.activity[room_id]),
+        }
+
+    def __len__(self):
+        return len(self.rooms)
@@ -0,0 +1,136 @@
+"""
+ルームIDごとにメッセージ処理をワーカースレッドへ振り分けるスケジューラ
+同じルームのメッセージは常に同じワーカーで順番に処理され、
+混雑したルームが他のルームの配信を待たせないようにします
+"""
+
+import queue
+import threading
+import time
+from collections import deque
+from server_log import get_logger
+
+log = get_logger('scheduler')
+
+METRICS_TOP_ROOMS = 10  # /metricsに遅延を公開するルーム数（p99の大きい順）
+
+
+class RoomLatencyStats:
+    """ルームごとの処理遅延の統計"""
+
+    def __init__(self, samples=512):
+        self.count = 0
+        self.dropped = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.recent = deque(maxlen=samples)
+
+    def record(self, latency):
+        self.count += 1
+        self.total += latency
+        if latency > self.max:
+            self.max = latency
+        self.recent.append(latency)
+
+    def percentile(self, p, ordered=None):
+        if ordered is None:
+            ordered = sorted(self.recent)
+        if not ordered:
+            return 0.0
+        return ordered[min(len(ordered) - 1, int(len(ordered) * p))]
+
+    def to_dict(self):
+        ordered = sorted(self.recent)
+        return {
+            'count': self.count,
+            'dropped': self.dropped,
+            'mean': self.total / self.count if self.count else 0.0,
+            'p50': self.percentile(0.5, ordered),
+            'p99': self.percentile(0.99, ordered),
+            'max': self.max,
+        }
+
+
+class RoomScheduler:
+    """ルームIDのハッシュでワーカーを選び、ワーカーごとのキューで処理する
+
+    キューが満杯のときは新しいメッセージを破棄します（リアルタイム性を優先）。
+    遅延統計はis_room(ルームIDのバイト列)がTrueを返す（存在する）ルームだけに作るため、
+    偽のルームIDのパケットで統計が増え続けることはありません。
+    """
+
+    def __init__(self, handler, workers=4, queue_size=1024, is_room=None):
+        self.handler = handler
+        self.is_room = is_room
+        self.queues = [queue.Queue(maxsize=queue_size) for _ in range(workers)]
+        self.stats_by_room = {}  # ルームIDのバイト列 -> RoomLatencyStats
+        self.running = False
+
+    def start(self):
+        """ワーカースレッドを起動"""
+        self.running = True
+        for index in range(len(self.queues)):
+            worker = threading.Thread(target=self.worker_loop, args=(self.queues[index],))
+            worker.daemon = True
+            worker.start()
+
+    def stop(self):
+        """ワーカースレッドを停止"""
+        self.running = False
+        for q in self.queues:
+            try:
+                q.put_nowait(None)
+            except queue.Full:
+                pass
+
+    def submit(self, room_key, *args):
+        """ルームのワーカーへ処理を投入（満杯で破棄した場合はFalse）"""
+        stats = self.stats_by_room.get(room_key)
+        if stats is None and (self.is_room is None or self.is_room(room_key)):
+            stats = self.stats_by_room.setdefault(room_key, RoomLatencyStats())
+        try:
+            self.queues[hash(room_key) % len(self.queues)].put_nowait(
+                (stats, time.perf_counter(), args))
+            return True
+        except queue.Full:
+            if stats is not None:
+                stats.dropped += 1
+            return False
+
+    def worker_loop(self, q):
+        """キューからメッセージを取り出して処理"""
+        while self.running:
+            item = q.get()
+            if item is None:
+                break
+            stats, enqueued, args = item
+            try:
+                self.handler(*args)
+            except Exception as e:
+                log.exception('worker_error', error=str(e))
+            if stats is not None:
+                stats.record(time.perf_counter() - enqueued)
+
+    def queue_depths(self):
+        """ワーカーごとの待ち行列の長さ"""
+        return [q.qsize() for q in self.queues]
+
+    def stats(self):
+        """ルームごとの遅延統計（秒）を返す"""
+        return {key.decode('utf-8', errors='replace'): stats.to_dict()
+                for key, stats in list(self.stats_by_room.items())}
+
+    def top_rooms(self, n=METRICS_TOP_ROOMS):
+        """直近の遅延のp99が大きいn個のルームの [(ルームID, 遅延統計)]"""
+        stats = sorted(self.stats().items(), key=lambda item: item[1]['p99'], reverse=True)
+        return stats[:n]
+
+    def metric_samples(self):
+        """/metrics用の (ラベル, 値) の組（ルーム数が多くても上位METRICS_TOP_ROOMS個だけ）"""
+        for room_id, stats in self.top_rooms():
+            for stat in ('mean', 'p50', 'p99', 'max'):
+                yield {'room': room_id, 'stat': stat}, stats[stat]
+
+    def forget(self, room_key):
+        """削除されたルームの統計を破棄"""
+        self.stats_by_room.pop(room_key, None)
@@ -3,20 +3,80 @@
 TCP接続でルーム作成・参加を管理し、UDPでリアルタイムメッセージを配信します
 """
 
+import argparse
 import threading
 from tcp_server import TCPServer
 from udp_server import UDPServer
+from async_udp_server import AsyncUDPServer
+from cluster import ClusterNode, run_workers
+from history import DEFAULT_MAX_BYTES, DEFAULT_MAX_MESSAGES, DEFAULT_TOTAL_BYTES
+from metrics import serve_metrics
+from rate_limit import RateLimits, parse_rate
+from retransmit import DEFAULT_RETRANSMIT_SIZE
+import server_log
+
+log = server_log.get_logger('server')
+
+UDP_ENGINES = {
+    'thread': UDPServer,
+    'asyncio': AsyncUDPServer,
+}
+
+def start_servers(engine='thread', batch_send=True, batch_recv=False, room_workers=0,
+                  history_messages=DEFAULT_MAX_MESSAGES, history_room_bytes=DEFAULT_MAX_BYTES,
+                  history_total_bytes=DEFAULT_TOTAL_BYTES, log_dir=None, client_timeout=180.0,
+                  cleanup_interval=1.0, tcp_backlog=1024, tcp_threads=64, tcp_max_pending=1024,
+                  tcp_read_timeout=10.0, tcp_max_pipelined=256, log_level='INFO', log_format='text', log_sampling=None,
+                  metrics_host='127.0.0.1', metrics_port=0, rate_limits=None, coalesce_max_ms=10.0,
+                  retransmit_size=DEFAULT_RETRANSMIT_SIZE, cluster_conn=None, worker_index=0):
+    """サーバーを起動
+
+    cluster_connが渡された場合はマルチプロセス構成のワーカーとして起動し、
+    SO_REUSEPORTでポートを共有しつつルーム状態を他のワーカーと同期します。
+    metrics_portが0でなければ計測値をhttp://metrics_host:metrics_port/metricsで公開します
+    （マルチプロセス構成ではワーカーごとにmetrics_port + worker_indexを使用）。
+    rate_limitsはUDPメッセージの流量制限（rate_limit.RateLimits、ワーカーごとに適用）です。
+    coalesce_max_msはルーム作成時に指定できるまとめ送信の待ち時間の上限（ミリ秒、0で無効）、
+    retransmit_sizeは信頼性モードのルームが再送用に保持するメッセージ数（0で無効）です。
+    """
+    reuse_port = cluster_conn is not None
+    server_log.configure(log_level, log_format, log_sampling)
 
-def start_servers():
-    """サーバーを起動"""
     # TCPサーバーの作成
-    tcp_server = TCPServer()
+    tcp_server = TCPServer(reuse_port=reuse_port,
+                           history_messages=history_messages,
+                           history_room_bytes=history_room_bytes,
+                           history_total_bytes=history_total_bytes,
+                           log_dir=log_dir,
+                           client_timeout=client_timeout,
+                           expiry_resolution=cleanup_interval,
+                           backlog=tcp_backlog,
+                           handler_threads=tcp_threads,
+                           max_pending=tcp_max_pending,
+                           read_timeout=tcp_read_timeout,
+                           max_pipelined=tcp_max_pipelined,
+                           max_coalesce_delay=coalesce_max_ms / 1000,
+                           retransmit_size=retransmit_size,
+                           worker_index=worker_index)
+    if cluster_conn is not None:
+        tcp_server.cluster = ClusterNode(cluster_conn, tcp_server)
+        tcp_server.cluster.start()
+    tcp_server.metrics.gauge('chat_log_dropped_events', 'Diagnostic log events dropped on a full queue',
+                             server_log.dropped)
+    if metrics_port:
+        port = metrics_port + worker_index
+        serve_metrics(tcp_server.metrics, metrics_host, port)
+        log.info('metrics_listening', host=metrics_host, port=port)
     tcp_thread = threading.Thread(target=tcp_server.start)
     tcp_thread.daemon = True
     tcp_thread.start()
     
     # UDPサーバーの作成
-    udp_server = UDPServer(tcp_server)
+    udp_server = UDP_ENGINES[engine](tcp_server, batch_send=batch_send, batch_recv=batch_recv,
+                                     reuse_port=reuse_port, room_workers=room_workers,
+                                     rate_limits=rate_limits)
+    if tcp_server.cluster is not None:
+        tcp_server.cluster.udp_server = udp_server
     udp_thread = threading.Thread(target=udp_server.start)
     udp_thread.daemon = True
     udp_thread.start()
@@ -27,8 +87,8 @@ def start_servers():
             try:
                 udp_server.remove_inactive_clients()
             except Exception as e:
-                print(f"Cleanup error: {e}")
-            threading.Event().wait(60)  # 1分ごとに実行
+                log.exception('cleanup_error', error=str(e))
+            threading.Event().wait(cleanup_interval)
             
     cleanup_thread = threading.Thread(target=cleanup_task)
     cleanup_thread.daemon = True
@@ -39,7 +99,92 @@ def start_servers():
         while True:
             threading.Event().wait(10)
     except KeyboardInterrupt:
-        print("Shutting down servers...")
+        log.info('shutting_down')
+        server_log.shutdown()
+
+def main():
+    """メイン関数"""
+    parser = argparse.ArgumentParser(description="チャットサーバー")
+    parser.add_argument('--engine', choices=UDP_ENGINES.keys(), default='thread',
+                        help='UDPリレーエンジン')
+    parser.add_argument('--no-batch-send', action='store_true',
+                        help='sendmmsgによるバッチ送信を無効化')
+    parser.add_argument('--batch-recv', action='store_true',
+                        help='recvmmsgによるバッチ受信を有効化（threadエンジンのみ）')
+    parser.add_argument('--room-workers', type=int, default=0,
+                        help='ルームIDで振り分けるメッセージ処理スレッド数（0で無効）')
+    parser.add_argument('--history-messages', type=int, default=DEFAULT_MAX_MESSAGES,
+                        help='ルームごとに保持するメッセージ数の上限')
+    parser.add_argument('--history-room-bytes', type=int, default=DEFAULT_MAX_BYTES,
+                        help='ルームごとの履歴のバイト数上限')
+    parser.add_argument('--history-total-bytes', type=int, default=DEFAULT_TOTAL_BYTES,
+                        help='全ルームの履歴のバイト数上限')
+    parser.add_argument('--log-dir', default=None,
+                        help='メッセージを追記保存するディレクトリ（未指定なら保存しない）')
+    parser.add_argument('--client-timeout', type=float, default=180.0,
+                        help='メッセージを送らないクライアントを削除するまでの秒数')
+    parser.add_argument('--cleanup-interval', type=float, default=1.0,
+                        help='非アクティブクライアントを確認する間隔（秒）')
+    parser.add_argument('--tcp-backlog', type=int, default=1024,
+                        help='TCRPの接続待ちキューの長さ（listenのbacklog）')
+    parser.add_argument('--tcp-threads', type=int, default=64,
+                        help='TCRPリクエストを処理するスレッド数')
+    parser.add_argument('--tcp-max-pending', type=int, default=1024,
+                        help='受け付け済みで処理待ち・処理中のTCRP接続数の上限')
+    parser.add_argument('--tcp-read-timeout', type=float, default=10.0,
+                        help='TCRPリクエストの受信タイムアウト（秒）')
+    parser.add_argument('--tcp-max-pipelined', type=int, default=256,
+                        help='リクエストID付きで接続を保持するTCRP接続数の上限（超えた接続は1リクエストごとに閉じる）')
+    parser.add_argument('--log-level', choices=server_log.LEVELS, default='INFO',
+                        help='診断ログのレベル（DEBUGでリクエストごとのヘッダーも出力）')
+    parser.add_argument('--log-format', choices=server_log.FORMATTERS.keys(), default='text',
+                        help='診断ログの形式')
+    parser.add_argument('--log-sample', action='append', metavar='EVENT=N',
+                        help='イベントをN回に1回だけ記録（例: invalid_token=1000、複数指定可）')
+    parser.add_argument('--rate-limit-token', default='20:40', metavar='RATE[:BURST]',
+                        help='クライアント（トークン）ごとの毎秒メッセージ数と瞬間的な上限（0で無効）')
+    parser.add_argument('--rate-limit-address', default='0', metavar='RATE[:BURST]',
+                        help='送信元IPアドレスごとの毎秒パケット数と瞬間的な上限（0で無効）')
+    parser.add_argument('--rate-limit-room', default='500:1000', metavar='RATE[:BURST]',
+                        help='ルームごとの毎秒メッセージ数と瞬間的な上限（0で無効）')
+    parser.add_argument('--rate-limit-retransmit', default='200:1000', metavar='RATE[:BURST]',
+                        help='クライアントごとに再送要求で送り直す毎秒のメッセージ数と瞬間的な上限（0で無効）')
+    parser.add_argument('--coalesce-max-ms', type=float, default=10.0,
+                        help='ルーム作成時に指定できるまとめ送信の待ち時間の上限（ミリ秒、0で無効）')
+    parser.add_argument('--retransmit-buffer', type=int, default=DEFAULT_RETRANSMIT_SIZE,
+                        help='信頼性モードのルームが再送用に保持するメッセージ数（0で信頼性モードを無効化）')
+    parser.add_argument('--metrics-port', type=int, default=0,
+                        help='計測値をPrometheus形式で公開するHTTPポート（0で無効、ワーカーごとに+1）')
+    parser.add_argument('--metrics-host', default='127.0.0.1',
+                        help='計測値のHTTPエンドポイントの待ち受けアドレス')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='ワーカープロセス数（2以上でSO_REUSEPORTによるマルチプロセス構成）')
+
+    args = parser.parse_args()
+    options = dict(engine=args.engine, batch_send=not args.no_batch_send, batch_recv=args.batch_recv,
+                   room_workers=args.room_workers, history_messages=args.history_messages,
+                   history_room_bytes=args.history_room_bytes,
+                   history_total_bytes=args.history_total_bytes, log_dir=args.log_dir,
+                   client_timeout=args.client_timeout, cleanup_interval=args.cleanup_interval,
+                   tcp_backlog=args.tcp_backlog, tcp_threads=args.tcp_threads,
+                   tcp_max_pending=args.tcp_max_pending, tcp_read_timeout=args.tcp_read_timeout,
+                   tcp_max_pipelined=args.tcp_max_pipelined,
+                   log_level=args.log_level, log_format=args.log_format,
+                   log_sampling=server_log.parse_sampling(args.log_sample),
+                   metrics_host=args.metrics_host, metrics_port=args.metrics_port,
+                   coalesce_max_ms=args.coalesce_max_ms, retransmit_size=args.retransmit_buffer,
+                   rate_limits=RateLimits(token=parse_rate(args.rate_limit_token),
+                                          address=parse_rate(args.rate_limit_address),
+                                          room=parse_rate(args.rate_limit_room),
+                                          retransmit=parse_rate(args.rate_limit_retransmit)))
+    if args.workers > 1:
+        server_log.configure(args.log_level, args.log_format, options['log_sampling'])
+        if not args.log_dir:
+            # メモリ上の履歴はワーカーごとで共有されないため、履歴の取得（TCRP操作4）はエラーになる
+            log.warning('history_requires_log_dir', workers=args.workers)
+        run_workers(args.workers, start_servers, **options)
+    else:
+        start_servers(**options)
 
 if __name__ == "__main__":
-    start_servers()
\ No newline at end of file
+    main()
\ No newline at end of file
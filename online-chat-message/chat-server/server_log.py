@@ -0,0 +1,215 @@
+"""
+サーバーの診断ログ
+ハンドラースレッドはイベントをキューに積むだけで戻り、整形と標準出力への書き込みは
+標準ライブラリのlogging.handlers.QueueListenerの書き出しスレッドで行います
+
+ログはイベント名とキーワード引数のフィールドで記録します:
+    log = get_logger('tcp')
+    log.info('room_created', room_id=room.id, name=room_name)
+"""
+
+import atexit
+import itertools
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import time
+
+ROOT_LOGGER = 'chat'
+DEFAULT_QUEUE_SIZE = 10000
+LEVELS = ('DEBUG', 'INFO', 'WARNING', 'ERROR')
+
+# パケット単位で発生しうるイベントは既定で間引く（N回に1回だけ記録）
+DEFAULT_SAMPLING = {
+    'invalid_token': 100,
+    'room_mismatch': 100,
+    'message_error': 100,
+    'rate_limited': 1000,
+}
+
+_sampling = dict(DEFAULT_SAMPLING)
+_counters = {}  # イベント名 -> itertools.count
+_listener = None
+_handler = None  # configure()後のNonBlockingQueue
+
+
+class EventLogger:
+    """イベント名とフィールドで記録するロガー
+
+    レベルが無効なときは何もせずに戻ります。フィールドの値を作るのに手間がかかる場合は
+    enabled(logging.DEBUG) で確認してから呼んでください。
+    configure()後はLogRecordも作らずにキューへ積み、書き出しスレッドでLogRecordに変換します。
+    """
+
+    def __init__(self, name):
+        self.logger = logging.getLogger(f'{ROOT_LOGGER}.{name}')
+
+    def enabled(self, level):
+        return self.logger.isEnabledFor(level)
+
+    def log(self, level, event, exc_info=None, **fields):
+        if not self.logger.isEnabledFor(level):
+            return
+        rate = _sampling.get(event)
+        if rate and rate > 1:
+            counter = _counters.get(event)
+            if counter is None:
+                counter = _counters.setdefault(event, itertools.count())
+            if next(counter) % rate:
+                return
+            fields['sampled'] = rate
+        if exc_info:
+            exc_info = sys.exc_info()
+        handler = _handler
+        if handler is None:
+            self.logger.log(level, event, exc_info=exc_info, extra={'fields': fields})
+            return
+        handler.enqueue((time.time(), self.logger, level, event, fields, exc_info))
+
+    def debug(self, event, **fields):
+        self.log(logging.DEBUG, event, **fields)
+
+    def info(self, event, **fields):
+        self.log(logging.INFO, event, **fields)
+
+    def warning(self, event, **fields):
+        self.log(logging.WARNING, event, **fields)
+
+    def error(self, event, **fields):
+        self.log(logging.ERROR, event, **fields)
+
+    def exception(self, event, **fields):
+        """例外のトレースバック付きでERRORを記録（exceptブロック内で呼ぶ）"""
+        self.log(logging.ERROR, event, exc_info=True, **fields)
+
+
+def get_logger(name):
+    return EventLogger(name)
+
+
+class TextFormatter(logging.Formatter):
+    """時刻 レベル ロガー イベント key=value ... の1行形式"""
+
+    def format(self, record):
+        fields = getattr(record, 'fields', {})
+        parts = [self.formatTime(record), record.levelname, record.name, record.getMessage()]
+        parts.extend(f'{key}={value!r}' for key, value in fields.items())
+        line = ' '.join(parts)
+        if record.exc_info:
+            line += '\n' + self.formatException(record.exc_info)
+        return line
+
+    _cached_second = None
+    _cached_text = ''
+
+    def formatTime(self, record, datefmt=None):
+        # 同じ秒のレコードが続くことが多いため、秒までの文字列は使い回す
+        second = int(record.created)
+        if second != self._cached_second:
+            self._cached_text = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(second))
+            self._cached_second = second
+        return f'{self._cached_text}.{int(record.msecs):03d}'
+
+
+class JSONFormatter(TextFormatter):
+    """1行1オブジェクトのJSON形式"""
+
+    def format(self, record):
+        entry = {
+            'time': record.created,
+            'level': record.levelname,
+            'logger': record.name,
+            'event': record.getMessage(),
+        }
+        for key, value in getattr(record, 'fields', {}).items():
+            entry[key] = value if isinstance(value, (str, int, float, bool, type(None))) else repr(value)
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+FORMATTERS = {
+    'text': TextFormatter,
+    'json': JSONFormatter,
+}
+
+
+class NonBlockingQueue:
+    """キューが満杯なら待たずに破棄する書き込み側"""
+
+    def __init__(self, log_queue):
+        self.queue = log_queue
+        self.dropped = 0
+
+    def enqueue(self, entry):
+        try:
+            self.queue.put_nowait(entry)
+        except queue.Full:
+            self.dropped += 1
+
+
+class EventListener(logging.handlers.QueueListener):
+    """キューの (時刻, ロガー, レベル, イベント, フィールド, 例外) をLogRecordにして出力"""
+
+    def prepare(self, entry):
+        created, logger, level, event, fields, exc_info = entry
+        record = logger.makeRecord(logger.name, level, '', 0, event, (), exc_info,
+                                   extra={'fields': fields})
+        record.created = created
+        record.msecs = (created - int(created)) * 1000
+        return record
+
+    def enqueue_sentinel(self):
+        # 停止の合図はキューが満杯でも確実に届ける
+        self.queue.put(self._sentinel)
+
+
+def configure(level='INFO', fmt='text', sampling=None, stream=None, queue_size=DEFAULT_QUEUE_SIZE):
+    """ログの出力先・レベル・間引き設定を行い、書き出しスレッドを起動
+
+    sampling: {イベント名: N} でN回に1回だけ記録（既定値を上書き、1以下で間引きなし）
+    """
+    global _listener, _handler
+    shutdown()
+    _sampling.clear()
+    _sampling.update(DEFAULT_SAMPLING)
+    _sampling.update(sampling or {})
+
+    output = logging.StreamHandler(stream or sys.stdout)
+    output.setFormatter(FORMATTERS[fmt]())
+    root = logging.getLogger(ROOT_LOGGER)
+    root.setLevel(level)
+    root.propagate = False
+    log_queue = queue.Queue(maxsize=queue_size)
+    _handler = NonBlockingQueue(log_queue)
+    _listener = EventListener(log_queue, output)
+    _listener.start()
+    return _listener
+
+
+def shutdown():
+    """キューに残っているログを書き出して書き出しスレッドを止める"""
+    global _listener, _handler
+    if _listener is not None:
+        _handler = None
+        _listener.stop()
+        _listener = None
+
+
+def dropped():
+    """キューが満杯で破棄したログの件数"""
+    return _handler.dropped if _handler else 0
+
+
+def parse_sampling(values):
+    """コマンドライン引数の EVENT=N のリストを辞書に変換"""
+    sampling = {}
+    for value in values or ():
+        event, _, rate = value.partition('=')
+        sampling[event] = int(rate)
+    return sampling
+
+
+atexit.register(shutdown)
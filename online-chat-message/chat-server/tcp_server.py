@@ -6,121 +6,402 @@ TCP接続を処理するサーバーモジュール
 import socket
 import threading
 import json
+import logging
+import os
+import sys
+import time
 import uuid
-import traceback
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from models import ClientInfo, Room
+from history import (DEFAULT_MAX_BYTES, DEFAULT_MAX_MESSAGES, DEFAULT_TOTAL_BYTES,
+                     HistoryBudget, MessageHistory)
+from message_log import MessageLog
+from expiry import ExpiryIndex
+from metrics import ServerMetrics
+from retransmit import DEFAULT_RETRANSMIT_SIZE, RetransmitBuffer
+from room_index import DEFAULT_LIMIT, SORT_NAME, RoomIndex
+from server_log import get_logger
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'common'))
+
+from tcrp import (HEADER_SIZE, MAX_PAYLOAD_SIZE, MAX_ROOM_NAME_SIZE, OP_CREATE, OP_HISTORY, OP_JOIN, OP_LIST,
+                  STATE_ERROR, STATE_REQUEST, STATE_RESPONSE, encode_message, recv_exactly, unpack_header,
+                  unpack_request_id)
+
+log = get_logger('tcp')
+
+# 受信した1件のリクエスト（dataはルーム名とペイロード、startedは受信時刻のperf_counter_ns）
+TCRPRequest = namedtuple('TCRPRequest', 'header operation state request_id room_name_size data started')
+
+HISTORY_RESPONSE_BYTES = 256 * 1024  # 履歴レスポンスの本文の上限（超える分は古いメッセージから省く）
+
+
+def parse_user_payload(payload):
+    """作成・参加リクエストのペイロードを (ユーザー名, オプションの辞書) にする"""
+    if payload.startswith('{'):
+        try:
+            options = json.loads(payload)
+        except json.JSONDecodeError:
+            options = None
+        if isinstance(options, dict) and isinstance(options.get('username'), str):
+            return options['username'], options
+    return payload, {}
+
+
+class PipelinedConnection:
+    """パイプライン接続のソケットの代わりにハンドラーへ渡すオブジェクト
+
+    同じ接続のリクエストはスレッドプールで並行に処理されるため、応答の書き込みをロックで直列化し、
+    同時に処理するリクエスト数をin_flightで制限します。
+    """
+
+    def __init__(self, sock, depth):
+        self.socket = sock
+        self.depth = depth
+        self.lock = threading.Lock()
+        self.in_flight = threading.BoundedSemaphore(depth)
+
+    def recv(self, size):
+        return self.socket.recv(size)
+
+    def sendall(self, data):
+        with self.lock:
+            self.socket.sendall(data)
+
+    def drain(self):
+        """処理中のリクエストがすべて応答し終わるまで待つ"""
+        for _ in range(self.depth):
+            self.in_flight.acquire()
+
 
 class TCPServer:
     """TCPサーバー - ルーム作成・参加を処理"""
-    def __init__(self, host='0.0.0.0', port=9001):
+    def __init__(self, host='0.0.0.0', port=9001, reuse_port=False,
+                 history_messages=DEFAULT_MAX_MESSAGES, history_room_bytes=DEFAULT_MAX_BYTES,
+                 history_total_bytes=DEFAULT_TOTAL_BYTES, log_dir=None,
+                 client_timeout=180.0, expiry_resolution=1.0,
+                 backlog=1024, handler_threads=64, max_pending=1024, read_timeout=10.0,
+                 max_pipelined=256, pipeline_depth=32,
+                 max_coalesce_delay=0.01, retransmit_size=DEFAULT_RETRANSMIT_SIZE, worker_index=0):
         self.host = host
         self.port = port
         self.socket = None
         self.rooms = {}  # roomId -> Room
+        self.tokens = {}  # トークンのバイト列 -> (Room, ClientInfo, token)
         self.running = False
+        self.reuse_port = reuse_port
+        self.history_messages = history_messages
+        self.history_room_bytes = history_room_bytes
+        self.history_budget = HistoryBudget(history_total_bytes)
+        self.message_log = MessageLog(log_dir) if log_dir else None
+        self.expiry = ExpiryIndex(client_timeout, expiry_resolution)
+        self.room_index = RoomIndex()  # ルームの一覧・検索用
+        self.metrics = ServerMetrics()  # UDPServerと共有する計測値
+        self.metrics.gauge('chat_rooms', 'Rooms', lambda: len(self.rooms))
+        self.metrics.gauge('chat_clients', 'Clients joined to a room', lambda: len(self.tokens))
+        self.metrics.gauge('chat_history_bytes', 'Bytes held by in-memory message history',
+                           lambda: self.history_budget.used)
+        self.cluster = None  # マルチプロセス時のルーム状態同期（cluster.ClusterNode）
+        self.backlog = backlog
+        self.handler_threads = handler_threads
+        self.read_timeout = read_timeout
+        # 受け付け済みで処理待ち・処理中の接続数の上限（超えた分はカーネルのbacklogで待たせる）
+        self.pending = threading.BoundedSemaphore(max_pending)
+        self.executor = None
+        # パイプライン接続（受信スレッドを1本ずつ持つ）の数の上限。超えた接続は1リクエストごとに閉じる
+        self.pipelines = threading.BoundedSemaphore(max_pipelined)
+        self.pipeline_depth = pipeline_depth  # パイプライン接続1本あたりの同時処理リクエスト数
+        # ルーム作成時に指定できるまとめ送信の待ち時間の上限（秒、0ならまとめ送信を受け付けない）
+        self.max_coalesce_delay = max_coalesce_delay
+        # 信頼性モードのルームが保持する再送用のメッセージ数（0なら信頼性モードを受け付けない）
+        self.retransmit_size = retransmit_size
+        self.worker_index = worker_index  # 連番のストリーム番号（マルチプロセス構成のワーカー番号）
 
     def start(self):
         """サーバーを起動"""
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         self.socket.bind((self.host, self.port))
-        self.socket.listen(5)
+        self.socket.listen(self.backlog)
+        self.executor = ThreadPoolExecutor(max_workers=self.handler_threads,
+                                           thread_name_prefix='tcrp')
         self.running = True
-        print(f"TCP Server running on {self.host}:{self.port}")
+        log.info('listening', host=self.host, port=self.port, backlog=self.backlog,
+                 threads=self.handler_threads)
 
         while self.running:
+            self.pending.acquire()
             try:
                 client_socket, address = self.socket.accept()
-                client_handler = threading.Thread(
-                    target=self.handle_client,
-                    args=(client_socket, address)
-                )
-                client_handler.daemon = True
-                client_handler.start()
             except Exception as e:
-                print(f"TCP connection error: {e}")
+                self.pending.release()
+                log.error('accept_error', error=str(e))
+                continue
+            self.executor.submit(self.serve_client, client_socket, address)
+
+    def serve_client(self, client_socket, address):
+        """スレッドプール上で1接続の最初のリクエストを処理
+
+        リクエストID付きのリクエスト（パイプライン接続）なら、以降の受信を接続ごとのスレッドに引き継ぎ、
+        プールのスレッドはすぐに次の接続へ戻ります。それ以外は応答して接続を閉じます。
+        """
+        handed_off = False
+        try:
+            client_socket.settimeout(self.read_timeout)
+            handed_off = self.handle_client(client_socket, address)
+        finally:
+            if not handed_off:
+                client_socket.close()
+            self.pending.release()
 
     def handle_client(self, client_socket, address):
-        """クライアント接続を処理"""
+        """クライアント接続を処理（接続をパイプライン用のスレッドに引き継いだ場合はTrue）"""
+        self.metrics.tcp_connections.inc()
         try:
-            # ヘッダーの受信 (32バイト)
-            header = client_socket.recv(32)
-            if not header:
-                return
-
-            room_name_size = header[0]
-            operation = header[1]
-            state = header[2]
-            
-            # ペイロードサイズの解析（安全に行う）
-            payload_size_bytes = header[3:32]
-            payload_size_str = ''
-            for b in payload_size_bytes:
-                if b == 0:  # ヌルバイトで終了
-                    break
-                if 48 <= b <= 57:  # ASCIIの0-9
-                    payload_size_str += chr(b)
-            
-            try:
-                payload_size = int(payload_size_str) if payload_size_str else 0
-                print(f"受信ヘッダー: room_size={room_name_size}, op={operation}, state={state}, payload_size={payload_size}")
-                
-                # 最大サイズを制限
-                MAX_PAYLOAD_SIZE = 10240  # 10KB
-                if payload_size > MAX_PAYLOAD_SIZE:
-                    print(f"警告: ペイロードサイズが大きすぎます ({payload_size} > {MAX_PAYLOAD_SIZE})。制限値に設定します。")
-                    payload_size = MAX_PAYLOAD_SIZE
-                    
-            except ValueError:
-                print(f"警告: ペイロードサイズの解析エラー。デフォルト値を使用します。")
-                payload_size = 1024  # デフォルト値
-            
-            # データの受信
-            max_data_size = room_name_size + payload_size
-            print(f"データ受信サイズ: {max_data_size} バイト")
-            
-            data = bytearray()
-            total_received = 0
-            
-            while total_received < max_data_size:
-                chunk = client_socket.recv(min(4096, max_data_size - total_received))
-                if not chunk:
-                    break
-                data.extend(chunk)
-                total_received += len(chunk)
-                
-            if total_received < room_name_size:
-                print("エラー: ルーム名を完全に受信できませんでした")
-                return
-                
-            room_name = data[:room_name_size].decode('utf-8', errors='replace')
-            
-            # ペイロードが存在する場合のみ処理
-            if total_received > room_name_size:
-                payload = data[room_name_size:].decode('utf-8', errors='replace')
-            else:
-                payload = ""
-                
-            print(f"受信データ: room_name={room_name}, payload_length={len(payload)}")
-            print(f"Debug - 受信ヘッダー: {', '.join([f'{b:02x}' for b in header[:8]])}")
-
-            # 操作に応じた処理
-            if operation == 1 and state == 0:  # ルーム作成リクエスト
-                self.handle_create_room(client_socket, room_name, payload, address)
-            elif operation == 2 and state == 0:  # ルーム参加リクエスト
-                self.handle_join_room(client_socket, room_name, payload, address)
+            request = self.read_request(client_socket, address)
+            if request is None:
+                return False
+            if request.request_id is None:
+                self.process_request(client_socket, address, request)
+                return False
+            if not self.pipelines.acquire(blocking=False):
+                # パイプライン接続が上限に達している場合は、最初のリクエストだけに応答して閉じる
+                # （リクエストIDは付けるため、クライアントは拡張を使い続け、残りを新しい接続で送り直す）
+                log.warning('pipeline_limit', address=address)
+                self.process_request(client_socket, address, request)
+                return False
+            thread = threading.Thread(target=self.serve_pipeline, args=(client_socket, address, request),
+                                      name='tcrp-pipeline')
+            thread.daemon = True
+            thread.start()
+            return True
+        except socket.timeout:
+            pass
+        except Exception as e:
+            self.metrics.tcp_errors.inc()
+            log.exception('client_error', address=address, error=str(e))
+        return False
+
+    def serve_pipeline(self, client_socket, address, request):
+        """パイプライン接続の受信スレッド
 
+        リクエストを読むたびにスレッドプールで処理させ、応答は処理が終わった順に書き込みます。
+        クライアントが切断するか、read_timeout秒リクエストが届かなくなると、処理中の応答を送ってから閉じます。
+        """
+        connection = PipelinedConnection(client_socket, self.pipeline_depth)
+        try:
+            while request is not None:
+                connection.in_flight.acquire()
+                self.executor.submit(self.process_pipelined, connection, address, request)
+                if request.request_id is None:
+                    break  # リクエストIDのないリクエストは1リクエストの接続と同じく最後にする
+                request = self.read_request(connection, address)
+        except socket.timeout:
+            pass
         except Exception as e:
-            print(f"Error handling TCP client: {e}")
-            traceback.print_exc()
+            self.metrics.tcp_errors.inc()
+            log.exception('client_error', address=address, error=str(e))
+        finally:
+            connection.drain()
+            client_socket.close()
+            self.pipelines.release()
 
-    def handle_create_room(self, client_socket, room_name, username, address):
-        """ルーム作成処理"""
+    def process_pipelined(self, connection, address, request):
+        """スレッドプール上でパイプライン接続の1リクエストを処理"""
         try:
+            self.process_request(connection, address, request)
+        except Exception as e:
+            self.metrics.tcp_errors.inc()
+            log.exception('client_error', address=address, error=str(e))
+        finally:
+            connection.in_flight.release()
+
+    def read_request(self, client_socket, address):
+        """1件のリクエストを受信
+
+        TCRPRequestを返します。接続が閉じられた場合やボディが大きすぎる場合（エラーを返す）はNoneです。
+        """
+        # ヘッダーの受信 (32バイト)
+        header = recv_exactly(client_socket, HEADER_SIZE)
+        if len(header) < HEADER_SIZE:
+            return None
+        started = time.perf_counter_ns()
+
+        room_name_size, operation, state, payload_size = unpack_header(header)
+        request_id = unpack_request_id(header)
+
+        # 最大サイズを超えるリクエストは読まずにエラーを返して切断する
+        # （残りのボディが接続に残ると、パイプライン接続で次のヘッダーの位置が分からなくなるため）
+        if payload_size > MAX_PAYLOAD_SIZE:
+            log.warning('payload_too_large', address=address, size=payload_size, limit=MAX_PAYLOAD_SIZE)
+            self.send_response(client_socket, operation, STATE_ERROR, b'', "Payload too large", request_id)
+            self.metrics.tcp_requests['other'].inc()
+            return None
+
+        # データの受信
+        data = recv_exactly(client_socket, room_name_size + payload_size)
+        if len(data) < room_name_size + payload_size:
+            log.warning('incomplete_request', address=address)
+            return None
+        return TCRPRequest(header, operation, state, request_id, room_name_size, data, started)
+
+    def process_request(self, client_socket, address, request):
+        """受信したリクエストを処理して応答"""
+        header, operation, state, request_id, room_name_size, data, started = request
+        payload_size = len(data) - room_name_size
+        room_bytes = data[:room_name_size]
+        try:
+            room_name = room_bytes.decode('utf-8')
+        except UnicodeDecodeError:
+            # 置換文字に置き換えるとUTF-8で255バイトを超えて応答を作れないことがあるため、
+            # 登録せずに受け取ったバイト列のままエラーを返す
+            log.warning('invalid_room_name', address=address, op=operation)
+            self.send_response(client_socket, operation, STATE_ERROR, room_bytes,
+                               "Room name must be valid UTF-8", request_id)
+            self.metrics.tcp_requests['other'].inc()
+            return
+        payload = data[room_name_size:].decode('utf-8', errors='replace')
+
+        if log.enabled(logging.DEBUG):
+            log.debug('request', address=address, op=operation, state=state, room=room_name,
+                      payload_size=payload_size, request_id=request_id, header=header[:8].hex(' '))
+
+        # 操作に応じた処理
+        if operation == OP_CREATE and state == STATE_REQUEST:  # ルーム作成リクエスト
+            op_name = 'create'
+            self.handle_create_room(client_socket, room_name, payload, address, request_id)
+        elif operation == OP_JOIN and state == STATE_REQUEST:  # ルーム参加リクエスト
+            op_name = 'join'
+            self.handle_join_room(client_socket, room_name, payload, address, request_id)
+        elif operation == OP_LIST and state == STATE_REQUEST:  # ルーム一覧・検索リクエスト
+            op_name = 'list'
+            self.handle_list_rooms(client_socket, room_name, payload, request_id)
+        elif operation == OP_HISTORY and state == STATE_REQUEST:  # 履歴の取得リクエスト
+            op_name = 'history'
+            self.handle_history(client_socket, room_name, payload, request_id)
+        else:
+            op_name = 'other'
+            if request_id is not None:
+                # パイプライン接続では応答を待つクライアントがいるため、未対応の操作にもエラーを返す
+                self.send_response(client_socket, operation, STATE_ERROR, room_name,
+                                   "Unsupported operation", request_id)
+        self.metrics.tcp_requests[op_name].inc()
+        self.metrics.tcp_latency.record(time.perf_counter_ns() - started)
+
+    def send_response(self, client_socket, operation, state, room_name, payload, request_id=None):
+        """レスポンスを送信（リクエストIDがあれば同じIDを付ける）"""
+        client_socket.sendall(encode_message(operation, state, room_name, payload, request_id))
+
+    def new_room(self, name, room_id=None, coalesce_delay=0.0, reliable=False):
+        """サーバーの履歴設定を使ってルームを作成"""
+        history = MessageHistory(self.history_messages, self.history_room_bytes, self.history_budget)
+        retransmit = RetransmitBuffer(self.retransmit_size, self.worker_index) \
+            if reliable and self.retransmit_size > 0 else None
+        return Room(name, room_id=room_id, history=history, log=self.message_log,
+                    coalesce_delay=coalesce_delay, retransmit=retransmit)
+
+    def recent_messages(self, room_id, count=None, since=None):
+        """再参加したクライアント向けに最新count件、またはsince（エポックミリ秒）以降のメッセージを取得
+
+        メッセージログが有効な場合はディスク上のログから、無効な場合はメモリ上の履歴から読み出します。
+        マルチプロセス構成ではメモリ上の履歴はワーカーごとに別々で、どのワーカーが答えるかで結果が変わるため、
+        全ワーカーが同じファイルに書き込むメッセージログが無効ならValueErrorにします。
+        """
+        if self.cluster and not self.message_log:
+            raise ValueError("History requires --log-dir when running with --workers")
+        if self.message_log:
+            reader = self.message_log.reader(room_id)
+        elif room_id in self.rooms:
+            reader = self.rooms[room_id].messages
+        else:
+            return []
+        if since is not None:
+            records = reader.since(since)
+            return records[-count:] if count else records
+        return reader.latest(count or DEFAULT_MAX_MESSAGES)
+
+    def history_stats(self):
+        """ルームごとと全体の履歴メモリ使用量"""
+        return {
+            'total_bytes': self.history_budget.used,
+            'max_total_bytes': self.history_budget.max_bytes,
+            'rooms': {room_id: room.history_stats() for room_id, room in list(self.rooms.items())},
+        }
+
+    def register_room(self, room, replicate=True):
+        """ルームを登録"""
+        self.rooms[room.id] = room
+        self.room_index.add(room)
+        if replicate and self.cluster:
+            self.cluster.publish('room_created', room.id, room.name, room.coalesce_delay,
+                                 room.retransmit is not None)
+
+    def register_client(self, room, token, client_info, is_host=False, replicate=True):
+        """クライアントをルームに登録"""
+        room.add_client(token, client_info, is_host=is_host)
+        self.tokens[token.encode('utf-8')] = (room, client_info, token)
+        self.expiry.track(room.id, token, client_info)
+        self.room_index.update_members(room)
+        if replicate and self.cluster:
+            self.cluster.publish('client_joined', room.id, token, client_info.username,
+                                 client_info.address, is_host, client_info.tagged)
+
+    def wait_replicated(self):
+        """マルチプロセス構成では、ここまでの作成・参加を他のワーカーが適用するまで待つ
+
+        応答を受け取ったクライアントが別のワーカーに参加やUDPパケットを送っても見つかるようにします。
+        """
+        if self.cluster:
+            self.cluster.wait_replicated()
+
+    def unregister_client(self, room_id, token, replicate=True):
+        """クライアントをルームから削除（ホストの場合はルームも削除）"""
+        room = self.rooms.get(room_id)
+        if room is None:
+            return
+        if replicate and self.cluster:
+            self.cluster.publish('client_removed', room_id, token)
+        self.tokens.pop(token.encode('utf-8'), None)
+        if not room.remove_client(token) or not room.clients:
+            self.remove_room(room_id, replicate=False)
+        else:
+            self.room_index.update_members(room)
+
+    def remove_room(self, room_id, replicate=True):
+        """ルームを削除"""
+        room = self.rooms.pop(room_id, None)
+        if room is None:
+            return
+        for token in list(room.clients):
+            self.tokens.pop(token.encode('utf-8'), None)
+        self.room_index.remove(room)
+        room.close()
+        if replicate and self.cluster:
+            self.cluster.publish('room_removed', room_id)
+
+    def handle_create_room(self, client_socket, room_name, payload, address, request_id=None):
+        """ルーム作成処理
+
+        ペイロードはユーザー名、またはオプション付きのJSON
+        {"username": 名前, "coalesceMs": ミリ秒, "reliable": true, "tagged": true}
+        （coalesceMsを指定するとメッセージをまとめて配信するルーム、reliableを指定すると
+        配信するメッセージに連番を付けて再送要求に答えるルームになります。
+        taggedを指定したクライアントへの配信にはルームタグが付きます）。
+        """
+        username = payload
+        try:
+            username, options = parse_user_payload(payload)
+            if len(room_name.encode('utf-8')) > MAX_ROOM_NAME_SIZE:
+                raise ValueError(f"Room name must be at most {MAX_ROOM_NAME_SIZE} bytes of UTF-8")
+            coalesce_delay = min(max(float(options.get('coalesceMs') or 0), 0.0) / 1000,
+                                 self.max_coalesce_delay)
             # 新しいルームの作成
-            room = Room(room_name)
-            self.rooms[room.id] = room
+            room = self.new_room(room_name, coalesce_delay=coalesce_delay,
+                                 reliable=bool(options.get('reliable')))
             
             # トークンの生成とホスト登録
             token = str(uuid.uuid4())
@@ -128,65 +409,43 @@ class TCPServer:
                 address=address,
                 last_message_time=datetime.now(),
                 username=username,
-                is_host=True
+                is_host=True,
+                tagged=bool(options.get('tagged'))
             )
             
-            room.add_client(token, client_info, is_host=True)
+            self.register_room(room)
+            self.register_client(room, token, client_info, is_host=True)
             
             # レスポンスの構築
             payload = json.dumps({
                 "token": token,
-                "roomId": room.id
+                "roomId": room.id,
+                "coalesceMs": room.coalesce_delay * 1000,
+                "reliable": room.retransmit is not None,
+                "tagged": client_info.tagged
             })
             
             # ペイロードサイズの確認（サイズが大きすぎる場合は切り詰める）
             if len(payload) > 1000:  # 安全なサイズ制限
-                print(f"Warning: Payload too large ({len(payload)} bytes), truncating")
+                log.warning('response_truncated', size=len(payload))
                 payload = payload[:1000]
             
-            # ステータスコードの送信
-            response_header = bytearray(32)
-            response_header[0] = len(room_name)
-            response_header[1] = 1  # オペレーション（作成）
-            response_header[2] = 1  # ステータス（応答）
+            self.wait_replicated()
+            self.send_response(client_socket, OP_CREATE, STATE_RESPONSE, room_name, payload, request_id)
             
-            # バイト変換をより安全に行う
-            payload_size_str = str(len(payload))
-            for i in range(min(len(payload_size_str), 29)):
-                response_header[3 + i] = ord(payload_size_str[i])
-            # 残りは0で埋める
-            for i in range(len(payload_size_str), 29):
-                response_header[3 + i] = 0
-            
-            print(f"レスポンス送信: room_name={room_name}, payload_size={len(payload)}")
-            print(f"Debug - レスポンスヘッダー: {', '.join([f'{b:02x}' for b in response_header[:8]])}")
-            client_socket.send(response_header + room_name.encode('utf-8') + payload.encode('utf-8'))
-            
-            print(f"Room created: {room_name} (ID: {room.id})")
+            log.info('room_created', room_id=room.id, name=room_name, host=username)
             
         except Exception as e:
-            print(f"Error creating room: {e}")
-            traceback.print_exc()
-            
-            # エラーレスポンスの構築
-            error_header = bytearray(32)
-            error_header[0] = len(room_name)
-            error_header[1] = 1  # オペレーション（作成）
-            error_header[2] = 2  # ステータス（エラー）
-            error_message = str(e)[:100]  # 長すぎるエラーメッセージを防止
+            log.exception('create_room_error', name=room_name, error=str(e))
             
-            # エラーメッセージサイズを安全に設定
-            error_size_str = str(len(error_message))
-            for i in range(min(len(error_size_str), 29)):
-                error_header[3 + i] = ord(error_size_str[i])
-            for i in range(len(error_size_str), 29):
-                error_header[3 + i] = 0
-                
-            client_socket.send(error_header + room_name.encode('utf-8') + error_message.encode('utf-8'))
-
-    def handle_join_room(self, client_socket, room_id, username, address):
-        """ルーム参加処理"""
+            # エラーレスポンス（長すぎるエラーメッセージを防止）
+            self.send_response(client_socket, OP_CREATE, STATE_ERROR, room_name, str(e)[:100], request_id)
+
+    def handle_join_room(self, client_socket, room_id, payload, address, request_id=None):
+        """ルーム参加処理（ペイロードはユーザー名、またはJSON {"username": 名前, "tagged": true}）"""
+        username = payload
         try:
+            username, options = parse_user_payload(payload)
             if room_id not in self.rooms:
                 raise ValueError("Room not found")
             
@@ -197,60 +456,95 @@ class TCPServer:
             client_info = ClientInfo(
                 address=address,
                 last_message_time=datetime.now(),
-                username=username
+                username=username,
+                tagged=bool(options.get('tagged'))
             )
             
-            room.add_client(token, client_info)
+            self.register_client(room, token, client_info)
             
             # レスポンスの構築
             payload = json.dumps({
                 "token": token,
                 "roomId": room_id,
-                "roomName": room.name
+                "roomName": room.name,
+                "coalesceMs": room.coalesce_delay * 1000,
+                "reliable": room.retransmit is not None,
+                "tagged": client_info.tagged
             })
             
             # ペイロードサイズの確認
             if len(payload) > 1000:
-                print(f"Warning: Payload too large ({len(payload)} bytes), truncating")
+                log.warning('response_truncated', size=len(payload))
                 payload = payload[:1000]
             
-            # ステータスコードの送信
-            response_header = bytearray(32)
-            response_header[0] = len(room_id)
-            response_header[1] = 2  # オペレーション（参加）
-            response_header[2] = 1  # ステータス（応答）
+            self.wait_replicated()
+            self.send_response(client_socket, OP_JOIN, STATE_RESPONSE, room_id, payload, request_id)
             
-            # バイト変換を安全に行う
-            payload_size_str = str(len(payload))
-            for i in range(min(len(payload_size_str), 29)):
-                response_header[3 + i] = ord(payload_size_str[i])
-            # 残りは0で埋める
-            for i in range(len(payload_size_str), 29):
-                response_header[3 + i] = 0
-            
-            print(f"ルーム参加レスポンス送信: room_id={room_id}, payload_size={len(payload)}")
-            print(f"Debug - レスポンスヘッダー: {', '.join([f'{b:02x}' for b in response_header[:8]])}")
-            client_socket.send(response_header + room_id.encode('utf-8') + payload.encode('utf-8'))
-            
-            print(f"Client joined room: {room_id} - {username}")
+            log.info('client_joined', room_id=room_id, username=username)
             
         except Exception as e:
-            print(f"Error joining room: {e}")
-            traceback.print_exc()
+            log.warning('join_room_error', room_id=room_id, error=str(e))
             
-            # エラーレスポンスの構築
-            error_header = bytearray(32)
-            error_header[0] = len(room_id)
-            error_header[1] = 2  # オペレーション（参加）
-            error_header[2] = 2  # ステータス（エラー）
-            error_message = str(e)[:100]  # 長すぎるエラーメッセージを防止
-            
-            # エラーメッセージサイズを安全に設定
-            error_size_str = str(len(error_message))
-            for i in range(min(len(error_size_str), 29)):
-                error_header[3 + i] = ord(error_size_str[i])
-            # 残りは0で埋める
-            for i in range(len(error_size_str), 29):
-                error_header[3 + i] = 0
-                
-            client_socket.send(error_header + room_id.encode('utf-8') + error_message.encode('utf-8')) 
\ No newline at end of file
+            # エラーレスポンス（長すぎるエラーメッセージを防止）
+            self.send_response(client_socket, OP_JOIN, STATE_ERROR, room_id, str(e)[:100], request_id)
+
+    def handle_list_rooms(self, client_socket, prefix, query, request_id=None):
+        """ルーム一覧・検索処理
+
+        ルーム名の欄に名前の前方一致条件、ペイロードにJSONの条件
+        {"sort": "name" | "members" | "activity", "limit": 件数, "cursor": 前のページのnextCursor}
+        を受け取り、RoomIndexから1ページ分を返します。
+        """
+        try:
+            options = json.loads(query) if query else {}
+            if not isinstance(options, dict):
+                raise ValueError("Query must be a JSON object")
+            result = self.room_index.query(sort=options.get('sort', SORT_NAME), prefix=prefix,
+                                           limit=options.get('limit', DEFAULT_LIMIT),
+                                           cursor=options.get('cursor'))
+            self.send_response(client_socket, OP_LIST, STATE_RESPONSE, prefix,
+                               json.dumps(result, ensure_ascii=False), request_id)
+        except Exception as e:
+            log.warning('list_rooms_error', prefix=prefix, error=str(e))
+            self.send_response(client_socket, OP_LIST, STATE_ERROR, prefix, str(e)[:100], request_id)
+
+    def handle_history(self, client_socket, room_id, query, request_id=None):
+        """履歴の取得処理
+
+        ルーム名の欄にルームID、ペイロードにJSONの条件
+        {"token": 参加時のトークン, "count": 件数, "since": エポックミリ秒}
+        を受け取り、recent_messagesの結果を古い順に返します。トークンはそのルームのメンバーのものに限り、
+        本文がHISTORY_RESPONSE_BYTESを超える場合は古いメッセージを省いて "truncated": true を付けます。
+        """
+        try:
+            options = json.loads(query) if query else {}
+            if not isinstance(options, dict):
+                raise ValueError("Query must be a JSON object")
+            token = options.get('token')
+            member = self.tokens.get(token.encode('utf-8')) if isinstance(token, str) else None
+            if member is None or member[0].id != room_id:
+                raise ValueError("Invalid token")
+            count = options.get('count')
+            since = options.get('since')
+            if count is not None and (not isinstance(count, int) or count < 0):
+                raise ValueError("Invalid count")
+            if since is not None and not isinstance(since, int):
+                raise ValueError("Invalid since")
+            count = min(count or DEFAULT_MAX_MESSAGES, DEFAULT_MAX_MESSAGES)
+
+            messages = []
+            size = 0
+            truncated = False
+            for record in reversed(self.recent_messages(room_id, count, since)):
+                message = json.dumps(record.to_dict(), ensure_ascii=False)
+                size += len(message.encode('utf-8')) + 2
+                if size > HISTORY_RESPONSE_BYTES:
+                    truncated = True
+                    break
+                messages.append(message)
+            payload = '{"messages": [%s], "truncated": %s}' % (
+                ', '.join(reversed(messages)), 'true' if truncated else 'false')
+            self.send_response(client_socket, OP_HISTORY, STATE_RESPONSE, room_id, payload, request_id)
+        except Exception as e:
+            log.warning('history_error', room_id=room_id, error=str(e))
+            self.send_response(client_socket, OP_HISTORY, STATE_ERROR, room_id, str(e)[:100], request_id)
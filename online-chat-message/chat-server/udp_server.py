@@ -3,89 +3,311 @@ UDP通信を処理するサーバーモジュール
 チャットメッセージのリアルタイム配信を担当します
 """
 
+import os
 import socket
+import sys
 import threading
-from datetime import datetime, timedelta
+import time
+from coalescer import RoomCoalescer
+from mmsg import MMSG_AVAILABLE, MultiReceiver, MultiSender
+from retransmit import MAX_RETRANSMIT_PER_NACK, limit_ranges
+from room_scheduler import RoomScheduler
+from server_log import get_logger
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'common'))
+
+from udp_batch import MAX_DATAGRAM_SIZE, pack_frames
+from udp_reliable import KIND_LOST, NACK_HEADER, NACK_RANGE, SEQ_MAGIC, encode_ack, parse_nack
+
+log = get_logger('udp')
 
 class UDPServer:
     """UDPサーバー - チャットメッセージを処理"""
-    def __init__(self, tcp_server, host='0.0.0.0', port=10000):
+    def __init__(self, tcp_server, host='0.0.0.0', port=10000, batch_send=True, batch_recv=False,
+                 reuse_port=False, room_workers=0, room_queue_size=1024, rate_limits=None):
         self.host = host
         self.port = port
         self.socket = None
         self.tcp_server = tcp_server
         self.running = False
+        self.reuse_port = reuse_port
+        # sendmmsg/recvmmsgが使える場合はバッチ送受信を行う
+        self.batch_send = batch_send and MMSG_AVAILABLE
+        self.batch_recv = batch_recv and MMSG_AVAILABLE
+        self.senders = threading.local()  # MultiSenderはスレッドごとに持つ
+        self.metrics = tcp_server.metrics
+        self.rate_limits = rate_limits  # rate_limit.RateLimits（Noneなら流量制限なし）
+        # room_workersが1以上ならルームごとにワーカースレッドへ振り分ける
+        self.scheduler = RoomScheduler(self.handle_message, room_workers, room_queue_size,
+                                       is_room=self.is_room) if room_workers > 0 else None
+        if self.scheduler:
+            self.metrics.gauge('chat_room_queue_depth', 'Messages waiting for room workers',
+                               lambda: sum(self.scheduler.queue_depths()))
+            self.metrics.gauge_set('chat_room_worker_latency_seconds',
+                                   'Queueing plus handling time per room (rooms with the highest p99)',
+                                   self.scheduler.metric_samples)
+        self.coalescer = RoomCoalescer(self)  # まとめ送信が有効なルーム用
+
+    def is_room(self, room_key):
+        """ルームIDのバイト列が登録済みのルームか"""
+        return room_key.decode('utf-8', errors='replace') in self.tcp_server.rooms
 
     def start(self):
         """サーバーを起動"""
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.socket.bind((self.host, self.port))
+        self.socket = self.create_socket()
         self.running = True
-        print(f"UDP Server running on {self.host}:{self.port}")
+        if self.scheduler:
+            self.scheduler.start()
+        self.coalescer.start()
+        log.info('listening', host=self.host, port=self.port, engine='thread',
+                 batch_send=self.batch_send, batch_recv=self.batch_recv)
+
+        if self.batch_recv:
+            self.receive_batches()
+            return
+
+        # 受信バッファを使い回し、memoryviewでコピーせずに解析する
+        buffer = bytearray(4096)
+        view = memoryview(buffer)
+        recvfrom_into = self.socket.recvfrom_into
+        while self.running:
+            try:
+                size, address = recvfrom_into(buffer)
+                self.dispatch(view[:size], address)
+            except Exception as e:
+                self.metrics.udp_dropped['error'].inc()
+                log.error('message_error', error=str(e))
+
+    def create_socket(self):
+        """待ち受け用のUDPソケットを作成"""
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        if self.reuse_port:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind((self.host, self.port))
+        return sock
 
+    def receive_batches(self):
+        """recvmmsgで複数のデータグラムをまとめて受信して処理"""
+        receiver = MultiReceiver()
         while self.running:
             try:
-                data, address = self.socket.recvfrom(4096)
-                self.handle_message(data, address)
+                for data, address in receiver.recv(self.socket):
+                    self.dispatch(data, address)
             except Exception as e:
-                print(f"UDP message error: {e}")
+                if self.running:
+                    self.metrics.udp_dropped['error'].inc()
+                    log.error('message_error', error=str(e))
+
+    def dispatch(self, data, address):
+        """受信したデータグラムを直接、またはルームのワーカー経由で処理
+
+        dataは受信バッファのmemoryviewの場合があるため、
+        ワーカーへ渡すときはバッファが再利用される前にコピーします。
+        送信元IPアドレスの流量制限はここで確認し、超えたパケットは解析せずに破棄します。
+        有効なトークンからの再送要求・生存通知の制御パケットは、多数のセッションを持つ送信元でも
+        届くよう制限の対象外です（送り直すフレーム数はhandle_nackでトークンごとに制限します）。
+        """
+        self.metrics.udp_received.inc()
+        limits = self.rate_limits
+        if (limits is not None and limits.address is not None and not self.is_control(data)
+                and not limits.allow_address(address, time.monotonic())):
+            self.metrics.udp_dropped['rate_address'].inc()
+            log.warning('rate_limited', address=address, limit='address')
+            return
+        if self.scheduler is None:
+            self.handle_message(data, address)
+        elif len(data) >= 2:
+            data = bytes(data)
+            # ルームIDだけをデコードせずに取り出して振り分ける
+            if not self.scheduler.submit(data[2:2+data[0]], data, address):
+                self.metrics.udp_dropped['queue_full'].inc()
+
+    def is_control(self, data):
+        """本文が再送要求（範囲のない生存通知を含む）の形式どおりで、トークンがそのルームで有効ならTrue"""
+        if len(data) < 2:
+            return False
+        token_start = 2 + data[0]
+        message_start = token_start + data[1]
+        body_size = len(data) - message_start
+        if body_size < NACK_HEADER.size or data[message_start] != SEQ_MAGIC:
+            return False
+        if body_size != NACK_HEADER.size + data[message_start + 2] * NACK_RANGE.size:
+            return False
+        entry = self.tcp_server.tokens.get(bytes(data[token_start:message_start]))
+        return entry is not None and data[2:token_start] == entry[0].id_bytes
 
     def handle_message(self, data, address):
-        """UDPメッセージの処理"""
+        """UDPメッセージの処理
+
+        dataはbytesまたはmemoryviewで、本文はデコードせずにバイト列のまま転送します。
+        """
+        started = time.perf_counter_ns()
+        metrics = self.metrics
         try:
             # ヘッダー解析
             room_id_size = data[0]
-            token_size = data[1]
+            token_start = 2 + room_id_size
+            message_start = token_start + data[1]
             
-            # データの解析
-            room_id = data[2:2+room_id_size].decode('utf-8')
-            token = data[2+room_id_size:2+room_id_size+token_size].decode('utf-8')
-            message = data[2+room_id_size+token_size:].decode('utf-8')
-            
-            # ルームとトークンの検証
-            if room_id not in self.tcp_server.rooms:
-                print(f"Room {room_id} not found")
+            # トークンのバイト列から直接ルームとクライアントを引く
+            token_key = bytes(data[token_start:message_start])
+            entry = self.tcp_server.tokens.get(token_key)
+            if entry is None:
+                metrics.udp_dropped['invalid_token'].inc()
+                log.warning('invalid_token', address=address)
                 return
-                
-            room = self.tcp_server.rooms[room_id]
-            if token not in room.clients:
-                print(f"Invalid token for room {room_id}")
+            room, client_info, token = entry
+            if data[2:token_start] != room.id_bytes:
+                metrics.udp_dropped['room_mismatch'].inc()
+                log.warning('room_mismatch', address=address, room_id=room.id)
                 return
-                
-            # クライアント情報の更新
-            client_info = room.clients[token]
-            client_info.update_message_time()
-            client_info.address = address  # アドレスの更新（IP変更に対応）
+            if len(data) - message_start >= NACK_HEADER.size and data[message_start] == SEQ_MAGIC:
+                # 制御パケット: 再送要求（範囲がなければアドレスの登録と生存通知のみ）
+                # チャットメッセージとしては扱わず、流量制限もかけない
+                self.update_client(room, client_info, token, address)
+                self.handle_nack(room, client_info, token, data[message_start:])
+                return
+            # トークンとルームの流量制限（履歴への保存・転送の前に確認）
+            limits = self.rate_limits
+            if limits is not None:
+                reason = limits.check_sender(token_key, room.id_bytes, time.monotonic())
+                if reason:
+                    metrics.udp_dropped[reason].inc()
+                    log.warning('rate_limited', address=address, room_id=room.id,
+                                limit=reason[len('rate_'):])
+                    return
+            message = bytes(data[message_start:])
+            self.update_client(room, client_info, token, address)
             
             # メッセージをルームの全クライアントに転送
-            sender = client_info.username
-            room.add_message(sender, message)
+            room.add_message(client_info.username, message)
             
-            formatted_message = f"{sender}: {message}".encode('utf-8')
-            
-            for client_address in room.get_client_addresses(token):
-                self.socket.sendto(formatted_message, client_address)
+            formatted_message = client_info.prefix + message
+            if room.retransmit is not None:
+                formatted_message = room.retransmit.add(formatted_message, token)
+            addresses, positions = room.recipient_list()
+            skip = positions.get(token)
+            tagged, tagged_positions = room.tagged_recipient_list()
+            tagged_skip = tagged_positions.get(token)
+            # まとめ送信が有効なルームはバッチに追加し、数ミリ秒後にまとめて配信
+            if not (room.coalesce_delay and self.coalescer.add(room, token, formatted_message)):
+                self.relay(formatted_message, addresses, skip)
+                if tagged:
+                    self.relay(room.tag + formatted_message, tagged, tagged_skip)
+                if room.retransmit is not None:
+                    # 送信者には本文の代わりに連番だけを送り、自分のメッセージが欠番にならないようにする
+                    ack = encode_ack(formatted_message)
+                    if skip is not None:
+                        self.relay(ack, (addresses[skip],))
+                    if tagged_skip is not None:
+                        self.relay(room.tag + ack, (tagged[tagged_skip],))
+            fanout = len(addresses) + len(tagged) - (skip is not None) - (tagged_skip is not None)
+            metrics.udp_fanout.record(fanout)
+            metrics.udp_relay_latency.record(time.perf_counter_ns() - started)
                 
         except Exception as e:
-            print(f"Error handling UDP message: {e}")
+            metrics.udp_dropped['error'].inc()
+            log.error('message_error', address=address, error=str(e))
+
+    def update_client(self, room, client_info, token, address):
+        """クライアントの最終活動時刻とアドレスを更新（IP変更に対応）"""
+        client_info.update_message_time()
+        self.tcp_server.room_index.touch(room, client_info.last_active)
+        if room.update_client_address(token, address):
+            if self.tcp_server.cluster:
+                self.tcp_server.cluster.publish('address', room.id, token, address)
+        if self.tcp_server.cluster:
+            self.tcp_server.cluster.touch(room.id, token)
+
+    def handle_nack(self, room, client_info, token, body):
+        """再送要求に答える（他のワーカーが配信したストリームならクラスタ経由で転送）
+
+        送り直すフレーム数はトークンごとの再送の流量制限にかけ、超えた分は送りません
+        （クライアントは残りを後で要求し直します）。
+        """
+        stream, ranges = parse_nack(bytes(body))
+        if not ranges:
+            return
+        self.metrics.udp_nacks.inc()
+        if room.retransmit is None:
+            return
+        limits = self.rate_limits
+        if limits is not None:
+            requested = min(sum(count for _, count in ranges), MAX_RETRANSMIT_PER_NACK)
+            granted = limits.retransmit_frames(token, requested, time.monotonic())
+            if granted < requested:
+                self.metrics.udp_retransmit_limited.inc(requested - granted)
+                if not granted:
+                    return
+                ranges = limit_ranges(ranges, granted)
+        if stream == room.retransmit.stream:
+            self.retransmit(room, ranges, client_info.address, room.tag if client_info.tagged else b'',
+                            token)
+        elif self.tcp_server.cluster:
+            self.tcp_server.cluster.publish('nack', room.id, stream, ranges, client_info.address,
+                                            client_info.tagged, token)
+
+    def retransmit(self, room, ranges, address, tag=b'', token=None):
+        """要求された連番のメッセージをまとめ送信の形式に詰めて送り直す
+
+        tagはルームタグ、tokenは要求したクライアントのトークンです（そのクライアント自身のメッセージは連番の通知にする）。
+        """
+        frames = room.retransmit.lookup(ranges, requester=token)
+        missing = sum(1 for frame in frames if frame[1] == KIND_LOST)
+        # タグ付きで送っても上限に収まるよう、タグの分を引いた大きさに詰める
+        for datagram in pack_frames(frames, MAX_DATAGRAM_SIZE - len(tag)):
+            self.relay(tag + datagram, (address,))
+        self.metrics.udp_retransmitted.inc(len(frames) - missing)
+        if missing:
+            self.metrics.udp_retransmit_missing.inc(missing)
+
+    @property
+    def multi_sender(self):
+        """呼び出し元スレッド用のMultiSender（バッチ送信無効時はNone）"""
+        if not self.batch_send:
+            return None
+        sender = getattr(self.senders, 'sender', None)
+        if sender is None:
+            sender = self.senders.sender = MultiSender()
+        return sender
+
+    def relay(self, data, addresses, skip=None):
+        """メッセージを複数のアドレス（skip番目を除く）へ転送"""
+        multi_sender = self.multi_sender
+        if multi_sender and len(addresses) > 2:
+            multi_sender.sendto_many(self.socket, data, addresses, skip)
+            return
+        sendto = self.socket.sendto
+        for index, client_address in enumerate(addresses):
+            if index != skip:
+                sendto(data, client_address)
+
+    def stop(self):
+        """サーバーを停止"""
+        self.running = False
+        if self.scheduler:
+            self.scheduler.stop()
+        self.coalescer.stop()
+        if self.socket:
+            self.socket.close()
 
     def remove_inactive_clients(self):
-        """非アクティブなクライアントを削除"""
-        current_time = datetime.now()
-        timeout = timedelta(minutes=3)
-        
-        for room_id, room in list(self.tcp_server.rooms.items()):
-            inactive_tokens = []
-            
-            for token, client in room.clients.items():
-                if current_time - client.last_message_time > timeout:
-                    inactive_tokens.append(token)
-            
-            room_active = True
-            for token in inactive_tokens:
-                # クライアント削除（ホストの場合はルームも削除）
-                if not room.remove_client(token):
-                    room_active = False
-                    
-            if not room_active or not room.clients:
-                del self.tcp_server.rooms[room_id] 
\ No newline at end of file
+        """非アクティブなクライアントを削除
+
+        タイミングホイールで期限を迎えたクライアントだけを確認するため、
+        処理量は接続中の全クライアント数ではなく期限切れの数に比例します。
+        """
+        started = time.perf_counter_ns()
+        rooms = self.tcp_server.rooms
+        removed = 0
+        for room_id, token in self.tcp_server.expiry.expired(rooms):
+            # クライアント削除（ホストの場合はルームも削除）
+            self.tcp_server.unregister_client(room_id, token)
+            removed += 1
+            if self.scheduler and room_id not in rooms:
+                self.scheduler.forget(room_id.encode('utf-8'))
+        if self.rate_limits is not None:
+            self.rate_limits.prune(time.monotonic())
+        self.metrics.cleanup_runs.inc()
+        self.metrics.cleanup_expired.inc(removed)
+        self.metrics.cleanup_duration.record(time.perf_counter_ns() - started)
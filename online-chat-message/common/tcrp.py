@@ -0,0 +1,93 @@
+"""
+TCRP（チャットルームプロトコル）のヘッダーとボディのエンコード・デコード
+サーバー（chat-server/tcp_server.py）とクライアント（chat-client/tcp_client.py）で共有します
+
+ヘッダー（32バイト）:
+    RoomNameSize(1) | Operation(1) | State(1) | OperationPayloadSize(29)
+OperationPayloadSizeはASCIIの10進数字で、残りはヌルバイトで埋めます。
+
+リクエストID拡張（パイプライン接続）:
+    RoomNameSize(1) | Operation(1) | State(1) | OperationPayloadSize(24) | 0xFE(1) | RequestId(4)
+OperationPayloadSizeの末尾5バイトにマーカーとリクエストIDを入れます。サイズの数字はヌルバイトで
+終わるため、拡張を知らない実装はこの5バイトを無視します。リクエストIDの付いたリクエストを受けた
+サーバーは同じIDを付けて応答し、接続を閉じずに次のリクエストを待ちます。
+"""
+
+import struct
+
+HEADER = struct.Struct('!BBB29s')
+HEADER_SIZE = HEADER.size
+EXTENDED_HEADER = struct.Struct('!BBB24sBI')
+REQUEST_ID = struct.Struct('!I')
+REQUEST_ID_MARKER = 0xFE
+REQUEST_ID_OFFSET = 28
+
+OP_CREATE = 1
+OP_JOIN = 2
+OP_LIST = 3  # ルームの一覧・検索（ルーム名の欄に名前の前方一致、ペイロードにJSONの条件）
+OP_HISTORY = 4  # ルームの最近のメッセージ（ルーム名の欄にルームID、ペイロードにJSONの条件）
+
+STATE_REQUEST = 0
+STATE_RESPONSE = 1
+STATE_ERROR = 2
+
+MAX_PAYLOAD_SIZE = 10240  # 受信するペイロードの上限（10KB）
+MAX_ROOM_NAME_SIZE = 255  # RoomNameSizeは1バイトのため、ルーム名はUTF-8で255バイトまで
+
+
+def to_bytes(value):
+    return value.encode('utf-8') if isinstance(value, str) else value
+
+
+def parse_size(field):
+    """OperationPayloadSizeフィールドを整数に変換（数字以外は無視）"""
+    digits = field.split(b'\0', 1)[0]
+    if digits.isdigit():
+        return int(digits)
+    digits = bytes(b for b in digits if 48 <= b <= 57)
+    return int(digits) if digits else 0
+
+
+def pack_header(room_size, operation, state, payload_size, request_id=None):
+    """32バイトのヘッダーを作成（request_idを指定するとリクエストID拡張付き）"""
+    if request_id is None:
+        return HEADER.pack(room_size, operation, state, b'%d' % payload_size)
+    return EXTENDED_HEADER.pack(room_size, operation, state, b'%d' % payload_size,
+                                REQUEST_ID_MARKER, request_id)
+
+
+def unpack_header(header):
+    """ヘッダーを (room_size, operation, state, payload_size) に変換"""
+    room_size, operation, state, size_field = HEADER.unpack_from(header)
+    return room_size, operation, state, parse_size(size_field)
+
+
+def unpack_request_id(header):
+    """リクエストID拡張のIDを返す（拡張なしのヘッダーはNone）"""
+    if header[REQUEST_ID_OFFSET - 1] != REQUEST_ID_MARKER:
+        return None
+    return REQUEST_ID.unpack_from(header, REQUEST_ID_OFFSET)[0]
+
+
+def encode_message(operation, state, room, payload, request_id=None):
+    """ヘッダーとボディをまとめたバイト列を作成（room, payloadはstrまたはbytes）
+
+    ヘッダーは1回のstruct.packで作り、ボディと連結するだけでメッセージになります。
+    """
+    room = to_bytes(room)
+    payload = to_bytes(payload)
+    return pack_header(len(room), operation, state, len(payload), request_id) + room + payload
+
+
+def recv_exactly(sock, size):
+    """sizeバイトを受信（途中で切断された場合はそこまでのデータを返す）"""
+    data = sock.recv(size)
+    if len(data) == size or not data:
+        return data
+    buffer = bytearray(data)
+    while len(buffer) < size:
+        chunk = sock.recv(size - len(buffer))
+        if not chunk:
+            break
+        buffer += chunk
+    return bytes(buffer)
@@ -0,0 +1,96 @@
+"""
+UDPリレーのまとめ送信（バッチ）形式
+
+まとめ送信が有効なルームでは、サーバーが数ミリ秒以内に届いた複数のメッセージを
+1つのデータグラムにまとめて配信します:
+
+    0xFF | フレーム数(1) | (長さ(2) | "ユーザー名: 本文") × フレーム数
+
+通常のメッセージは「ユーザー名: 本文」のUTF-8なので、UTF-8に現れない0xFFで始まるかどうかで区別できます。
+データグラムの大きさはクライアントの受信上限（MAX_DATAGRAM_SIZE）以下に収めます。
+
+1つのUDPソケットで複数のルームに参加するクライアント（参加時にtaggedを指定）には、
+どのルームのデータグラムか分かるようにルームタグを先頭に付けて配信します:
+
+    0xFD | ルームIDの長さ(1) | ルームID | データグラム（通常・まとめ送信・連番付き）
+"""
+
+import struct
+
+BATCH_MAGIC = 0xFF
+ROOM_TAG_MAGIC = 0xFD
+BATCH_HEADER_SIZE = 2
+FRAME_LENGTH = struct.Struct('!H')
+FRAME_OVERHEAD = FRAME_LENGTH.size
+MAX_DATAGRAM_SIZE = 4094
+MAX_FRAMES = 255
+
+
+def encode_batch(frames):
+    """フレーム（bytes）のリストを1つのデータグラムにする"""
+    parts = [bytes((BATCH_MAGIC, len(frames)))]
+    pack = FRAME_LENGTH.pack
+    for frame in frames:
+        parts.append(pack(len(frame)))
+        parts.append(frame)
+    return b''.join(parts)
+
+
+def batch_size(frame_sizes):
+    """フレームの大きさのリストからデータグラムの大きさを求める"""
+    return BATCH_HEADER_SIZE + sum(frame_sizes) + FRAME_OVERHEAD * len(frame_sizes)
+
+
+def pack_frames(frames, max_size=MAX_DATAGRAM_SIZE):
+    """フレームのリストをmax_size以下のデータグラムに詰める（1件だけのものはそのまま）
+
+    ルームタグを付けて送る場合は、max_sizeにタグの分を引いた大きさを指定します。
+    """
+    datagrams = []
+    batch = []
+    size = BATCH_HEADER_SIZE
+    for frame in frames:
+        if batch and (size + FRAME_OVERHEAD + len(frame) > max_size or len(batch) >= MAX_FRAMES):
+            datagrams.append(encode_batch(batch) if len(batch) > 1 else batch[0])
+            batch = []
+            size = BATCH_HEADER_SIZE
+        batch.append(frame)
+        size += FRAME_OVERHEAD + len(frame)
+    if batch:
+        datagrams.append(encode_batch(batch) if len(batch) > 1 else batch[0])
+    return datagrams
+
+
+def room_tag(room_id_bytes):
+    """ルームタグ（タグ付きで配信するデータグラムの先頭）"""
+    return bytes((ROOM_TAG_MAGIC, len(room_id_bytes))) + room_id_bytes
+
+
+def split_room_tag(data):
+    """データグラムを (ルームID（bytes、タグなしならNone）, 残り) にする"""
+    if len(data) < 2 or data[0] != ROOM_TAG_MAGIC or len(data) < 2 + data[1]:
+        return None, data
+    end = 2 + data[1]
+    return bytes(data[2:end]), data[end:]
+
+
+def split_datagram(data):
+    """受信したデータグラムをメッセージ（bytes）のリストにする（まとめ送信でなければ[data]）
+
+    途中で切れたフレームは捨てます。
+    """
+    if not data or data[0] != BATCH_MAGIC:
+        return [data]
+    frames = []
+    offset = BATCH_HEADER_SIZE
+    unpack_from = FRAME_LENGTH.unpack_from
+    for _ in range(data[1] if len(data) > 1 else 0):
+        if offset + FRAME_OVERHEAD > len(data):
+            break
+        (length,) = unpack_from(data, offset)
+        offset += FRAME_OVERHEAD
+        if offset + length > len(data):
+            break
+        frames.append(bytes(data[offset:offset + length]))
+        offset += length
+    return frames
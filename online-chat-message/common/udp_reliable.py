@@ -0,0 +1,175 @@
+"""
+UDPリレーの再送制御（信頼性モード）の形式と受信側の欠番検出
+
+信頼性モードのルームでは、サーバーが配信するメッセージに連番を付けます:
+
+    0xFE | 種別(1) | ストリーム(1) | 連番(4) | "ユーザー名: 本文"
+
+ストリームはメッセージを配信したワーカーの番号で、連番はルームとストリームごとに増えます。
+種別は通常のメッセージ（KIND_DATA）か、再送バッファから消えていて再送できない通知（KIND_LOST、本文なし）、
+または送信者自身のメッセージの連番だけを知らせる通知（KIND_ACK、本文なし）です。送信者には自分のメッセージの
+代わりにKIND_ACKが届くため、自分のメッセージの連番が欠番になりません。
+まとめ送信（common/udp_batch.py）が有効なルームでは、連番付きのフレームがまとめられます。
+
+クライアントは欠番を見つけると、通常の送信パケットの本文に再送要求（NACK）を入れて送ります:
+
+    0xFE | ストリーム(1) | 範囲の数(1) | (先頭の連番(4) | 件数(2)) × 範囲の数
+
+欠番があっても後続のメッセージはすぐに渡し、再送されたメッセージは届いた時点で渡します（到着順）。
+"""
+
+import struct
+
+SEQ_MAGIC = 0xFE
+KIND_DATA = 0
+KIND_LOST = 1
+KIND_ACK = 2
+SEQ_HEADER = struct.Struct('!BBBI')
+SEQ_HEADER_SIZE = SEQ_HEADER.size
+NACK_HEADER = struct.Struct('!BBB')
+NACK_RANGE = struct.Struct('!IH')
+MAX_NACK_RANGES = 64
+
+
+def encode_sequenced(stream, seq, frame, kind=KIND_DATA):
+    """連番付きのフレームを作る"""
+    return SEQ_HEADER.pack(SEQ_MAGIC, kind, stream, seq) + frame
+
+
+def encode_ack(frame):
+    """連番付きフレームと同じ連番の、送信者向けの通知（本文なし）"""
+    return bytes((SEQ_MAGIC, KIND_ACK)) + frame[2:SEQ_HEADER_SIZE]
+
+
+def parse_sequenced(frame):
+    """フレームを (種別, ストリーム, 連番, 本文) にする（連番なしのフレームは種別・ストリーム・連番がNone）"""
+    if len(frame) < SEQ_HEADER_SIZE or frame[0] != SEQ_MAGIC:
+        return None, None, None, frame
+    _, kind, stream, seq = SEQ_HEADER.unpack_from(frame)
+    return kind, stream, seq, frame[SEQ_HEADER_SIZE:]
+
+
+def seq_ranges(seqs):
+    """昇順の連番のリストを (先頭, 件数) の範囲にまとめる"""
+    ranges = []
+    for seq in seqs:
+        if ranges and ranges[-1][0] + ranges[-1][1] == seq and ranges[-1][1] < 0xFFFF:
+            ranges[-1][1] += 1
+        else:
+            ranges.append([seq, 1])
+    return [tuple(r) for r in ranges]
+
+
+def encode_nack(stream, ranges):
+    """再送要求の本文を作る（範囲はMAX_NACK_RANGES個まで）"""
+    ranges = ranges[:MAX_NACK_RANGES]
+    parts = [NACK_HEADER.pack(SEQ_MAGIC, stream, len(ranges))]
+    parts.extend(NACK_RANGE.pack(start, count) for start, count in ranges)
+    return b''.join(parts)
+
+
+def parse_nack(body):
+    """再送要求の本文を (ストリーム, [(先頭, 件数)]) にする（途中で切れた範囲は捨てる）"""
+    _, stream, count = NACK_HEADER.unpack_from(body)
+    ranges = []
+    offset = NACK_HEADER.size
+    for _ in range(count):
+        if offset + NACK_RANGE.size > len(body):
+            break
+        ranges.append(NACK_RANGE.unpack_from(body, offset))
+        offset += NACK_RANGE.size
+    return stream, ranges
+
+
+class StreamState:
+    """1つのストリームの受信状況"""
+
+    __slots__ = ('expected', 'missing')
+
+    def __init__(self, expected):
+        self.expected = expected  # 次に届くはずの連番
+        self.missing = {}  # 欠番 -> [次に再送要求する時刻, 再送要求した回数]
+
+
+class SequenceTracker:
+    """連番付きメッセージの重複と欠番を検出し、再送要求する欠番を決める
+
+    最初に受信した連番から数え始めるため、参加前のメッセージは欠番になりません。
+    欠番はnack_delay秒後に要求し、届かなければretry_interval秒ごとにmax_retries回まで要求し直します。
+    一度に追跡する欠番はストリームごとにwindow個までで、それより古いものは失われたものとして数えます。
+    """
+
+    def __init__(self, nack_delay=0.01, retry_interval=0.2, max_retries=5, window=4096):
+        self.nack_delay = nack_delay
+        self.retry_interval = retry_interval
+        self.max_retries = max_retries
+        self.window = window
+        self.streams = {}  # ストリーム -> StreamState
+        self.next_due = None  # 次に再送要求する時刻（欠番がなければNone）
+        self.stats = {'gaps': 0, 'nacks': 0, 'recovered': 0, 'lost': 0, 'duplicates': 0}
+
+    def receive(self, stream, seq, now):
+        """連番を記録し、初めて届いたメッセージならTrue（重複はFalse）"""
+        state = self.streams.get(stream)
+        if state is None:
+            self.streams[stream] = StreamState(seq + 1)
+            return True
+        if seq >= state.expected:
+            gap = seq - state.expected
+            if gap:
+                start = state.expected
+                if gap > self.window:
+                    self.stats['lost'] += gap - self.window
+                    start = seq - self.window
+                due = now + self.nack_delay
+                for missing in range(start, seq):
+                    state.missing[missing] = [due, 0]
+                self.stats['gaps'] += seq - start
+                if self.next_due is None or due < self.next_due:
+                    self.next_due = due
+                if len(state.missing) > self.window:
+                    for old in sorted(state.missing)[:len(state.missing) - self.window]:
+                        del state.missing[old]
+                        self.stats['lost'] += 1
+            state.expected = seq + 1
+            return True
+        if state.missing.pop(seq, None) is not None:
+            self.stats['recovered'] += 1
+            return True
+        self.stats['duplicates'] += 1
+        return False
+
+    def give_up(self, stream, seq):
+        """再送できないと通知された欠番を失われたものとして数える"""
+        state = self.streams.get(stream)
+        if state is not None and state.missing.pop(seq, None) is not None:
+            self.stats['lost'] += 1
+
+    def due(self, now):
+        """再送要求する欠番を [(ストリーム, [(先頭, 件数)])] で返す"""
+        if self.next_due is None or now < self.next_due:
+            return []
+        requests = []
+        next_due = None
+        for stream, state in self.streams.items():
+            seqs = []
+            for seq, entry in list(state.missing.items()):
+                if entry[0] > now:
+                    if next_due is None or entry[0] < next_due:
+                        next_due = entry[0]
+                    continue
+                if entry[1] >= self.max_retries:
+                    del state.missing[seq]
+                    self.stats['lost'] += 1
+                    continue
+                entry[0] = now + self.retry_interval
+                entry[1] += 1
+                seqs.append(seq)
+                if next_due is None or entry[0] < next_due:
+                    next_due = entry[0]
+            if seqs:
+                seqs.sort()
+                requests.append((stream, seq_ranges(seqs)))
+        self.next_due = next_due
+        self.stats['nacks'] += len(requests)
+        return requests